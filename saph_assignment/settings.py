@@ -75,6 +75,58 @@ CELERY_RESULT_BACKEND = 'redis://localhost:6379/0'
 # set the celery timezone
 CELERY_TIMEZONE = 'UTC'
 
+# The file rewrite waits until no row changed for VCFAPI_SYNC_DEBOUNCE seconds, but never
+# longer than VCFAPI_SYNC_MAX_LATENCY seconds after the first change, folding bursts of
+# writes into a single rewrite
+VCFAPI_SYNC_DEBOUNCE = 1.0
+VCFAPI_SYNC_MAX_LATENCY = 30.0
+
+# The change feed keeps the deletion events for VCFAPI_CHANGES_RETENTION seconds after they
+# reach the file, a client resuming from an older version has to copy the rows again.
+# A long polling request waits up to VCFAPI_CHANGES_MAX_WAIT seconds for changes, holding a
+# server thread meanwhile. Serve the API threaded (runserver is, gunicorn needs --threads) and
+# keep the wait well below the worker timeout
+VCFAPI_CHANGES_RETENTION = 7 * 24 * 3600
+VCFAPI_CHANGES_MAX_WAIT = 10.0
+
+# Keep the managed file BGZF compressed with a tabix index, so regions can be read from it
+# (see the read_region command). Every sync then rewrites the whole file in one pass.
+VCFAPI_BGZF_OUTPUT = False
+
+# Split the managed file in segments (at the chromosome changes and every VCFAPI_SEGMENT_LINES
+# lines) listed in a manifest. A sync then only rewrites the segments with changes, in parallel
+# on the celery workers. The single file is produced on demand by the export_vcf command
+VCFAPI_SEGMENTED_FILES = False
+VCFAPI_SEGMENT_LINES = 1000000
+
+# A rewrite of the whole file (from VCFAPI_PARALLEL_SYNC_SIZE bytes on) is split in VCFAPI_SYNC_PARTS
+# line ranges written in parallel by celery subtasks, then joined. Match it to the worker concurrency
+VCFAPI_SYNC_PARTS = 4
+VCFAPI_PARALLEL_SYNC_SIZE = 256 * 1024 * 1024
+
+# periodic tasks run by celery beat
+CELERY_BEAT_SCHEDULE = {
+    'reconcile-row-counts': {
+        'task': 'vcfApi.tasks.reconcile_row_counts',
+        'schedule': 3600.0,
+    },
+}
+
+# The vcfapi cache holds the API responses and the data version they are keyed on. It has to be
+# shared by every process that writes rows (the server processes, the celery workers and the
+# update_db command run with proc_settings), else a write only invalidates the responses cached
+# by its own process. The redis server the celery broker runs on holds it, in its own database
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'vcfapi': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': 'redis://localhost:6379/1',
+        'TIMEOUT': 3600,
+    },
+}
+
 ROOT_URLCONF = 'saph_assignment.urls'
 
 TEMPLATES = [
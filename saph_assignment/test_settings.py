@@ -74,6 +74,16 @@ CELERY_RESULT_BACKEND = 'redis://localhost:6379/0'
 # set the celery timezone
 CELERY_TIMEZONE = 'UTC'
 
+# Responses are not cached in the tests unless a test enables it
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'vcfapi': {
+        'BACKEND': 'django.core.cache.backends.dummy.DummyCache',
+    },
+}
+
 ROOT_URLCONF = 'saph_assignment.urls'
 
 TEMPLATES = [
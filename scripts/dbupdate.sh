@@ -5,6 +5,7 @@ python3 manage.py migrate
 
 copy_set_source() {
   filetocheck="$1"
+  shift
   if [ -f "$filetocheck" ] ; then
 	echo "$filetocheck exists. Copying to the files folder and setting as source for the insert script..."
 	basename=$(basename "$filetocheck")
@@ -12,7 +13,7 @@ copy_set_source() {
 	export VCF_FILE_SOURCE=files/"$basename"
 	export VCF_FILE_NAME="$basename"
 	echo "Inserting file to Db. Please wait..."
-	python3 manage.py update_db --settings=saph_assignment.proc_settings
+	python3 manage.py update_db --settings=saph_assignment.proc_settings "$@"
 	echo File Insertion Process Completed. Please run the application via "supervisord -c vcfapi.conf" to confirm data installation.
   else
         echo "file $filetocheck could not be found! Did you enter the full correct path?"
@@ -21,6 +22,6 @@ copy_set_source() {
 
 case $1 in 
      -f)
-       copy_set_source $2   
+       copy_set_source "$2" "${@:3}"
      ;;
 esac
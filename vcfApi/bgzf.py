@@ -0,0 +1,461 @@
+"""
+This module contains the BGZF (blocked gzip) writer and reader and the tabix index of
+a BGZF compressed VCF file. BGZF files are plain multi member gzip files, so any gzip
+reader can stream them, but they are made of independent blocks of at most 64KB, so a
+line can be read from a virtual offset (the offset of its block in the file << 16 | its
+offset in the block) without decompressing what comes before it. The tabix index maps
+genomic regions to the virtual offsets of the lines in them.
+Like vcfio it deliberately has no Django dependencies.
+"""
+import gzip
+import zlib
+import struct
+from vcfApi.vcfio import FIELD_DEL
+from vcfApi.vcfio import HEADER_PREFIX
+
+TABIX_SUFFIX = '.tbi'
+# The uncompressed bytes per block, so a block stays under 64KB even if it doesn't compress
+BLOCK_SIZE = 0xff00
+COMPRESS_LEVEL = 6
+# id1, id2, compression method, flags, mtime, extra flags, os, extra length
+GZIP_HEADER = struct.Struct('<4BI2BH')
+# subfield id1, id2, subfield length, total block size - 1
+BGZF_SUBFIELD = struct.Struct('<2BHH')
+GZIP_TRAILER = struct.Struct('<II')
+GZIP_ID = (0x1f, 0x8b)
+DEFLATE_METHOD = 8
+EXTRA_FLAG = 4
+BGZF_SUBFIELD_ID = (ord('B'), ord('C'))
+UNKNOWN_OS = 0xff
+# The empty block that marks the end of a BGZF file
+EOF_BLOCK = bytes.fromhex('1f8b08040000000000ff0600424302001b0003000000000000000000')
+TABIX_MAGIC = b'TBI\x01'
+# format (VCF), sequence column, begin column, end column (none), meta char, skipped lines
+TABIX_HEADER = struct.Struct('<4s8i')
+TABIX_VCF_FORMAT = 2
+TABIX_COLUMNS = (1, 2, 0)
+# The linear index has one entry per 16KB window of the positions
+LINEAR_SHIFT = 14
+# (shift, first bin) of the binning levels, from the largest bins to the smallest
+BIN_LEVELS = ((26, 1), (23, 9), (20, 73), (17, 585), (14, 4681))
+
+def virtual_offset(block_offset, within):
+    """
+    Build a virtual offset
+
+    Args:
+        block_offset(int): The file offset of a block
+        within(int): The offset in the uncompressed block
+
+    Returns:
+        offset(int): The virtual offset
+    """
+    return block_offset << 16 | within
+
+def is_bgzf(vcf_path):
+    """
+    Check the first block header of a file to see if it is BGZF compressed
+
+    Args:
+        vcf_path(str): The full path of the file
+
+    Returns:
+        bgzf(bool): True if the file is BGZF compressed
+    """
+    with open(vcf_path, 'rb') as probe:
+        return read_block_size(probe) is not None
+
+def read_block_size(stream):
+    """
+    Read the header of a BGZF block
+
+    Args:
+        stream(file): A binary file object positioned at the start of a block
+
+    Returns:
+        size(int): The total size of the block or None if it is not a BGZF block
+    """
+    header = stream.read(GZIP_HEADER.size)
+    if len(header) < GZIP_HEADER.size:
+        return None
+    id1, id2, method, flags, _, _, _, extra_size = GZIP_HEADER.unpack(header)
+    if (id1, id2) != GZIP_ID or method != DEFLATE_METHOD or not flags & EXTRA_FLAG:
+        return None
+    extra = stream.read(extra_size)
+    position = 0
+    while position + BGZF_SUBFIELD.size <= len(extra):
+        id1, id2, length, size = BGZF_SUBFIELD.unpack_from(extra, position)
+        if (id1, id2) == BGZF_SUBFIELD_ID:
+            return size + 1
+        position += 4 + length
+    return None
+
+class BgzfWriter:
+    """
+    Writes a BGZF file. The data is compressed in blocks of BLOCK_SIZE bytes and tell()
+    gives the virtual offset the next byte is written at.
+    """
+
+    def __init__(self, stream, level=COMPRESS_LEVEL):
+        self.stream = stream
+        self.level = level
+        self.buffer = bytearray()
+        self.block_offset = stream.tell()
+
+    def tell(self):
+        """
+        The virtual offset of the next written byte
+        """
+        return virtual_offset(self.block_offset, len(self.buffer))
+
+    def write(self, data):
+        """
+        Write data, compressing every full block
+
+        Args:
+            data(bytes): The data
+        """
+        self.buffer.extend(data)
+        while len(self.buffer) >= BLOCK_SIZE:
+            self.write_block(BLOCK_SIZE)
+
+    def write_block(self, size):
+        """
+        Compress the first bytes of the buffer as a block
+
+        Args:
+            size(int): The number of bytes
+        """
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, -zlib.MAX_WBITS)
+        compressed = compressor.compress(data) + compressor.flush()
+        size = GZIP_HEADER.size + BGZF_SUBFIELD.size + len(compressed) + GZIP_TRAILER.size
+        self.stream.write(GZIP_HEADER.pack(*GZIP_ID, DEFLATE_METHOD, EXTRA_FLAG, 0, 0,
+            UNKNOWN_OS, BGZF_SUBFIELD.size))
+        self.stream.write(BGZF_SUBFIELD.pack(*BGZF_SUBFIELD_ID, 2, size - 1))
+        self.stream.write(compressed)
+        self.stream.write(GZIP_TRAILER.pack(zlib.crc32(data), len(data)))
+        self.block_offset += size
+
+    def close(self):
+        """
+        Compress the rest of the buffer and write the end of file marker.
+        The underlying stream is left open.
+        """
+        if self.buffer:
+            self.write_block(len(self.buffer))
+        self.stream.write(EOF_BLOCK)
+        self.block_offset += len(EOF_BLOCK)
+
+class BgzfReader:
+    """
+    Reads the lines of a BGZF file from virtual offsets, decompressing one block at a time
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.block_offset = 0
+        self.next_offset = 0
+        self.data = b''
+        self.within = 0
+
+    def load_block(self, block_offset):
+        """
+        Decompress the block at a file offset
+
+        Args:
+            block_offset(int): The file offset of the block
+
+        Returns:
+            loaded(bool): False at the end of the file
+        """
+        self.stream.seek(block_offset)
+        size = read_block_size(self.stream)
+        if size is None:
+            return False
+        self.stream.seek(block_offset)
+        block = self.stream.read(size)
+        header_size = GZIP_HEADER.size + GZIP_HEADER.unpack_from(block)[-1]
+        self.data = zlib.decompress(block[header_size:size - GZIP_TRAILER.size], -zlib.MAX_WBITS)
+        self.block_offset = block_offset
+        self.next_offset = block_offset + size
+        self.within = 0
+        return True
+
+    def seek(self, offset):
+        """
+        Move to a virtual offset
+
+        Args:
+            offset(int): The virtual offset
+        """
+        self.load_block(offset >> 16)
+        self.within = offset & 0xffff
+
+    def tell(self):
+        """
+        The virtual offset of the next read byte. The end of a block is the start of the next.
+        """
+        if self.within >= len(self.data):
+            return virtual_offset(self.next_offset, 0)
+        return virtual_offset(self.block_offset, self.within)
+
+    def readline(self):
+        """
+        Read a line, which may span blocks
+
+        Returns:
+            line(bytes): The line with its line end, empty at the end of the file
+        """
+        parts = []
+        while True:
+            if self.within >= len(self.data):
+                if not self.load_block(self.next_offset):
+                    break
+                if not self.data:
+                    # The empty end of file block
+                    continue
+            end = self.data.find(b'\n', self.within)
+            if end >= 0:
+                parts.append(self.data[self.within:end + 1])
+                self.within = end + 1
+                break
+            parts.append(self.data[self.within:])
+            self.within = len(self.data)
+        return b''.join(parts)
+
+def reg2bin(beg, end):
+    """
+    Get the smallest bin that contains a region
+
+    Args:
+        beg(int): The 0-based start of the region
+        end(int): The 0-based end of the region, exclusive
+
+    Returns:
+        bin(int): The bin number
+    """
+    end -= 1
+    for shift, first_bin in reversed(BIN_LEVELS):
+        if beg >> shift == end >> shift:
+            return first_bin + (beg >> shift)
+    return 0
+
+def reg2bins(beg, end):
+    """
+    Get the bins that may hold records overlapping a region
+
+    Args:
+        beg(int): The 0-based start of the region
+        end(int): The 0-based end of the region, exclusive
+
+    Returns:
+        bins(list): The bin numbers
+    """
+    end -= 1
+    bins = [0]
+    for shift, first_bin in BIN_LEVELS:
+        bins.extend(range(first_bin + (beg >> shift), first_bin + (end >> shift) + 1))
+    return bins
+
+def record_span(line):
+    """
+    Get the sequence and the 0-based half open span of a VCF body line
+
+    Args:
+        line(bytes): The line
+
+    Returns:
+        (chrom, beg, end): The sequence name and the span, None if the line is not valid
+    """
+    fields = line.split(FIELD_DEL, 4)
+    if len(fields) < 4:
+        return None
+    try:
+        beg = int(fields[1]) - 1
+    except ValueError:
+        return None
+    return fields[0], beg, beg + max(len(fields[3]), 1)
+
+class TabixIndex:
+    """
+    The tabix index of a BGZF compressed VCF file. Records are added as they are written,
+    in any order: the bins list chunks of virtual offsets and the linear index keeps, for
+    every window, the smallest offset of a record overlapping it or any later window,
+    so the index stays valid when the rows are not sorted by position.
+    """
+
+    def __init__(self):
+        self.names = []
+        # Per sequence: {bin: [[chunk start, chunk end], ...]} and {window: min offset}
+        self.bins = {}
+        self.windows = {}
+        self.linear = {}
+
+    def add(self, chrom, beg, end, start, stop):
+        """
+        Add a record
+
+        Args:
+            chrom(bytes): The sequence name
+            beg(int): The 0-based start of the record
+            end(int): The 0-based end of the record, exclusive
+            start(int): The virtual offset of the line
+            stop(int): The virtual offset after the line
+        """
+        if chrom not in self.bins:
+            self.names.append(chrom)
+            self.bins[chrom] = {}
+            self.windows[chrom] = {}
+        chunks = self.bins[chrom].setdefault(reg2bin(beg, end), [])
+        if chunks and chunks[-1][1] == start:
+            chunks[-1][1] = stop
+        else:
+            chunks.append([start, stop])
+        windows = self.windows[chrom]
+        for window in range(beg >> LINEAR_SHIFT, ((end - 1) >> LINEAR_SHIFT) + 1):
+            if windows.get(window, start + 1) > start:
+                windows[window] = start
+
+    def get_linear(self, chrom):
+        """
+        Get the linear index of a sequence: the smallest offset of a record in every
+        window or after it
+
+        Args:
+            chrom(bytes): The sequence name
+
+        Returns:
+            linear(list): The offsets by window
+        """
+        windows = self.windows[chrom]
+        if chrom not in self.linear:
+            linear = [0] * (max(windows) + 1 if windows else 0)
+            smallest = None
+            for window in range(len(linear) - 1, -1, -1):
+                if window in windows and (smallest is None or windows[window] < smallest):
+                    smallest = windows[window]
+                linear[window] = smallest
+            self.linear[chrom] = linear
+        return self.linear[chrom]
+
+    def save(self, index_path):
+        """
+        Write the index in the tabix format, BGZF compressed
+
+        Args:
+            index_path(str): The path of the index file
+        """
+        names = b''.join(name + b'\0' for name in self.names)
+        parts = [TABIX_HEADER.pack(TABIX_MAGIC, len(self.names), TABIX_VCF_FORMAT,
+            *TABIX_COLUMNS, ord(HEADER_PREFIX), 0, len(names)), names]
+        for name in self.names:
+            bins = self.bins[name]
+            parts.append(struct.pack('<i', len(bins)))
+            for bin_number, chunks in sorted(bins.items()):
+                parts.append(struct.pack('<Ii', bin_number, len(chunks)))
+                parts.extend(struct.pack('<QQ', *chunk) for chunk in chunks)
+            linear = self.get_linear(name)
+            parts.append(struct.pack(f'<i{len(linear)}Q', len(linear), *linear))
+        with open(index_path, 'wb') as stream:
+            writer = BgzfWriter(stream)
+            writer.write(b''.join(parts))
+            writer.close()
+
+    @classmethod
+    def load(cls, index_path):
+        """
+        Read a tabix index
+
+        Args:
+            index_path(str): The path of the index file
+
+        Returns:
+            index(TabixIndex): The index
+
+        Raises:
+            ValueError: If the file is not a tabix index
+        """
+        with gzip.open(index_path, 'rb') as stream:
+            data = stream.read()
+        magic, count, _, _, _, _, _, _, names_size = TABIX_HEADER.unpack_from(data)
+        if magic != TABIX_MAGIC:
+            raise ValueError(f"{index_path} is not a tabix index!")
+        position = TABIX_HEADER.size
+        index = cls()
+        index.names = data[position:position + names_size].split(b'\0')[:count]
+        position += names_size
+        for name in index.names:
+            bins = index.bins[name] = {}
+            (bin_count,) = struct.unpack_from('<i', data, position)
+            position += 4
+            for _ in range(bin_count):
+                bin_number, chunk_count = struct.unpack_from('<Ii', data, position)
+                position += 8
+                chunks = struct.unpack_from(f'<{chunk_count * 2}Q', data, position)
+                position += chunk_count * 16
+                bins[bin_number] = [list(chunks[i:i + 2]) for i in range(0, len(chunks), 2)]
+            (window_count,) = struct.unpack_from('<i', data, position)
+            position += 4
+            index.linear[name] = list(struct.unpack_from(f'<{window_count}Q', data, position))
+            position += window_count * 8
+            index.windows[name] = {}
+        return index
+
+    def get_chunks(self, chrom, beg, end):
+        """
+        Get the sorted, merged virtual offset ranges that hold the records of a region
+
+        Args:
+            chrom(bytes): The sequence name
+            beg(int): The 0-based start of the region
+            end(int): The 0-based end of the region, exclusive
+
+        Returns:
+            chunks(list): [start, end] virtual offset ranges
+        """
+        if chrom not in self.bins:
+            return []
+        linear = self.get_linear(chrom)
+        if beg >> LINEAR_SHIFT >= len(linear):
+            return []
+        smallest = linear[beg >> LINEAR_SHIFT]
+        bins = self.bins[chrom]
+        chunks = sorted(chunk for bin_number in reg2bins(beg, end)
+            for chunk in bins.get(bin_number, ()) if chunk[1] > smallest)
+        merged = []
+        for start, stop in chunks:
+            if merged and start <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], stop)
+            else:
+                merged.append([start, stop])
+        return merged
+
+def read_region(vcf_path, chrom, start, end):
+    """
+    Read the lines of a region from a BGZF compressed VCF file through its tabix index,
+    only decompressing the blocks that hold them
+
+    Args:
+        vcf_path(str): The full path of the file
+        chrom(str): The chromosome
+        start(int): The 1-based start of the region
+        end(int): The 1-based end of the region, inclusive
+
+    Returns:
+        lines(iterator): The raw lines of the records overlapping the region, in file order
+    """
+    index = TabixIndex.load(vcf_path + TABIX_SUFFIX)
+    name = chrom.encode()
+    with open(vcf_path, 'rb') as stream:
+        reader = BgzfReader(stream)
+        for chunk_start, chunk_end in index.get_chunks(name, start - 1, end):
+            reader.seek(chunk_start)
+            while reader.tell() < chunk_end:
+                line = reader.readline()
+                if not line:
+                    break
+                span = record_span(line)
+                if span and span[0] == name and span[1] < end and span[2] > start - 1:
+                    yield line
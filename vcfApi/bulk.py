@@ -0,0 +1,115 @@
+"""
+This module contains set based write operations on VcfRows.
+Each operation runs as a fixed number of statements whatever the number of rows,
+appends the row events to the change journal in bulk and requests a single file
+update per file.
+No model signals are fired, so everything the signals would do is done here.
+"""
+from django.db import connection
+from django.db import transaction
+from django.db.models import F
+from django.db.models import Value
+from django.db.models import Count
+from django.db.models import DateTimeField
+from django.utils import timezone
+from vcfApi.models import VcfRow
+from vcfApi.models import RowEvent
+from vcfApi.models import RowCount
+from vcfApi.dispatch import notify_rows_changed
+
+def get_vcf_counts(queryset):
+    """
+    Get the number of rows of a queryset per file with a single grouped query
+
+    Args:
+        queryset(QuerySet): The VcfRows
+
+    Returns:
+        counts(dict): The row counts by file id
+    """
+    return dict(queryset.order_by().values('vcf_id').annotate(total=Count('row_id'))
+        .values_list('vcf_id', 'total'))
+
+def notify_files_changed(vcf_counts):
+    """
+    Request one file update per file, in the current transaction
+
+    Args:
+        vcf_counts(dict): The number of changed rows by file id
+    """
+    for vcf_id, changes in vcf_counts.items():
+        notify_rows_changed(vcf_id, changes)
+
+def record_row_events(queryset, kind, values=None):
+    """
+    Append an event per row of a queryset to the change journal with a single
+    INSERT ... SELECT statement
+
+    Args:
+        queryset(QuerySet): The changed VcfRows, selected before the change
+        kind(int): RowEvent.UPDATED or RowEvent.DELETED
+        values(dict): The new field values of updated rows, None for deletions
+    """
+    quote = connection.ops.quote_name
+    columns = ['vcf_id', 'row_id', 'sort_key', 'kind', 'date_created']
+    selected = [F('vcf_id'), F('row_id'), F('sort_key'), Value(kind),
+        Value(timezone.now(), output_field=DateTimeField())]
+    if values is not None:
+        columns.extend(RowEvent.VALUE_FIELDS)
+        selected.extend(Value(values[field]) if field in values else F(field)
+            for field in RowEvent.VALUE_FIELDS)
+    select_sql, params = queryset.order_by().values_list(*selected).query.sql_with_params()
+    with connection.cursor() as cursor:
+        cursor.execute(f"INSERT INTO {quote(RowEvent._meta.db_table)} "
+            f"({', '.join(quote(column) for column in columns)}) {select_sql}", params)
+
+def bulk_update_rows(queryset, values):
+    """
+    Update the rows of a queryset with a single UPDATE statement, after recording
+    their update events with the new values
+
+    Args:
+        queryset(QuerySet): The VcfRows to update
+        values(dict): The validated field values
+
+    Returns:
+        count(int): The number of updated rows
+    """
+    with transaction.atomic():
+        vcf_counts = get_vcf_counts(queryset)
+        # The rows may no longer match the filters after the update, record them first
+        record_row_events(queryset, RowEvent.UPDATED, values)
+        count = queryset.update(**values)
+        for vcf_id in vcf_counts:
+            RowCount.invalidate(vcf_id)
+        notify_files_changed(vcf_counts)
+    return count
+
+def bulk_delete_rows(queryset):
+    """
+    Delete the rows of a queryset with a single DELETE statement, after recording
+    their deletion events
+
+    Args:
+        queryset(QuerySet): The VcfRows to delete
+
+    Returns:
+        count(int): The number of deleted rows
+    """
+    quote = connection.ops.quote_name
+    rows_table = quote(VcfRow._meta.db_table)
+    with transaction.atomic():
+        vcf_counts = get_vcf_counts(queryset)
+        record_row_events(queryset, RowEvent.DELETED)
+        pk_sql, pk_params = queryset.order_by().values('row_id').query.sql_with_params()
+        with connection.cursor() as cursor:
+            # A queryset delete() would load and signal every row, delete them in one go
+            cursor.execute(f"DELETE FROM {rows_table} WHERE {quote('row_id')} IN ({pk_sql})",
+                pk_params)
+            count = cursor.rowcount
+        for vcf_id, deleted in vcf_counts.items():
+            RowCount.invalidate(vcf_id)
+            RowCount.objects.filter(vcf_id=vcf_id, filter_key='').update(
+                count=F('count') - deleted)
+        notify_files_changed(vcf_counts)
+    return count
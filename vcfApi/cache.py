@@ -0,0 +1,134 @@
+"""
+This module contains the response cache of the read endpoints.
+Cached responses are keyed on the normalized request and the current data version,
+which is bumped on every row change and import, so a write invalidates every cached
+response at once without having to track which pages it affected. The version is
+global since the list and detail responses span the rows of every file. The cache backend
+has to be shared by every process that writes rows (see the CACHES setting), the version
+bump of a worker or an import only reaches the processes reading the same backend.
+Threads waiting for the data to change are woken by the bumps of their own process and
+see the bumps of the other processes on their next read of the shared version.
+"""
+import time
+import hashlib
+import functools
+import threading
+from django.core.cache import caches
+from django.core.cache import InvalidCacheBackendError
+from rest_framework.response import Response
+
+CACHE_ALIAS = 'vcfapi'
+VERSION_KEY = 'vcfapi:version'
+RESPONSE_KEY = 'vcfapi:response:{version}:{digest}'
+CACHED_STATUSES = (200, 404)
+# How often a thread waiting for a change reads the version the other processes bump
+VERSION_CHECK_INTERVAL = 1.0
+# Signalled on every bump of this process, counted so a bump between two waits is not missed
+version_bumped = threading.Condition()
+local_bumps = 0
+
+def get_cache():
+    """
+    Get the cache backend of the responses, the default one if no vcfapi cache is configured
+    """
+    try:
+        return caches[CACHE_ALIAS]
+    except InvalidCacheBackendError:
+        return caches['default']
+
+def new_version():
+    """
+    Get a starting version value. It is time based so that a version key that expired or
+    was evicted never restarts from a value older cached responses are stored under.
+    """
+    return time.time_ns()
+
+def get_data_version():
+    """
+    Get the current data version. Responses cached under older versions are never read again.
+
+    Returns:
+        version(int): The data version
+    """
+    cache = get_cache()
+    version = cache.get(VERSION_KEY)
+    if version is None:
+        cache.add(VERSION_KEY, new_version(), timeout=None)
+        version = cache.get(VERSION_KEY)
+    return version
+
+def bump_data_version():
+    """
+    Increase the data version, invalidating the cached responses
+    """
+    global local_bumps
+    cache = get_cache()
+    try:
+        cache.incr(VERSION_KEY)
+    except ValueError:
+        cache.set(VERSION_KEY, new_version(), timeout=None)
+    with version_bumped:
+        local_bumps += 1
+        version_bumped.notify_all()
+
+def wait_for_data_change(version, timeout):
+    """
+    Wait until the data changes after a version was read: this process bumps it or another
+    one did, as seen every VERSION_CHECK_INTERVAL seconds. The thread sleeps in between.
+
+    Args:
+        version(int): The data version read before the data
+        timeout(float): The seconds to wait at most
+
+    Returns:
+        changed(bool): True if the data may have changed, False if the timeout was reached
+    """
+    deadline = time.monotonic() + timeout
+    with version_bumped:
+        bumps = local_bumps
+    while get_data_version() == version:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return False
+        with version_bumped:
+            if local_bumps == bumps:
+                version_bumped.wait(min(VERSION_CHECK_INTERVAL, remaining))
+            if local_bumps != bumps:
+                return True
+    return True
+
+def response_cache_key(request):
+    """
+    Build the cache key of a request from its path, its sorted query parameters
+    and the current data version
+
+    Args:
+        request(Request): The DRF request
+
+    Returns:
+        key(str): The cache key
+    """
+    params = sorted((name, value) for name, values in request.query_params.lists()
+        for value in values)
+    normalized = repr((request.build_absolute_uri(request.path), params))
+    digest = hashlib.sha256(normalized.encode()).hexdigest()
+    return RESPONSE_KEY.format(version=get_data_version(), digest=digest)
+
+def cached_response(view_method):
+    """
+    Decorator caching the data of the successful (and not found) responses of a view method.
+    A cache hit skips the db queries and the serializer, only the rendering is left.
+    """
+    @functools.wraps(view_method)
+    def wrapper(self, request, *args, **kwargs):
+        cache = get_cache()
+        key = response_cache_key(request)
+        entry = cache.get(key)
+        if entry is not None:
+            data, status = entry
+            return Response(data, status=status)
+        response = view_method(self, request, *args, **kwargs)
+        if response.status_code in CACHED_STATUSES:
+            cache.set(key, (response.data, response.status_code))
+        return response
+    return wrapper
@@ -0,0 +1,106 @@
+"""
+This module contains the change feed that replicas mirror the rows with. The versions
+are the sequences of the change journal (see vcfApi.models.RowEvent): a client copies the
+rows once, then keeps asking for the changes after the last version it has seen.
+The journal keeps the last event of every row, so a replica gets the net changes
+whatever version it resumes from, as long as it is not older than the pruned deletions.
+A long polling request holds its server thread while it waits, it does not query the
+journal again until a row change bumps the data version (see vcfApi.cache).
+"""
+import time
+import datetime
+from django.conf import settings
+from django.db.models import Max
+from vcfApi.models import Vcf
+from vcfApi.models import RowEvent
+from vcfApi.cache import get_data_version
+from vcfApi.cache import wait_for_data_change
+CHANGES_PAGE_SIZE = 1000
+MAX_CHANGES_PAGE_SIZE = 10000
+# Well below the usual 30 seconds worker timeout of the application servers
+DEFAULT_CHANGES_MAX_WAIT = 10.0
+CHANGE_NAMES = dict(RowEvent.KINDS)
+
+def get_latest_version():
+    """
+    Get the version of the last change
+
+    Returns:
+        version(int): The sequence of the last row event, 0 if there is none
+    """
+    return RowEvent.objects.aggregate(last=Max('seq'))['last'] or 0
+
+def get_oldest_version():
+    """
+    Get the oldest version the feed can resume from, deletions before it were pruned
+
+    Returns:
+        version(int): The version
+    """
+    return Vcf.objects.aggregate(pruned=Max('pruned_seq'))['pruned'] or 0
+
+def get_max_wait():
+    """
+    Get the longest a long polling request may wait for changes from the settings
+
+    Returns:
+        max_wait(timedelta): The duration
+    """
+    return datetime.timedelta(seconds=getattr(settings, 'VCFAPI_CHANGES_MAX_WAIT',
+        DEFAULT_CHANGES_MAX_WAIT))
+
+def format_change(event):
+    """
+    Build the feed entry of a row event
+
+    Args:
+        event(RowEvent): The event
+
+    Returns:
+        change(dict): The entry, the row values are None for a deletion
+    """
+    row = None
+    if event.kind != RowEvent.DELETED:
+        row = {field: getattr(event, field) for field in RowEvent.VALUE_FIELDS}
+    return {'version': event.seq, 'change': CHANGE_NAMES[event.kind], 'row_id': event.row_id,
+        'sort_key': event.sort_key, 'row': row}
+
+def get_changes(since, limit=CHANGES_PAGE_SIZE):
+    """
+    Get a page of the changes after a version, in version order
+
+    Args:
+        since(int): The last version the client has seen
+        limit(int): The max number of changes
+
+    Returns:
+        (changes, more): The feed entries and whether more changes follow them
+    """
+    events = list(RowEvent.objects.filter(seq__gt=since).order_by('seq')[:limit + 1])
+    return [format_change(event) for event in events[:limit]], len(events) > limit
+
+def wait_for_changes(since, limit=CHANGES_PAGE_SIZE, wait=0):
+    """
+    Get a page of the changes after a version, waiting up to a number of seconds for
+    some to come in if there are none yet (long polling). The journal is read again
+    only when the data version changed.
+
+    Args:
+        since(int): The last version the client has seen
+        limit(int): The max number of changes
+        wait(float): The seconds to wait for changes
+
+    Returns:
+        (changes, more): The feed entries and whether more changes follow them
+    """
+    deadline = time.monotonic() + min(wait, get_max_wait().total_seconds())
+    # Read before the journal, so a change committed in between is not waited for
+    version = get_data_version()
+    changes, more = get_changes(since, limit)
+    while not changes:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0 or not wait_for_data_change(version, remaining):
+            break
+        version = get_data_version()
+        changes, more = get_changes(since, limit)
+    return changes, more
@@ -0,0 +1,33 @@
+"""
+This module contains the helpers that record a VCF file as modified. They are used by the
+signals for single row changes and by the views for bulk, set based changes that do not
+fire any signals. The changes are written to the outbox in the caller's transaction,
+the outbox relay (see vcfApi.outbox) starts the Celery task that transfers them to
+the physical file.
+"""
+from django.db import transaction
+from vcfApi.models import OutboxEvent
+from vcfApi.cache import bump_data_version
+
+def request_file_update(vcf_id, changes=1):
+    """
+    Record changes waiting for a file update as an outbox event.
+    This is a single INSERT, no broker call or row lock is involved.
+
+    Args:
+        vcf_id(int): The VCF file entities int PK on our DB.
+        changes(int): The number of changed rows
+    """
+    OutboxEvent.objects.create(vcf_id=vcf_id, changes=changes)
+
+def notify_rows_changed(vcf_id, changes=1):
+    """
+    Request a file update after rows of a file changed and invalidate the cached
+    responses once the change is committed
+
+    Args:
+        vcf_id(int): The VCF file entities int PK on our DB.
+        changes(int): The number of changed rows
+    """
+    request_file_update(vcf_id, changes)
+    transaction.on_commit(bump_data_version)
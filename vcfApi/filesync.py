@@ -0,0 +1,1308 @@
+"""
+This module contains the engine that transfers row changes to a VCF file.
+A persistent index of the file body maps every line to its byte offset and to the
+sort key of its row, so a sync can place changes by sort key and rewrite only the
+tail of the file that starts at the first changed line, instead of the whole file.
+When every change comes after the last line, the new lines are simply appended.
+A large rewrite can also be written in parts in parallel, then joined (see plan_parts).
+The file can also be kept BGZF compressed with a tabix index, see vcfApi.bgzf.
+Rows keep their sort keys for good, the physical line numbers only exist in the index.
+The index is the only link between the lines and the rows, a lost or stale one is rebuilt
+from the sort keys the caller gets from the rows, see restore_line_keys.
+Unchanged lines are always copied as raw bytes, only the changed lines are formatted.
+Like vcfio it deliberately has no Django dependencies.
+"""
+import os
+import zlib
+import heapq
+import struct
+import shutil
+import itertools
+from array import array
+from bisect import bisect_left
+from operator import itemgetter
+from vcfApi.vcfio import READ_BUFFER_SIZE
+from vcfApi.vcfio import FIELD_DEL
+from vcfApi.vcfio import EMPTY_VALUE
+from vcfApi.vcfio import HEADER_PREFIX
+from vcfApi.vcfio import COLUMNS_HEADER_PREFIX
+from vcfApi.vcfio import find_body_offset
+from vcfApi.vcfio import is_row_line
+from vcfApi.vcfio import is_gzipped
+from vcfApi.vcfio import open_vcf_stream
+from vcfApi.bgzf import TABIX_SUFFIX
+from vcfApi.bgzf import BgzfWriter
+from vcfApi.bgzf import TabixIndex
+from vcfApi.bgzf import record_span
+
+INDEX_SUFFIX = '.lidx'
+JOURNAL_SUFFIX = '.journal'
+APPEND_SUFFIX = '.append'
+KEYS_SUFFIX = '.keys'
+REWRITE_SUFFIX = '.rewrite'
+PART_SUFFIX = '.part{:04d}'
+VCF_EXTENSION = '.vcf'
+COMPRESSED_EXTENSIONS = ('.gz', '.bgz')
+INDEX_MAGIC = b'VCFLIDX2'
+JOURNAL_MAGIC = b'VCFJRNL2'
+APPEND_MAGIC = b'VCFAPND1'
+KEYS_MAGIC = b'VCFKEYS1'
+PART_MAGIC = b'VCFPART1'
+# magic, file size, body offset, line count, crc32 of the end of the file,
+# followed by an (offset, sort key) entry per line
+INDEX_HEADER = struct.Struct('<8sQQQI')
+# magic, the offset the journal content replaces the file from, the content size and
+# the position of its first line, followed by the content and the sort keys of its lines
+JOURNAL_HEADER = struct.Struct('<8sQQQ')
+# magic, the end offset of the file before an append
+APPEND_MARKER = struct.Struct('<8sQ')
+# magic, the size of the compressed file, the line count, followed by the sort key per line
+KEYS_HEADER = struct.Struct('<8sQQ')
+# magic, the line count of a rewrite part, followed by the offsets and the sort keys
+PART_HEADER = struct.Struct('<8sQ')
+OFFSET_TYPECODE = 'Q'
+KEY_TYPECODE = 'q'
+ENTRY_SIZE = array(OFFSET_TYPECODE).itemsize + array(KEY_TYPECODE).itemsize
+# The sort keys of imported lines are spaced out so rows fit in between them
+SORT_KEY_GAP = 1 << 32
+CHECKSUM_SIZE = 64 * 1024
+COPY_BUFFER_SIZE = 8 * 1024 * 1024
+# A patched tail is written twice, to the journal and to the file
+TAIL_WRITES = 2
+VERIFY_SAMPLES = 64
+LINE_END = b'\n'
+# The fixed columns of a VCF line after CHROM POS ID REF ALT: QUAL FILTER INFO
+FIXED_COLUMNS = 8
+MISSING_FORMAT = b'GT'
+MISSING_CALL = b'./.'
+
+class StaleIndexError(ValueError):
+    """
+    Raised when the sort keys of the lines of a file are not known: its index (or the key
+    file of a compressed file) is missing or stale and there are no keys to rebuild it from,
+    or they don't match the lines
+    """
+
+def tail_checksum(vcf_path, size):
+    """
+    Compute the crc32 of the last bytes of a file. Any change that a sync makes ends
+    at the end of the file, so this detects a file that changed behind the index.
+
+    Args:
+        vcf_path(str): The full path of the file
+        size(int): The size of the file
+
+    Returns:
+        checksum(int): The crc32 value
+    """
+    with open(vcf_path, 'rb') as stream:
+        stream.seek(max(size - CHECKSUM_SIZE, 0))
+        return zlib.crc32(stream.read(CHECKSUM_SIZE))
+
+def read_column_count(vcf_path, body_offset):
+    """
+    Get the number of columns of a VCF file from its #CHROM header line
+
+    Args:
+        vcf_path(str): The full path of an uncompressed file
+        body_offset(int): The byte offset right after the header
+
+    Returns:
+        count(int): The number of columns
+    """
+    with open(vcf_path, 'rb') as stream:
+        for line in stream.read(body_offset).splitlines():
+            if line.startswith(COLUMNS_HEADER_PREFIX):
+                return len(line.split(FIELD_DEL))
+    return FIXED_COLUMNS
+
+def format_row_line(row, line=None, columns=FIXED_COLUMNS):
+    """
+    Format the VCF body line of a row. The columns after ALT are kept from the
+    original line, a new line gets missing values for them.
+
+    Args:
+        row(tuple): The (chrom, pos, id, ref, alt) values
+        line(bytes): The original line, None for a new one
+        columns(int): The number of columns of the file
+
+    Returns:
+        line(bytes): The formatted line
+    """
+    chrom, pos, vid, ref, alt = row
+    fields = [str(chrom).encode(), str(pos).encode(), vid.encode() if vid else EMPTY_VALUE,
+        str(ref).encode(), alt.encode() if alt else EMPTY_VALUE]
+    if line is not None:
+        fields.extend(line.rstrip(b'\r\n').split(FIELD_DEL, 5)[5:])
+    else:
+        fields.extend([EMPTY_VALUE] * (min(columns, FIXED_COLUMNS) - len(fields)))
+        if columns > FIXED_COLUMNS:
+            fields.append(MISSING_FORMAT)
+            fields.extend([MISSING_CALL] * (columns - FIXED_COLUMNS - 1))
+    return FIELD_DEL.join(fields) + LINE_END
+
+class LineIndex:
+    """
+    The byte offsets and the row sort keys of the body lines of an uncompressed VCF file,
+    stored next to it. Line ids are 1-based physical line numbers, the sort keys
+    increase with them.
+    """
+
+    def __init__(self, vcf_path, body_offset, offsets, keys):
+        self.vcf_path = vcf_path
+        self.body_offset = body_offset
+        self.offsets = offsets
+        self.keys = keys
+
+    @property
+    def path(self):
+        """
+        The path of the index file
+        """
+        return self.vcf_path + INDEX_SUFFIX
+
+    @property
+    def line_count(self):
+        """
+        The number of body lines of the file
+        """
+        return len(self.offsets)
+
+    def line_offset(self, line_id):
+        """
+        Get the byte offset a line starts at. The line after the last one
+        starts at the end of the file.
+
+        Args:
+            line_id(int): The 1-based line id
+
+        Returns:
+            offset(int): The byte offset
+        """
+        if line_id > self.line_count:
+            return os.path.getsize(self.vcf_path)
+        return self.offsets[line_id - 1]
+
+    def find_line(self, key, first=1):
+        """
+        Find the line of a sort key, or the line a row with it goes before
+
+        Args:
+            key(int): The sort key
+            first(int): The line id to search from
+
+        Returns:
+            (line_id, found): The line id (the one after the last line if the key is
+                greater than all) and whether the line has the key
+        """
+        position = bisect_left(self.keys, key, first - 1)
+        return position + 1, position < self.line_count and self.keys[position] == key
+
+    @classmethod
+    def build(cls, vcf_path, line_keys):
+        """
+        Build the index of a file by scanning it once. The lines can't tell which rows
+        they hold, so their sort keys come from the caller.
+
+        Args:
+            vcf_path(str): The full path of an uncompressed file
+            line_keys(callable): Gets the sort keys of the body lines from their number,
+                i.e. default_keys for a file that was never synced
+
+        Returns:
+            index(LineIndex): The index
+
+        Raises:
+            StaleIndexError: If the number of keys doesn't match the lines
+        """
+        body_offset = find_body_offset(vcf_path)
+        offsets = scan_offsets(vcf_path, body_offset)
+        return cls(vcf_path, body_offset, offsets, check_line_keys(vcf_path,
+            line_keys(len(offsets)), len(offsets)))
+
+    @classmethod
+    def read_entries(cls, vcf_path):
+        """
+        Read the stored index of a file without checking it against the file
+
+        Args:
+            vcf_path(str): The full path of the file
+
+        Returns:
+            (header, index): The unpacked header and the index, None if it is missing
+        """
+        try:
+            with open(vcf_path + INDEX_SUFFIX, 'rb') as stream:
+                header = INDEX_HEADER.unpack(stream.read(INDEX_HEADER.size))
+                entries = array(KEY_TYPECODE)
+                entries.frombytes(stream.read(header[3] * ENTRY_SIZE))
+        except (OSError, struct.error):
+            return None, None
+        if header[0] != INDEX_MAGIC or len(entries) != header[3] * 2:
+            return None, None
+        return header, cls(vcf_path, header[2], array(OFFSET_TYPECODE, entries[0::2]),
+            entries[1::2])
+
+    @classmethod
+    def load(cls, vcf_path):
+        """
+        Load the stored index of a file
+
+        Args:
+            vcf_path(str): The full path of the file
+
+        Returns:
+            index(LineIndex): The index or None if it is missing or does not match the file
+        """
+        header, index = cls.read_entries(vcf_path)
+        if index is None or not index.verify(header[1], header[4]):
+            return None
+        return index
+
+    @classmethod
+    def get(cls, vcf_path, line_keys=None):
+        """
+        Load the stored index of a file, (re)building it if it is missing or stale
+
+        Args:
+            vcf_path(str): The full path of an uncompressed file
+            line_keys(callable): Gets the sort keys of the body lines from their number,
+                to build the index with
+
+        Returns:
+            index(LineIndex): The index
+
+        Raises:
+            StaleIndexError: If the index has to be built without line_keys
+        """
+        index = cls.load(vcf_path)
+        if index is None:
+            if line_keys is None:
+                raise StaleIndexError(f"The line index of {vcf_path} is missing or stale!")
+            index = cls.build(vcf_path, line_keys)
+            index.save()
+        return index
+
+    def verify(self, size, checksum):
+        """
+        Check the index still describes the file: the size and the checksum of the
+        end of the file must match, and a sample of the offsets must be line starts.
+
+        Args:
+            size(int): The file size recorded with the index
+            checksum(int): The tail checksum recorded with the index
+
+        Returns:
+            valid(bool): True if the index can be used
+        """
+        if not os.path.isfile(self.vcf_path) or os.path.getsize(self.vcf_path) != size:
+            return False
+        if tail_checksum(self.vcf_path, size) != checksum:
+            return False
+        # Lines without a row before the first one are not indexed
+        if self.offsets and self.offsets[0] < self.body_offset:
+            return False
+        step = max(self.line_count // VERIFY_SAMPLES, 1)
+        with open(self.vcf_path, 'rb') as stream:
+            for position in range(0, self.line_count, step):
+                stream.seek(self.offsets[position] - 1)
+                if stream.read(1) != LINE_END:
+                    return False
+        return True
+
+    def replace_tail(self, start, offsets, keys):
+        """
+        Replace the entries of the lines from a line on
+
+        Args:
+            start(int): The id of the first replaced line
+            offsets(array): The offsets of the new lines
+            keys(array): The sort keys of the new lines
+        """
+        del self.offsets[start - 1:]
+        del self.keys[start - 1:]
+        self.offsets.extend(offsets)
+        self.keys.extend(keys)
+
+    def save(self, from_line=0):
+        """
+        Store the index. Only the header and the entries from a line on are written,
+        the ones before it are expected to be stored already.
+
+        Args:
+            from_line(int): The 0-based position of the first changed entry
+        """
+        size = os.path.getsize(self.vcf_path)
+        mode = 'r+b' if from_line and os.path.isfile(self.path) else 'wb'
+        entries = array(KEY_TYPECODE, bytes((self.line_count - from_line) * ENTRY_SIZE))
+        entries[0::2] = array(KEY_TYPECODE, self.offsets[from_line:])
+        entries[1::2] = self.keys[from_line:]
+        with open(self.path, mode) as stream:
+            stream.write(INDEX_HEADER.pack(INDEX_MAGIC, size, self.body_offset,
+                self.line_count, tail_checksum(self.vcf_path, size)))
+            stream.seek(INDEX_HEADER.size + from_line * ENTRY_SIZE)
+            entries.tofile(stream)
+            stream.truncate()
+
+def default_keys(count):
+    """
+    Get the sort keys the lines of a file are imported with. Only a file that was never
+    synced still has them, inserts and deletions shift the lines.
+
+    Args:
+        count(int): The number of lines
+
+    Returns:
+        keys(array): The sort keys
+    """
+    return array(KEY_TYPECODE, range(SORT_KEY_GAP, (count + 1) * SORT_KEY_GAP, SORT_KEY_GAP))
+
+def check_line_keys(vcf_path, keys, count):
+    """
+    Check there is a sort key for every body line of a file
+
+    Args:
+        vcf_path(str): The full path of the file
+        keys(iterable): The sort keys
+        count(int): The number of body lines
+
+    Returns:
+        keys(array): The sort keys
+
+    Raises:
+        StaleIndexError: If the number of keys doesn't match the lines
+    """
+    keys = array(KEY_TYPECODE, keys)
+    if len(keys) != count:
+        raise StaleIndexError(f"{vcf_path} has {count} lines but {len(keys)} rows!")
+    return keys
+
+def scan_offsets(vcf_path, offset):
+    """
+    Get the offsets of the body lines of a file from an offset on, by scanning it.
+    Like on import, the lines without a row are skipped.
+
+    Args:
+        vcf_path(str): The full path of an uncompressed file
+        offset(int): The offset of a line start in the body
+
+    Returns:
+        offsets(array): The line offsets
+    """
+    offsets = array(OFFSET_TYPECODE)
+    with open(vcf_path, 'rb', buffering=READ_BUFFER_SIZE) as stream:
+        stream.seek(offset)
+        position = offset
+        for line in stream:
+            if is_row_line(line):
+                offsets.append(position)
+            position += len(line)
+    return offsets
+
+def count_row_lines(vcf_path):
+    """
+    Count the body lines of a (compressed) file that hold a row, by scanning it
+
+    Args:
+        vcf_path(str): The full path of the file
+
+    Returns:
+        count(int): The number of lines
+    """
+    count = 0
+    in_body = False
+    with open_vcf_stream(vcf_path) as stream:
+        for line in stream:
+            in_body = in_body or not line.startswith(HEADER_PREFIX)
+            if in_body and is_row_line(line):
+                count += 1
+    return count
+
+def recover_index(vcf_path, start, offset, keys):
+    """
+    Rebuild the index of a file after an interrupted patch was completed from its journal.
+    The entries before the patched tail are still valid in the stored index, the tail
+    is scanned and gets the sort keys stored in the journal.
+
+    Args:
+        vcf_path(str): The full path of the file
+        start(int): The 0-based position of the first patched line
+        offset(int): The offset of the first patched line
+        keys(array): The sort keys of the patched lines
+
+    Returns:
+        index(LineIndex): The recovered index, None if the stored index can't be used
+    """
+    _, index = LineIndex.read_entries(vcf_path)
+    if index is None or index.line_count < start:
+        return None
+    offsets = scan_offsets(vcf_path, offset)
+    if len(offsets) != len(keys):
+        return None
+    index.replace_tail(start + 1, offsets, keys)
+    return index
+
+def apply_journal(vcf_path, index=None):
+    """
+    Replace the end of a file with the content of its journal, if there is one, and store
+    the index of the patched file. This is idempotent, so an interrupted sync is completed
+    by running it again.
+
+    Args:
+        vcf_path(str): The full path of the file
+        index(LineIndex): The index of the patched file, recovered from the journal if None
+
+    Returns:
+        applied(bool): True if a journal was applied
+    """
+    journal_path = vcf_path + JOURNAL_SUFFIX
+    if not os.path.isfile(journal_path):
+        return False
+    with open(journal_path, 'rb') as journal:
+        magic, offset, size, start = JOURNAL_HEADER.unpack(journal.read(JOURNAL_HEADER.size))
+        if magic == JOURNAL_MAGIC:
+            with open(vcf_path, 'r+b') as stream:
+                stream.truncate(offset)
+                stream.seek(offset)
+                copy_range(journal, stream, JOURNAL_HEADER.size, JOURNAL_HEADER.size + size)
+                stream.flush()
+                os.fsync(stream.fileno())
+            if index is None:
+                keys = array(KEY_TYPECODE)
+                keys.frombytes(journal.read())
+                index = recover_index(vcf_path, start, offset, keys)
+            # Without a usable index it is rebuilt on the next sync
+            if index is not None:
+                index.save(from_line=start)
+    os.remove(journal_path)
+    return True
+
+def merge_changes(dirty, deleted):
+    """
+    Merge modified/new rows and deleted rows into a single stream of changes in sort key
+    order, the form every sync function consumes. A deletion is a change without values.
+
+    Args:
+        dirty(iterable): (sort key, (chrom, pos, id, ref, alt)) tuples sorted by sort key
+        deleted(iterable): The sort keys of the deleted rows, sorted
+
+    Returns:
+        changes(iterator): (sort key, values) tuples sorted by sort key
+    """
+    # A deletion goes first, it wins over a change of the same row
+    return heapq.merge(((key, None) for key in deleted), dirty, key=itemgetter(0))
+
+def peek_changes(changes):
+    """
+    Get the first change of a stream without consuming it
+
+    Args:
+        changes(iterable): (sort key, values) tuples sorted by sort key
+
+    Returns:
+        (first, changes): The first change (None if there are none) and the full stream
+    """
+    changes = iter(changes)
+    first = next(changes, None)
+    if first is None:
+        return None, changes
+    return first, itertools.chain([first], changes)
+
+def first_changed_line(index, first):
+    """
+    Get the first line a sync has to rewrite
+
+    Args:
+        index(LineIndex): The index of the file
+        first(tuple): The first change of the stream
+
+    Returns:
+        line_id(int): The line id, the one after the last line if the file is only appended to
+    """
+    line_id, _ = index.find_line(first[0])
+    return line_id
+
+def copy_range(source, target, start, end):
+    """
+    Copy a byte range of a file verbatim with large reads and writes
+
+    Args:
+        source(file): The binary source file object
+        target(file): The binary target file object
+        start(int): The first byte offset
+        end(int): The offset after the last byte
+    """
+    source.seek(start)
+    remaining = end - start
+    while remaining > 0:
+        chunk = source.read(min(COPY_BUFFER_SIZE, remaining))
+        if not chunk:
+            break
+        target.write(chunk)
+        remaining -= len(chunk)
+
+def end_last_line(index, source, target, position):
+    """
+    Write a line end after the last line of a file if it lacks one, so lines can follow
+
+    Args:
+        index(LineIndex): The index of the source file
+        source(file): The binary source file object
+        target(file): The binary target file object
+        position(int): The offset the line end is written at
+
+    Returns:
+        position(int): The offset after the last line
+    """
+    if not index.line_count:
+        return position
+    source.seek(index.line_offset(index.line_count + 1) - 1)
+    if source.read(1) != LINE_END:
+        target.write(LINE_END)
+        position += len(LINE_END)
+    return position
+
+class BodyWriter:
+    """
+    Writes the body of a file from a line on, with the row changes applied.
+    Runs of unchanged lines are copied as byte ranges, only the modified and the new lines
+    are formatted. The offsets and the sort keys of the written lines are recorded.
+    """
+
+    def __init__(self, index, source, target, start, position, columns):
+        self.index = index
+        self.source = source
+        self.target = target
+        self.position = position
+        self.columns = columns
+        self.line_id = start
+        self.offsets = array(OFFSET_TYPECODE)
+        self.keys = array(KEY_TYPECODE)
+        if start > index.line_count:
+            # The last line is kept as it is, lines may follow it
+            self.position = end_last_line(index, source, target, position)
+
+    def copy_until(self, line_id):
+        """
+        Copy the unchanged lines up to a line verbatim
+
+        Args:
+            line_id(int): The id of the line after the run
+        """
+        index = self.index
+        if line_id <= self.line_id:
+            return
+        run_start = index.line_offset(self.line_id)
+        run_end = index.line_offset(line_id)
+        delta = self.position - run_start
+        run = index.offsets[self.line_id - 1:line_id - 1]
+        self.offsets.extend(run if not delta else
+            array(OFFSET_TYPECODE, [offset + delta for offset in run]))
+        self.keys.extend(index.keys[self.line_id - 1:line_id - 1])
+        copy_range(self.source, self.target, run_start, run_end)
+        self.position += run_end - run_start
+        if line_id > index.line_count:
+            self.position = end_last_line(index, self.source, self.target, self.position)
+        self.line_id = line_id
+
+    def write_line(self, key, line):
+        """
+        Write a formatted line
+
+        Args:
+            key(int): The sort key of the row
+            line(bytes): The line
+        """
+        self.offsets.append(self.position)
+        self.keys.append(key)
+        self.target.write(line)
+        self.position += len(line)
+
+    def write(self, changes, end=None):
+        """
+        Merge the change stream with the file in a single pass. Only one change
+        is held in memory at a time.
+
+        Args:
+            changes(iterable): (sort key, values) tuples sorted by sort key, see merge_changes.
+                Keys that are not in the file are inserted in order.
+            end(int): The id of the line the writing stops before, the end of the file if None.
+                The changes must have lower sort keys than that line.
+
+        Returns:
+            (offsets, keys): The offsets and the sort keys of the written lines
+        """
+        previous = None
+        for key, values in changes:
+            if key == previous:
+                # A row changed twice, the first change wins
+                continue
+            previous = key
+            line_id, found = self.index.find_line(key, self.line_id)
+            self.copy_until(line_id)
+            if found:
+                if values is not None:
+                    self.source.seek(self.index.offsets[line_id - 1])
+                    self.write_line(key, format_row_line(values, self.source.readline()))
+                self.line_id = line_id + 1
+            elif values is not None:
+                self.write_line(key, format_row_line(values, columns=self.columns))
+        self.copy_until(end or self.index.line_count + 1)
+        return self.offsets, self.keys
+
+def patch_file(index, changes):
+    """
+    Transfer row changes to a file by rewriting it from the first changed line on.
+    The new tail is written to a journal with the sort keys of its lines first, then
+    it replaces the end of the file and the index is updated from that line on.
+
+    Args:
+        index(LineIndex): The index of the file
+        changes(iterable): (sort key, values) tuples sorted by sort key, see merge_changes
+
+    Returns:
+        rewritten(int): The number of bytes written
+    """
+    vcf_path = index.vcf_path
+    first, changes = peek_changes(changes)
+    if first is None:
+        return 0
+    start = first_changed_line(index, first)
+    start_offset = index.line_offset(start)
+    columns = read_column_count(vcf_path, index.body_offset)
+    journal_path = vcf_path + JOURNAL_SUFFIX
+    with open(vcf_path, 'rb') as source, \
+            open(journal_path + '.tmp', 'wb', buffering=COPY_BUFFER_SIZE) as journal:
+        journal.write(bytes(JOURNAL_HEADER.size))
+        writer = BodyWriter(index, source, journal, start, start_offset, columns)
+        offsets, keys = writer.write(changes)
+        rewritten = journal.tell() - JOURNAL_HEADER.size
+        keys.tofile(journal)
+        journal.seek(0)
+        journal.write(JOURNAL_HEADER.pack(JOURNAL_MAGIC, start_offset, rewritten, start - 1))
+        journal.flush()
+        os.fsync(journal.fileno())
+    # The journal only becomes visible once it is complete
+    os.replace(journal_path + '.tmp', journal_path)
+    index.replace_tail(start, offsets, keys)
+    apply_journal(vcf_path, index)
+    return rewritten
+
+def write_append_marker(vcf_path, end):
+    """
+    Record the end offset of a file before lines are appended to it
+
+    Args:
+        vcf_path(str): The full path of the file
+        end(int): The end offset of the file
+    """
+    with open(vcf_path + APPEND_SUFFIX + '.tmp', 'wb') as marker:
+        marker.write(APPEND_MARKER.pack(APPEND_MAGIC, end))
+        marker.flush()
+        os.fsync(marker.fileno())
+    os.replace(vcf_path + APPEND_SUFFIX + '.tmp', vcf_path + APPEND_SUFFIX)
+
+def undo_append(vcf_path):
+    """
+    Roll back an append that was interrupted before its index was stored, by truncating
+    the file to the end offset recorded before it. The rows are still pending, so the next
+    sync appends them again. A completed append is kept.
+
+    Args:
+        vcf_path(str): The full path of the file
+
+    Returns:
+        undone(bool): True if an interrupted append was rolled back
+    """
+    marker_path = vcf_path + APPEND_SUFFIX
+    if not os.path.isfile(marker_path):
+        return False
+    undone = False
+    with open(marker_path, 'rb') as marker:
+        try:
+            magic, end = APPEND_MARKER.unpack(marker.read(APPEND_MARKER.size))
+        except struct.error:
+            magic = None
+    if magic == APPEND_MAGIC and LineIndex.load(vcf_path) is None \
+            and os.path.getsize(vcf_path) > end:
+        with open(vcf_path, 'r+b') as stream:
+            stream.truncate(end)
+            os.fsync(stream.fileno())
+        undone = True
+    os.remove(marker_path)
+    return undone
+
+def append_file(index, changes):
+    """
+    Transfer row changes that all come after the last line of a file by appending the
+    new lines to it. Only the new lines are written, nothing is copied. The end offset of
+    the file is recorded first so an interrupted append can be rolled back, see undo_append.
+
+    Args:
+        index(LineIndex): The index of the file
+        changes(iterable): (sort key, values) tuples sorted by sort key, greater than the
+            sort key of the last line, see merge_changes
+
+    Returns:
+        rewritten(int): The number of bytes written
+    """
+    vcf_path = index.vcf_path
+    columns = read_column_count(vcf_path, index.body_offset)
+    end = os.path.getsize(vcf_path)
+    write_append_marker(vcf_path, end)
+    offsets = array(OFFSET_TYPECODE)
+    keys = array(KEY_TYPECODE)
+    previous = None
+    with open(vcf_path, 'r+b', buffering=COPY_BUFFER_SIZE) as stream:
+        position = end_last_line(index, stream, stream, end)
+        stream.seek(position)
+        for key, values in changes:
+            # Rows deleted before they were ever synced have no line
+            if key == previous or values is None:
+                previous = key
+                continue
+            previous = key
+            line = format_row_line(values, columns=columns)
+            offsets.append(position)
+            keys.append(key)
+            stream.write(line)
+            position += len(line)
+        stream.flush()
+        os.fsync(stream.fileno())
+    start = index.line_count
+    index.offsets.extend(offsets)
+    index.keys.extend(keys)
+    index.save(from_line=start)
+    os.remove(vcf_path + APPEND_SUFFIX)
+    return position - end
+
+def rewrite_file(index, changes):
+    """
+    Transfer row changes to a file by writing a new copy of it and replacing the
+    original, copying the header and the unchanged lines verbatim
+
+    Args:
+        index(LineIndex): The index of the file
+        changes(iterable): (sort key, values) tuples sorted by sort key, see merge_changes
+
+    Returns:
+        rewritten(int): The number of bytes written
+    """
+    vcf_path = index.vcf_path
+    columns = read_column_count(vcf_path, index.body_offset)
+    with open(vcf_path, 'rb') as source, \
+            open(vcf_path + REWRITE_SUFFIX, 'wb', buffering=COPY_BUFFER_SIZE) as target:
+        copy_range(source, target, 0, index.body_offset)
+        writer = BodyWriter(index, source, target, 1, index.body_offset, columns)
+        offsets, keys = writer.write(changes)
+        rewritten = target.tell()
+        target.flush()
+        os.fsync(target.fileno())
+    os.replace(vcf_path + REWRITE_SUFFIX, vcf_path)
+    index.offsets = offsets
+    index.keys = keys
+    index.save()
+    return rewritten
+
+def plan_parts(vcf_path, first_key, parts):
+    """
+    Split the rewrite of a file in parts that can be written in parallel, when the changes
+    would have the whole file rewritten (see sync_file). Every part covers a range of lines
+    from the first changed line on, and the range of sort keys of its changes.
+
+    Args:
+        vcf_path(str): The full path of an uncompressed file
+        first_key(int): The lowest sort key of the changes
+        parts(int): The number of parts
+
+    Returns:
+        (start, ranges): The id of the first changed line and the (first line, end line,
+            first key, end key) tuple of every part, the keys are None when unbounded.
+            There are no ranges when the file is cheaper to patch or append to.
+    """
+    # Complete a patch or roll back an append that was interrupted,
+    # a stale index has to be restored first, see restore_line_keys
+    apply_journal(vcf_path)
+    undo_append(vcf_path)
+    index = LineIndex.get(vcf_path)
+    start, _ = index.find_line(first_key)
+    size = os.path.getsize(vcf_path)
+    if start > index.line_count or (size - index.line_offset(start)) * TAIL_WRITES <= size:
+        return start, []
+    lines = index.line_count - start + 1
+    parts = max(min(parts, lines), 1)
+    bounds = [start + lines * part // parts for part in range(parts + 1)]
+    ranges = []
+    for part in range(parts):
+        first_line, end_line = bounds[part], bounds[part + 1]
+        ranges.append((first_line, end_line, index.keys[first_line - 1] if part else None,
+            index.keys[end_line - 1] if end_line <= index.line_count else None))
+    return start, ranges
+
+def get_part_path(vcf_path, part):
+    """
+    Get the path of a part of a file rewrite
+
+    Args:
+        vcf_path(str): The full path of the file
+        part(int): The 0-based part number
+
+    Returns:
+        path(str): The path of the part file
+    """
+    return vcf_path + PART_SUFFIX.format(part)
+
+def write_part(vcf_path, first_line, end_line, changes, part_path):
+    """
+    Write a part of a file rewrite: the lines of a range with their changes applied.
+    The offsets and the sort keys of the written lines, relative to the part, are
+    stored next to it.
+
+    Args:
+        vcf_path(str): The full path of an uncompressed file
+        first_line(int): The id of the first line of the part
+        end_line(int): The id of the line after the part, the one after the last line for
+            the last part
+        changes(iterable): (sort key, values) tuples sorted by sort key, within the sort keys
+            of the part, see merge_changes
+        part_path(str): The full path of the part file
+
+    Returns:
+        written(int): The size of the part
+    """
+    index = LineIndex.get(vcf_path)
+    columns = read_column_count(vcf_path, index.body_offset)
+    with open(vcf_path, 'rb') as source, \
+            open(part_path, 'wb', buffering=COPY_BUFFER_SIZE) as target:
+        writer = BodyWriter(index, source, target, first_line, 0, columns)
+        offsets, keys = writer.write(changes, end_line)
+        written = target.tell()
+        target.flush()
+        os.fsync(target.fileno())
+    with open(part_path + INDEX_SUFFIX, 'wb') as stream:
+        stream.write(PART_HEADER.pack(PART_MAGIC, len(keys)))
+        offsets.tofile(stream)
+        keys.tofile(stream)
+    return written
+
+def read_part_entries(part_path):
+    """
+    Read the offsets and the sort keys of the lines of a part
+
+    Args:
+        part_path(str): The full path of the part file
+
+    Returns:
+        (offsets, keys): The offsets relative to the part and the sort keys
+
+    Raises:
+        ValueError: If the entries are missing or incomplete
+    """
+    offsets = array(OFFSET_TYPECODE)
+    keys = array(KEY_TYPECODE)
+    with open(part_path + INDEX_SUFFIX, 'rb') as stream:
+        magic, count = PART_HEADER.unpack(stream.read(PART_HEADER.size))
+        offsets.frombytes(stream.read(count * offsets.itemsize))
+        keys.frombytes(stream.read(count * keys.itemsize))
+    if magic != PART_MAGIC or len(offsets) != count or len(keys) != count:
+        raise ValueError(f"The line entries of {part_path} are not valid!")
+    return offsets, keys
+
+def join_parts(vcf_path, start, part_paths):
+    """
+    Complete a file rewrite written in parts: the new file is the unchanged lines before the
+    first changed line followed by the parts, it replaces the original once it is complete.
+    The parts are removed.
+
+    Args:
+        vcf_path(str): The full path of the file
+        start(int): The id of the first changed line
+        part_paths(list): The full paths of the part files, in line order
+
+    Returns:
+        rewritten(int): The number of bytes written
+    """
+    index = LineIndex.get(vcf_path)
+    offsets = array(OFFSET_TYPECODE)
+    keys = array(KEY_TYPECODE)
+    with open(vcf_path, 'rb') as source, \
+            open(vcf_path + REWRITE_SUFFIX, 'wb', buffering=COPY_BUFFER_SIZE) as target:
+        position = index.line_offset(start)
+        copy_range(source, target, 0, position)
+        for part_path in part_paths:
+            part_offsets, part_keys = read_part_entries(part_path)
+            offsets.extend(array(OFFSET_TYPECODE,
+                [offset + position for offset in part_offsets]))
+            keys.extend(part_keys)
+            with open(part_path, 'rb') as part:
+                shutil.copyfileobj(part, target, COPY_BUFFER_SIZE)
+            position = target.tell()
+        target.flush()
+        os.fsync(target.fileno())
+    os.replace(vcf_path + REWRITE_SUFFIX, vcf_path)
+    index.replace_tail(start, offsets, keys)
+    index.save()
+    remove_parts(part_paths)
+    return position
+
+def remove_parts(part_paths):
+    """
+    Remove the part files of a file rewrite with their line entries
+
+    Args:
+        part_paths(list): The full paths of the part files
+    """
+    for part_path in part_paths:
+        remove_file(part_path, (INDEX_SUFFIX,))
+
+def iter_merged_lines(source, changes, keys):
+    """
+    Merge the change stream with the lines of a file stream in a single pass.
+    The unchanged lines are passed on as they are, only the changed and the new
+    ones are formatted. Only one change is held in memory at a time.
+    The lines without a row are dropped.
+
+    Args:
+        source(file): The binary stream of the whole file
+        changes(iterable): (sort key, values) tuples sorted by sort key, see merge_changes
+        keys(iterable): The sort keys of the body lines
+
+    Returns:
+        lines(iterator): (sort key, line) tuples in file order, the header lines have no key
+
+    Raises:
+        StaleIndexError: If the number of keys doesn't match the lines
+    """
+    changes = iter(changes)
+    pending = next(changes, None)
+    keys = iter(keys)
+    in_body = False
+    columns = FIXED_COLUMNS
+    previous = None
+    for line in source:
+        if not in_body:
+            if line.startswith(HEADER_PREFIX):
+                if line.startswith(COLUMNS_HEADER_PREFIX):
+                    columns = len(line.split(FIELD_DEL))
+                yield None, line
+                continue
+            in_body = True
+        if not is_row_line(line):
+            continue
+        line_key = next(keys, None)
+        if line_key is None:
+            raise StaleIndexError("The file has more lines than sort keys!")
+        change = None
+        while pending is not None and pending[0] <= line_key:
+            key, values = pending
+            pending = next(changes, None)
+            if key == previous:
+                continue
+            previous = key
+            if key == line_key:
+                change = values
+                break
+            if values is not None:
+                yield key, format_row_line(values, columns=columns)
+        if previous == line_key:
+            if change is not None:
+                yield line_key, format_row_line(change, line)
+            continue
+        yield line_key, line if line.endswith(LINE_END) else line + LINE_END
+    if next(keys, None) is not None:
+        raise StaleIndexError("The file has fewer lines than sort keys!")
+    for key, values in itertools.chain([pending] if pending else [], changes):
+        if key != previous and values is not None:
+            yield key, format_row_line(values, columns=columns)
+        previous = key
+
+def convert_file(source_path, vcf_path, changes, keys):
+    """
+    Transfer row changes while decompressing a file to an uncompressed copy,
+    building the index of the new file along the way.
+
+    Args:
+        source_path(str): The full path of the (compressed) file
+        vcf_path(str): The full path of the uncompressed file to write
+        changes(iterable): (sort key, values) tuples sorted by sort key, see merge_changes
+        keys(iterable): The sort keys of the source lines
+
+    Returns:
+        rewritten(int): The number of bytes written
+    """
+    with open_vcf_stream(source_path) as source:
+        return write_indexed_file(iter_merged_lines(source, changes, keys), vcf_path)
+
+def write_indexed_file(lines, vcf_path):
+    """
+    Write an uncompressed file and its index, replacing the previous ones once complete
+
+    Args:
+        lines(iterable): (sort key, line) tuples in file order, see iter_merged_lines
+        vcf_path(str): The full path of the file to write
+
+    Returns:
+        rewritten(int): The number of bytes written
+    """
+    offsets = array(OFFSET_TYPECODE)
+    line_keys = array(KEY_TYPECODE)
+    body_offset = None
+    position = 0
+    with open(vcf_path + REWRITE_SUFFIX, 'wb', buffering=COPY_BUFFER_SIZE) as target:
+        for key, line in lines:
+            if key is not None:
+                if body_offset is None:
+                    body_offset = position
+                offsets.append(position)
+                line_keys.append(key)
+            target.write(line)
+            position += len(line)
+        if body_offset is None:
+            body_offset = position
+        target.flush()
+        os.fsync(target.fileno())
+    os.replace(vcf_path + REWRITE_SUFFIX, vcf_path)
+    LineIndex(vcf_path, body_offset, offsets, line_keys).save()
+    return position
+
+def save_line_keys(key_path, size, keys):
+    """
+    Store the sort keys of the lines of a compressed file, which has no line index
+
+    Args:
+        key_path(str): The path of the key file
+        size(int): The size of the compressed file
+        keys(array): The sort keys of its body lines
+    """
+    with open(key_path, 'wb') as stream:
+        stream.write(KEYS_HEADER.pack(KEYS_MAGIC, size, len(keys)))
+        keys.tofile(stream)
+        stream.flush()
+        os.fsync(stream.fileno())
+
+def load_line_keys(vcf_path):
+    """
+    Load the stored sort keys of the lines of a compressed file
+
+    Args:
+        vcf_path(str): The full path of the compressed file
+
+    Returns:
+        keys(array): The sort keys, None if they are missing or don't match the file
+    """
+    try:
+        with open(vcf_path + KEYS_SUFFIX, 'rb') as stream:
+            magic, size, count = KEYS_HEADER.unpack(stream.read(KEYS_HEADER.size))
+            keys = array(KEY_TYPECODE)
+            keys.frombytes(stream.read(count * keys.itemsize))
+    except (OSError, struct.error):
+        return None
+    if magic != KEYS_MAGIC or size != os.path.getsize(vcf_path) or len(keys) != count:
+        return None
+    return keys
+
+def compress_file(source_path, vcf_path, changes, keys):
+    """
+    Transfer row changes while writing a BGZF compressed copy of a file, building
+    its tabix index and storing the sort keys of its lines along the way.
+
+    Args:
+        source_path(str): The full path of the (compressed) file
+        vcf_path(str): The full path of the compressed file to write
+        changes(iterable): (sort key, values) tuples sorted by sort key, see merge_changes
+        keys(iterable): The sort keys of the source lines
+
+    Returns:
+        rewritten(int): The number of bytes written
+    """
+    with open_vcf_stream(source_path) as source:
+        return write_compressed_file(iter_merged_lines(source, changes, keys), vcf_path)
+
+def write_compressed_file(lines, vcf_path):
+    """
+    Write a BGZF compressed file with its tabix index and the sort keys of its lines.
+    The file and its side files replace the previous ones once they are complete.
+
+    Args:
+        lines(iterable): (sort key, line) tuples in file order, see iter_merged_lines
+        vcf_path(str): The full path of the compressed file to write
+
+    Returns:
+        rewritten(int): The number of bytes written
+    """
+    tabix = TabixIndex()
+    line_keys = array(KEY_TYPECODE)
+    with open(vcf_path + REWRITE_SUFFIX, 'wb', buffering=COPY_BUFFER_SIZE) as target:
+        writer = BgzfWriter(target)
+        start = writer.tell()
+        for key, line in lines:
+            writer.write(line)
+            end = writer.tell()
+            if key is not None:
+                line_keys.append(key)
+                span = record_span(line)
+                if span is not None:
+                    tabix.add(*span, start, end)
+            start = end
+        writer.close()
+        target.flush()
+        os.fsync(target.fileno())
+        rewritten = target.tell()
+    save_line_keys(vcf_path + KEYS_SUFFIX + REWRITE_SUFFIX, rewritten, line_keys)
+    tabix.save(vcf_path + TABIX_SUFFIX + REWRITE_SUFFIX)
+    for suffix in ('', KEYS_SUFFIX, TABIX_SUFFIX):
+        os.replace(vcf_path + suffix + REWRITE_SUFFIX, vcf_path + suffix)
+    return rewritten
+
+def restore_line_keys(vcf_path, line_keys):
+    """
+    Make sure the sort keys of the lines of a file are stored before it is synced.
+    A missing or stale index (the key file of a compressed file) is rebuilt with the keys
+    line_keys gets, as the lines can't tell which rows they hold. Interrupted patches and
+    appends are settled first.
+
+    Args:
+        vcf_path(str): The full path of the file
+        line_keys(callable): Gets the sort keys of the body lines from their number
+
+    Raises:
+        StaleIndexError: If the number of keys doesn't match the lines
+    """
+    if not is_gzipped(vcf_path):
+        apply_journal(vcf_path)
+        undo_append(vcf_path)
+        LineIndex.get(vcf_path, line_keys)
+    elif load_line_keys(vcf_path) is None:
+        count = count_row_lines(vcf_path)
+        save_line_keys(vcf_path + KEYS_SUFFIX, os.path.getsize(vcf_path),
+            check_line_keys(vcf_path, line_keys(count), count))
+
+def read_header_lines(vcf_path):
+    """
+    Read the header lines of a (compressed) file
+
+    Args:
+        vcf_path(str): The full path of the file
+
+    Returns:
+        lines(list): The header lines
+    """
+    with open_vcf_stream(vcf_path) as stream:
+        return list(itertools.takewhile(lambda line: line.startswith(HEADER_PREFIX), stream))
+
+def regenerate_file(vcf_path, rows):
+    """
+    Write a file anew from its header and the rows it should hold, when its lines can't be
+    matched to the rows anymore. The columns after ALT get missing values. The file keeps
+    its format and gets its index, or its tabix index and key file when compressed.
+
+    Args:
+        vcf_path(str): The full path of the file
+        rows(iterable): (sort key, values) tuples of all the rows sorted by sort key
+
+    Returns:
+        rewritten(int): The number of bytes written
+    """
+    lines = iter_merged_lines(read_header_lines(vcf_path), rows, [])
+    if is_gzipped(vcf_path):
+        return write_compressed_file(lines, vcf_path)
+    rewritten = write_indexed_file(lines, vcf_path)
+    # A journal or an append marker left behind belongs to the previous content
+    for suffix in (JOURNAL_SUFFIX, APPEND_SUFFIX):
+        if os.path.isfile(vcf_path + suffix):
+            os.remove(vcf_path + suffix)
+    return rewritten
+
+def remove_file(vcf_path, suffixes):
+    """
+    Remove a file that was replaced by a copy in another format, with its side files
+
+    Args:
+        vcf_path(str): The full path of the file
+        suffixes(tuple): The suffixes of its side files
+    """
+    for suffix in ('',) + suffixes:
+        if os.path.isfile(vcf_path + suffix):
+            os.remove(vcf_path + suffix)
+
+def get_uncompressed_path(vcf_path):
+    """
+    Get the path the uncompressed copy of a compressed file is written to
+
+    Args:
+        vcf_path(str): The full path of the compressed file
+
+    Returns:
+        path(str): The path without the compression extension
+    """
+    root, extension = os.path.splitext(vcf_path)
+    if extension in COMPRESSED_EXTENSIONS:
+        return root if root.endswith(VCF_EXTENSION) else root + VCF_EXTENSION
+    return vcf_path + VCF_EXTENSION
+
+def get_compressed_path(vcf_path):
+    """
+    Get the path the BGZF compressed copy of an uncompressed file is written to
+
+    Args:
+        vcf_path(str): The full path of the uncompressed file
+
+    Returns:
+        path(str): The path with the compression extension
+    """
+    return vcf_path + COMPRESSED_EXTENSIONS[0]
+
+def sync_file(vcf_path, changes, compress=False):
+    """
+    Transfer row changes to a VCF file with the cheapest method.
+    With compress the file is kept BGZF compressed with a tabix index: it is rewritten in a
+    single streaming pass, as a compressed file can't be patched in place. Otherwise a
+    compressed file is converted to an uncompressed one. Lines that only come after the
+    last line are appended. Otherwise only the tail after the first changed line is
+    rewritten, unless that is most of the file: the tail is written twice (journal and file)
+    so then writing a new copy of the file is cheaper.
+
+    Args:
+        vcf_path(str): The full path of the file
+        changes(iterable): (sort key, values) tuples sorted by sort key, see merge_changes
+        compress(bool): True to keep the file BGZF compressed
+
+    Returns:
+        (path, rewritten): The path of the synced file and the number of bytes written
+
+    Raises:
+        StaleIndexError: If the sort keys of the lines are not stored, see restore_line_keys
+    """
+    if is_gzipped(vcf_path):
+        keys = load_line_keys(vcf_path)
+        if keys is None:
+            raise StaleIndexError(f"The line keys of {vcf_path} are missing or stale!")
+        if compress:
+            first, changes = peek_changes(changes)
+            if first is None and os.path.isfile(vcf_path + TABIX_SUFFIX):
+                return vcf_path, 0
+            return vcf_path, compress_file(vcf_path, vcf_path, changes, keys)
+        path = get_uncompressed_path(vcf_path)
+        rewritten = convert_file(vcf_path, path, changes, keys)
+        remove_file(vcf_path, (KEYS_SUFFIX, TABIX_SUFFIX))
+        return path, rewritten
+    # Complete a patch or roll back an append that was interrupted,
+    # a stale index has to be restored first, see restore_line_keys
+    apply_journal(vcf_path)
+    undo_append(vcf_path)
+    index = LineIndex.get(vcf_path)
+    if compress:
+        path = get_compressed_path(vcf_path)
+        rewritten = compress_file(vcf_path, path, changes, index.keys)
+        remove_file(vcf_path, (INDEX_SUFFIX,))
+        return path, rewritten
+    first, changes = peek_changes(changes)
+    if first is None:
+        return vcf_path, 0
+    start = first_changed_line(index, first)
+    if start > index.line_count:
+        return vcf_path, append_file(index, changes)
+    size = os.path.getsize(vcf_path)
+    if (size - index.line_offset(start)) * TAIL_WRITES > size:
+        return vcf_path, rewrite_file(index, changes)
+    return vcf_path, patch_file(index, changes)
@@ -0,0 +1,484 @@
+"""
+This is a benchmark command module. It reports how the queries behind our
+endpoints and tasks perform on the configured database, so changes to the
+schema or the query patterns can be verified against real data.
+"""
+import os
+import re
+import time
+import heapq
+import shutil
+import tempfile
+import tracemalloc
+import multiprocessing
+from operator import itemgetter
+from django.db import transaction
+from django.utils import timezone
+from django.core.management.base import BaseCommand
+from vcfApi.models import Vcf
+from vcfApi.models import VcfRow
+from vcfApi.models import RowEvent
+from vcfApi.vcfio import is_gzipped
+from vcfApi.filesync import LineIndex
+from vcfApi.filesync import rewrite_file
+from vcfApi.filesync import patch_file
+from vcfApi.filesync import append_file
+from vcfApi.filesync import sync_file
+from vcfApi.filesync import merge_changes
+from vcfApi.filesync import compress_file
+from vcfApi.filesync import default_keys
+from vcfApi.filesync import plan_parts
+from vcfApi.filesync import get_part_path
+from vcfApi.filesync import write_part
+from vcfApi.filesync import join_parts
+from vcfApi.bgzf import read_region
+from vcfApi.query import region_query
+from vcfApi.segments import Manifest
+from vcfApi.segments import split_file
+from vcfApi.segments import join_segments
+from vcfApi.segments import get_manifest_path
+from vcfApi.filesync import SORT_KEY_GAP
+from vcfApi.bulk import bulk_update_rows
+from vcfApi.bulk import bulk_delete_rows
+from vcfApi.tasks import get_pending_events
+from vcfApi.tasks import compact_row_events
+from vcfApi.tasks import iter_row_changes
+from vcfApi.tasks import finish_file_sync
+from vcfApi import logger
+DEFAULT_REPEAT = 20
+DEFAULT_CHANGES = 100000
+DEFAULT_ROWS = 1000000
+DEFAULT_DELETIONS = 10000
+DEFAULT_PARTS = 4
+# The number of chromosomes of the segments suite file
+SEGMENT_CHROMOSOMES = 24
+# The number of positions the filesync suite reads from the compressed file
+REGION_READ_SIZE = 1000000
+# How many times the journal suite updates every row
+JOURNAL_ROUNDS = 10
+INSERT_BATCH_SIZE = 10000
+PAGE_SIZE = 10
+# A plan line that reads the whole table instead of searching or walking an index
+FULL_SCAN = re.compile(r'\bSCAN (TABLE )?\S+\s*$')
+# The unique (vcf, sort_key) constraint is part of the table on SQLite, its index is unnamed
+SORT_KEY_INDEXES = ("vcfrow_vcf_sort_key_uniq", "sqlite_autoindex_vcfApi_vcfrow_")
+# The indexes the plan of a query has to search one of, where another would walk the whole file
+EXPECTED_INDEXES = {
+    "list": SORT_KEY_INDEXES,
+    "list regions": ("vcfrow_vcf_chrom_pos_idx",),
+    "sorted placement": ("vcfrow_vcf_chrom_pos_idx",),
+    "last sort key": SORT_KEY_INDEXES,
+    "pending deletions": ("rowevent_deleted_key_idx",),
+}
+
+def endpoint_querysets(sample_row):
+    """
+    Build the querysets our hot paths run, using the values of an existing row
+
+    Args:
+        sample_row(VcfRow): A row whose values are used for the filters
+
+    Returns:
+        querysets(list): A list of (name, queryset) tuples
+    """
+    rows = VcfRow.objects.filter(vcf_id=sample_row.vcf_id)
+    return [
+        ("list", rows[:PAGE_SIZE]),
+        ("list chrom", rows.filter(chrom=sample_row.chrom)[:PAGE_SIZE]),
+        ("list pos", rows.filter(pos=sample_row.pos)[:PAGE_SIZE]),
+        ("list chrom pos", rows.filter(chrom=sample_row.chrom, pos=sample_row.pos)[:PAGE_SIZE]),
+        ("list regions", VcfRow.objects.filter(region_query([f"{sample_row.chrom}:1-"
+            f"{sample_row.pos}", f"chrX:1-{sample_row.pos}"], sample_row.vcf_id))[:PAGE_SIZE]),
+        ("detail id", VcfRow.objects.filter(id=sample_row.id)),
+        ("task pending events", get_pending_events(sample_row.vcf_id, 0, sample_row.sort_key)
+            .order_by('sort_key', 'seq')),
+        ("pending deletions", RowEvent.deletions().filter(vcf_id=sample_row.vcf_id,
+            sort_key__lt=sample_row.sort_key).order_by('-sort_key')[:1]),
+        ("change feed", RowEvent.objects.filter(seq__gt=0).order_by('seq')[:PAGE_SIZE]),
+        ("expired deletions", RowEvent.deletions().filter(vcf_id=sample_row.vcf_id,
+            seq__lte=sample_row.sort_key, date_created__lt=timezone.now())),
+        ("sorted placement", rows.filter(chrom=sample_row.chrom, pos__gt=sample_row.pos)
+            .order_by('pos', 'sort_key')[:1]),
+        ("last sort key", rows.order_by('-sort_key')[:1]),
+    ]
+
+def is_slow_plan(name, plan):
+    """
+    Check an EXPLAIN output for a full table scan or a query that misses its index
+
+    Args:
+        name(str): The name of the query, see endpoint_querysets
+        plan(str): The output of QuerySet.explain()
+
+    Returns:
+        slow(bool): True if the plan scans a whole table or does not use the expected index
+    """
+    expected = EXPECTED_INDEXES.get(name, ('',))
+    return is_full_scan(plan) or not any(index in plan for index in expected)
+
+def is_full_scan(plan):
+    """
+    Check an EXPLAIN output for a full table scan
+
+    Args:
+        plan(str): The output of QuerySet.explain()
+
+    Returns:
+        full_scan(bool): True if any step of the plan scans a whole table
+    """
+    return any(FULL_SCAN.search(line) for line in plan.splitlines())
+
+def time_queryset(queryset, repeat):
+    """
+    Run a queryset a number of times and return the median duration
+
+    Args:
+        queryset(QuerySet): The queryset to evaluate
+        repeat(int): How many times it should run
+
+    Returns:
+        duration(float): The median duration in milliseconds
+    """
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        list(queryset.all())
+        durations.append((time.perf_counter() - start) * 1000)
+    durations.sort()
+    return durations[len(durations) // 2]
+
+def run_query_plans(repeat):
+    """
+    Print the plan and the median duration of every hot path query
+
+    Args:
+        repeat(int): How many times each query should run
+
+    Returns:
+        slow_plans(list): The names of the queries that scan a whole table or miss their index
+    """
+    sample_row = VcfRow.objects.order_by('sort_key').last()
+    if not sample_row:
+        logger.error("No rows found, please import a VCF file first")
+        return []
+    slow_plans = []
+    for name, queryset in endpoint_querysets(sample_row):
+        plan = queryset.explain()
+        if is_slow_plan(name, plan):
+            slow_plans.append(name)
+        logger.info(f"{name}: {time_queryset(queryset, repeat):.3f}ms\n{plan}")
+    return slow_plans
+
+def time_call(function, *args):
+    """
+    Run a function once and return its duration in seconds
+    """
+    start = time.perf_counter()
+    function(*args)
+    return time.perf_counter() - start
+
+def run_file_sync():
+    """
+    Compare the file sync methods with a plain file copy, on a copy of the managed file
+
+    Returns:
+        timings(dict): The durations in seconds by method
+    """
+    vcf_file = Vcf.objects.first()
+    if not vcf_file or not os.path.isfile(vcf_file.fullpath) or is_gzipped(vcf_file.fullpath):
+        logger.error("No uncompressed VCF file found, please import one and sync it first")
+        return {}
+    with tempfile.TemporaryDirectory() as work_dir:
+        path = os.path.join(work_dir, 'benchmark.vcf')
+        timings = {'copy': time_call(shutil.copyfile, vcf_file.fullpath, path)}
+        # The copy gets keys in line order, like a file that was never synced
+        timings['index build'] = time_call(LineIndex.get, path, default_keys)
+        index = LineIndex.get(path)
+        row = ('chr1', 1, '', 'A', '')
+        first_key, last_key = index.keys[0], index.keys[-1]
+        timings['full rewrite'] = time_call(rewrite_file, index, [(first_key, row)])
+        timings['tail patch'] = time_call(patch_file, LineIndex.get(path), [(last_key, row)])
+        timings['tail append'] = time_call(patch_file, LineIndex.get(path),
+            [(last_key + SORT_KEY_GAP, row)])
+        timings['append'] = time_call(append_file, LineIndex.get(path),
+            [(last_key + 2 * SORT_KEY_GAP, row)])
+        index = LineIndex.get(path)
+        timings['bgzf rewrite'] = time_call(compress_file, path, path + '.gz',
+            [(last_key, row)], index.keys)
+        logger.info(f"bgzf size: {os.path.getsize(path + '.gz')} bytes "
+            f"({os.path.getsize(path) / os.path.getsize(path + '.gz'):.1f}x smaller)")
+        with open(path, 'rb') as stream:
+            stream.seek(index.offsets[0])
+            chrom, pos = stream.readline().split(b'\t', 2)[:2]
+        timings['bgzf region read'] = time_call(list,
+            read_region(path + '.gz', chrom.decode(), int(pos), int(pos) + REGION_READ_SIZE))
+    for name, duration in timings.items():
+        logger.info(f"{name}: {duration * 1000:.1f}ms "
+            f"({duration / max(timings['copy'], 1e-9):.2f}x the file copy)")
+    return timings
+
+def write_sample_file(path, line_count, chromosomes=1):
+    """
+    Write a synthetic VCF file with a number of body lines, spread evenly over chromosomes
+    """
+    with open(path, 'w') as stream:
+        stream.write("##fileformat=VCFv4.1\n#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n")
+        for line_id in range(1, line_count + 1):
+            chrom = (line_id - 1) * chromosomes // line_count + 1
+            stream.write(f"chr{chrom}\t{line_id}\trs{line_id}\tA\tG\t.\tPASS\t.\n")
+
+def run_change_stream(changes):
+    """
+    Sync a number of pending changes to a synthetic file twice their size, streaming them
+    as the file modify task does. A third of them are updates, a third deletions and a
+    third inserts, interleaved over the whole file.
+
+    Args:
+        changes(int): The number of pending changes
+
+    Returns:
+        (duration, peak): The sync duration in seconds and the peak memory in bytes
+    """
+    line_count = changes * 2
+    with tempfile.TemporaryDirectory() as work_dir:
+        path = os.path.join(work_dir, 'benchmark.vcf')
+        write_sample_file(path, line_count)
+        LineIndex.get(path, default_keys)
+        dirty = heapq.merge(
+            ((line_id * SORT_KEY_GAP, ('chr1', line_id, '', 'A', 'T'))
+                for line_id in range(1, line_count, 6)),
+            ((line_id * SORT_KEY_GAP + 1, ('chr1', line_id, '', 'C', 'G'))
+                for line_id in range(3, line_count, 6)), key=itemgetter(0))
+        deleted = (line_id * SORT_KEY_GAP for line_id in range(4, line_count, 6))
+        tracemalloc.start()
+        start = time.perf_counter()
+        sync_file(path, merge_changes(dirty, deleted))
+        duration = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    logger.info(f"{changes} changes on {line_count} lines: {duration * 1000:.1f}ms, "
+        f"peak memory {peak / 1024:.0f}KB")
+    return duration, peak
+
+def run_ordering(rows, deletions):
+    """
+    Time the row placement operations on a large table: a row placed in chrom/pos order,
+    a bulk deletion spread over the table and the cleanup after the file sync.
+    The rows are created in a transaction that is rolled back, the data stays untouched.
+
+    Args:
+        rows(int): The number of rows
+        deletions(int): The number of deleted rows
+
+    Returns:
+        timings(dict): The durations in seconds by operation
+    """
+    with transaction.atomic():
+        vcf_file = Vcf.objects.create(name='benchmark.vcf', fullpath='benchmark.vcf')
+        first_key = VcfRow.last_sort_key(vcf_file.id) + SORT_KEY_GAP
+        for start in range(0, rows, INSERT_BATCH_SIZE):
+            VcfRow.objects.bulk_create([VcfRow(vcf=vcf_file,
+                sort_key=first_key + line * SORT_KEY_GAP, chrom='chrM', pos=line * 2 + 1,
+                ref='A', alt='G') for line in range(start, min(start + INSERT_BATCH_SIZE, rows))])
+        timings = {'sorted placement': time_call(lambda: VcfRow.objects.create(vcf=vcf_file,
+            sort_key=VcfRow.sorted_sort_key(vcf_file.id, 'chrM', rows), chrom='chrM', pos=rows,
+            ref='A', alt='G'))}
+        step = max(rows // max(deletions, 1), 1)
+        deleted_keys = [first_key + line * SORT_KEY_GAP for line in range(0, rows, step)]
+        timings['bulk delete'] = time_call(bulk_delete_rows,
+            VcfRow.objects.filter(vcf=vcf_file, sort_key__in=deleted_keys[:deletions]))
+        last_seq = RowEvent.objects.order_by('-seq').values_list('seq', flat=True).first()
+        timings['sync cleanup'] = time_call(finish_file_sync, vcf_file.id, last_seq)
+        transaction.set_rollback(True)
+    for name, duration in timings.items():
+        logger.info(f"{name} on {rows} rows, {deletions} deletions: {duration * 1000:.1f}ms")
+    return timings
+
+def run_journal(changes):
+    """
+    Time the compaction of the change journal: every row of a table is updated
+    JOURNAL_ROUNDS times, then the events are folded and streamed as the file modify
+    task does. The rows are created in a transaction that is rolled back.
+
+    Args:
+        changes(int): The number of journaled row events
+
+    Returns:
+        timings(dict): The durations in seconds by operation
+    """
+    rows = max(changes // JOURNAL_ROUNDS, 1)
+    with transaction.atomic():
+        vcf_file = Vcf.objects.create(name='benchmark.vcf', fullpath='benchmark.vcf')
+        for start in range(0, rows, INSERT_BATCH_SIZE):
+            VcfRow.objects.bulk_create([VcfRow(vcf=vcf_file, sort_key=(line + 1) * SORT_KEY_GAP,
+                chrom='chrM', pos=line + 1, ref='A', alt='G')
+                for line in range(start, min(start + INSERT_BATCH_SIZE, rows))])
+        for pos in range(JOURNAL_ROUNDS):
+            bulk_update_rows(VcfRow.objects.filter(vcf=vcf_file), {'pos': pos + 1})
+        last_seq = RowEvent.objects.order_by('-seq').values_list('seq', flat=True).first()
+        timings = {'compaction': time_call(compact_row_events, vcf_file.id, 0, last_seq)}
+        timings['change stream'] = time_call(lambda: sum(1 for _ in iter_row_changes(
+            vcf_file.id, 0, last_seq)))
+        net = get_pending_events(vcf_file.id, 0, last_seq).count()
+        transaction.set_rollback(True)
+    for name, duration in timings.items():
+        logger.info(f"{name} of {rows * JOURNAL_ROUNDS} row events into {net}: "
+            f"{duration * 1000:.1f}ms")
+    return timings
+
+def run_segments(rows):
+    """
+    Compare the sync of a single changed row on a synthetic file of SEGMENT_CHROMOSOMES
+    chromosomes, as a single file and split in per chromosome segments, for a row of the
+    first chromosome (a full rewrite of the single file) and one near the end
+
+    Args:
+        rows(int): The number of lines of the file
+
+    Returns:
+        timings(dict): The durations in seconds by operation
+    """
+    row = ('chr1', 1, '', 'A', 'T')
+    with tempfile.TemporaryDirectory() as work_dir:
+        path = os.path.join(work_dir, 'benchmark.vcf')
+        write_sample_file(path, rows, SEGMENT_CHROMOSOMES)
+        shutil.copyfile(path, path + '.single')
+        LineIndex.get(path, default_keys)
+        LineIndex.get(path + '.single', default_keys)
+        timings = {'split': time_call(split_file, path, rows)}
+        manifest = Manifest.load(get_manifest_path(path))
+        for chrom in (1, SEGMENT_CHROMOSOMES - 3):
+            key = ((chrom - 1) * rows // SEGMENT_CHROMOSOMES + 1) * SORT_KEY_GAP
+            timings[f'chr{chrom} file sync'] = time_call(sync_file, path + '.single',
+                [(key, row)])
+            segment_path = manifest.segment_path(manifest.find_segment(key))
+            timings[f'chr{chrom} segment sync'] = time_call(sync_file, segment_path,
+                [(key, row)])
+        timings['export'] = time_call(join_segments, manifest.path, path)
+    for name, duration in timings.items():
+        logger.info(f"{name} on {rows} rows in {len(manifest.segments)} segments: "
+            f"{duration * 1000:.1f}ms")
+    return timings
+
+def sample_changes(first_line, end_line, step):
+    """
+    Get the changes of every step-th line of a range of a synthetic file, alternating
+    updates and inserts before the line
+
+    Args:
+        first_line(int): The id of the first line of the range
+        end_line(int): The id of the line after the range
+        step(int): The number of lines between two changes
+
+    Returns:
+        changes(list): (sort key, values) tuples sorted by sort key
+    """
+    first_line += -(first_line - 1) % step
+    return [(line_id * SORT_KEY_GAP - (line_id // step) % 2, ('chr1', line_id, '', 'C', 'T'))
+        for line_id in range(first_line, end_line, step)]
+
+def write_sample_part(task):
+    """
+    Write a part of a parallel rewrite of a synthetic file in a worker process
+
+    Args:
+        task(tuple): The (path, part, first line, end line, first key, end key, step) tuple
+
+    Returns:
+        written(int): The size of the part
+    """
+    path, part, first_line, end_line, first_key, end_key, step = task
+    # An insert before the first line of the next part belongs to this one
+    last_line = end_line if end_key is None else end_line + 1
+    changes = [(key, values) for key, values in sample_changes(first_line, last_line, step)
+        if (first_key is None or key >= first_key) and (end_key is None or key < end_key)]
+    return write_part(path, first_line, end_line, changes, get_part_path(path, part))
+
+def run_parallel_rewrite(changes, parts):
+    """
+    Compare the sequential rewrite of a synthetic file ten times the size of the changes with
+    a rewrite in parts written by a pool of processes, as the celery workers do
+
+    Args:
+        changes(int): The number of changes, spread over the whole file
+        parts(int): The number of parts and processes
+
+    Returns:
+        timings(dict): The durations in seconds by method
+    """
+    line_count = changes * 10
+    step = line_count // changes
+    with tempfile.TemporaryDirectory() as work_dir:
+        path = os.path.join(work_dir, 'benchmark.vcf')
+        write_sample_file(path, line_count)
+        shutil.copyfile(path, path + '.sequential')
+        timings = {'sequential': time_call(lambda: rewrite_file(
+            LineIndex.get(path + '.sequential', default_keys),
+            sample_changes(1, line_count + 1, step)))}
+        LineIndex.get(path, default_keys)
+        start, ranges = plan_parts(path, SORT_KEY_GAP - 1, parts)
+        tasks = [(path, part) + part_range + (step,) for part, part_range in enumerate(ranges)]
+        with multiprocessing.Pool(parts) as pool:
+            begin = time.perf_counter()
+            pool.map(write_sample_part, tasks)
+            timings['parts'] = time.perf_counter() - begin
+        timings['join'] = time_call(join_parts, path, start,
+            [get_part_path(path, part) for part in range(len(ranges))])
+    logger.info(f"{changes} changes on {line_count} lines: sequential "
+        f"{timings['sequential'] * 1000:.1f}ms, {parts} parallel parts "
+        f"{timings['parts'] * 1000:.1f}ms + join {timings['join'] * 1000:.1f}ms")
+    return timings
+
+class Command(BaseCommand):
+
+    """This command class is utilized by Django via manage.py"""
+
+    help = 'Benchmark command. Reports plans and timings of the API queries and file syncs'
+
+    def add_arguments(self, parser):
+        """
+        Register the benchmark arguments
+        """
+        parser.add_argument('--suite',
+            choices=['queryplans', 'filesync', 'changes', 'ordering', 'journal', 'segments',
+                'parallel'],
+            default='queryplans',
+            help='The benchmark to run')
+        parser.add_argument('--changes', type=int, default=DEFAULT_CHANGES,
+            help='How many pending changes the changes, journal and parallel suites sync')
+        parser.add_argument('--parts', type=int, default=DEFAULT_PARTS,
+            help='How many parts the parallel suite writes at once')
+        parser.add_argument('--rows', type=int, default=DEFAULT_ROWS,
+            help='How many rows the ordering and segments suites create')
+        parser.add_argument('--deletions', type=int, default=DEFAULT_DELETIONS,
+            help='How many of them the ordering suite deletes')
+        parser.add_argument('--repeat', type=int, default=DEFAULT_REPEAT,
+            help='How many times every measured operation runs')
+
+    def handle(self, *args, **options):
+        """
+        Run the selected benchmark suite
+        """
+        if options['suite'] == 'filesync':
+            run_file_sync()
+            return
+        if options['suite'] == 'changes':
+            run_change_stream(options['changes'])
+            return
+        if options['suite'] == 'ordering':
+            run_ordering(options['rows'], options['deletions'])
+            return
+        if options['suite'] == 'journal':
+            run_journal(options['changes'])
+            return
+        if options['suite'] == 'segments':
+            run_segments(options['rows'])
+            return
+        if options['suite'] == 'parallel':
+            run_parallel_rewrite(options['changes'], options['parts'])
+            return
+        slow_plans = run_query_plans(options['repeat'])
+        if slow_plans:
+            logger.error(f"Full table scans or missed indexes found for: {', '.join(slow_plans)}")
+        else:
+            logger.info("No query scans a whole table")
@@ -0,0 +1,48 @@
+"""
+This is the export command module. It concatenates the segments of a segmented managed
+file to a single VCF file, on demand.
+"""
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+from vcfApi.models import Vcf
+from vcfApi.segments import is_manifest
+from vcfApi.segments import join_segments
+from vcfApi.segments import get_export_path
+from vcfApi.tasks import release_file_sync
+from vcfApi import logger
+
+class Command(BaseCommand):
+
+    """This command class is utilized by Django via manage.py"""
+
+    help = 'Export command. Joins the segments of the managed VCF file to a single file'
+
+    def add_arguments(self, parser):
+        """
+        Register the export arguments
+        """
+        parser.add_argument('--output',
+            help='The path of the exported file, next to the segments directory by default')
+
+    def handle(self, *args, **options):
+        """
+        Join the segments while no sync is running
+        """
+        vcf_file = Vcf.objects.first()
+        if not vcf_file:
+            raise CommandError("No VCF file imported!")
+        if not is_manifest(vcf_file.fullpath):
+            self.stdout.write(f"{vcf_file.fullpath} is not segmented, it is the single file")
+            return
+        # Hold the file like a sync does, the segments must not change while they are copied
+        if not Vcf.objects.filter(id=vcf_file.id, is_updating=False).update(is_updating=True):
+            raise CommandError("The file is being synced, please try again once it is done")
+        output = options['output'] or get_export_path(vcf_file.fullpath)
+        try:
+            size = join_segments(vcf_file.fullpath, output)
+        except (OSError, ValueError) as err:
+            raise CommandError(f"Can't export {vcf_file.fullpath}: {err}")
+        finally:
+            release_file_sync(vcf_file)
+        logger.info(f"Exported VCF file:{vcf_file.id} to {output}")
+        self.stdout.write(f"Exported {size} bytes to {output}")
@@ -0,0 +1,48 @@
+"""
+This is the region reader command module. It prints the lines of a region straight from
+the BGZF compressed managed file through its tabix index, without touching the rows table.
+"""
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+from vcfApi.models import Vcf
+from vcfApi.query import parse_region
+from vcfApi.bgzf import is_bgzf
+from vcfApi.bgzf import read_region
+# The largest position a tabix index can address
+MAX_POSITION = 1 << 29
+
+class Command(BaseCommand):
+
+    """This command class is utilized by Django via manage.py"""
+
+    help = 'Region reader command. Prints the lines of a region from the compressed VCF file'
+
+    def add_arguments(self, parser):
+        """
+        Register the reader arguments
+        """
+        parser.add_argument('region', help='A chrom:start-end region, i.e. chr1:10000-20000')
+        parser.add_argument('--path',
+            help='The BGZF compressed VCF file, the managed file by default')
+
+    def handle(self, *args, **options):
+        """
+        Print the lines of the region
+        """
+        try:
+            chrom, start, end = parse_region(options['region'])
+        except ValueError as err:
+            raise CommandError(str(err))
+        path = options['path']
+        if not path:
+            vcf_file = Vcf.objects.first()
+            if not vcf_file:
+                raise CommandError("No VCF file imported!")
+            path = vcf_file.fullpath
+        try:
+            if not is_bgzf(path):
+                raise CommandError(f"{path} is not BGZF compressed! Set VCFAPI_BGZF_OUTPUT")
+            for line in read_region(path, chrom, start or 1, end or MAX_POSITION):
+                self.stdout.write(line.decode(), ending='')
+        except (OSError, ValueError) as err:
+            raise CommandError(f"Can't read {path}: {err}")
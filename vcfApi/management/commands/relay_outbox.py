@@ -0,0 +1,48 @@
+"""
+This is the outbox relay command module. It runs as a background process next to the
+Celery worker and moves the committed file change events to Celery.
+"""
+import time
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from vcfApi.outbox import relay_outbox
+from vcfApi.outbox import OUTBOX_BATCH_SIZE
+from vcfApi import logger
+DEFAULT_POLL_INTERVAL = 0.5
+
+class Command(BaseCommand):
+
+    """This command class is utilized by Django via manage.py"""
+
+    help = 'Outbox relay command. Starts the file modify tasks of the committed row changes'
+
+    def add_arguments(self, parser):
+        """
+        Register the relay arguments
+        """
+        parser.add_argument('--interval', type=float, default=DEFAULT_POLL_INTERVAL,
+            help='Seconds to wait when the outbox is empty')
+        parser.add_argument('--batch-size', type=int, default=OUTBOX_BATCH_SIZE,
+            help='Max number of events relayed per transaction')
+        parser.add_argument('--once', action='store_true',
+            help='Relay the pending events and exit')
+
+    def handle(self, *args, **options):
+        """
+        Relay the outbox events until stopped
+        """
+        logger.info('Starting the outbox relay...')
+        while True:
+            try:
+                relayed = relay_outbox(options['batch_size'])
+            except Exception as err:
+                logger.error("Error while relaying the outbox events!")
+                logger.logException(err)
+                close_old_connections()
+                relayed = 0
+            if relayed:
+                logger.info(f"Relayed {relayed} outbox events")
+            if options['once'] and relayed < options['batch_size']:
+                return
+            if relayed < options['batch_size']:
+                time.sleep(options['interval'])
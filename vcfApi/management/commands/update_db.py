@@ -3,50 +3,212 @@ This is an importer command module that, when called by the relevant script, ins
 all the VCF file data to our database.
 """
 import os
-import vcfpy
+import time
+import multiprocessing
+from collections import deque
 from django.core.management.base import BaseCommand
+from django.db import connection
+from django.db import transaction
 from vcfApi.models import Vcf
 from vcfApi.models import VcfRow
+from vcfApi.models import ImportCheckpoint
+from vcfApi.models import RowCount
 from vcfApi import logger
-MAX_BULK_LINES = 1000
+from vcfApi.cache import bump_data_version
+from vcfApi.vcfio import HEADER_PREFIX
+from vcfApi.vcfio import COLUMNS_HEADER_PREFIX
+from vcfApi.vcfio import open_vcf_stream
+from vcfApi.vcfio import is_gzipped
+from vcfApi.vcfio import file_fingerprint
+from vcfApi.vcfio import seek_line
+from vcfApi.vcfio import find_body_offset
+from vcfApi.vcfio import parse_vcf_line
+from vcfApi.vcfio import parse_vcf_chunk
+from vcfApi.vcfio import split_byte_ranges
+from vcfApi.filesync import SORT_KEY_GAP
+MAX_BULK_LINES = 50000
+# More chunks than workers keeps the pool busy when chunks parse at different speeds
+CHUNKS_PER_WORKER = 4
+# Parsed chunks waiting for the writer are held in memory, so only this many per worker
+# are submitted ahead of the one being written
+PENDING_CHUNKS_PER_WORKER = 2
+# The columns we insert per row, in the order the parser emits them
+INSERT_COLUMNS = ['sort_key', 'vcf_id', 'chrom', 'pos', 'id', 'ref', 'alt']
 
-def insert_vcf_file(vcf_filename,vcf_source_path):
+def get_insert_sql():
     """
-    This function will read the indicated VCF file via VCFpy.
-    It will then insert it to the associated database.
-    
+    Build the raw INSERT statement used for the VcfRow bulk inserts
+
+    Returns:
+        sql(str): An INSERT statement with one placeholder per inserted column
+    """
+    quote = connection.ops.quote_name
+    columns = ", ".join(quote(col) for col in INSERT_COLUMNS)
+    placeholders = ", ".join(["%s"] * len(INSERT_COLUMNS))
+    return f"INSERT INTO {quote(VcfRow._meta.db_table)} ({columns}) VALUES ({placeholders})"
+
+def iter_stream_batches(vcf_source_path,batch_size,start_offset=0):
+    """
+    Parse the VCF file sequentially from a single stream
+
+    Args:
+        vcf_source_path(str): The full path of the file
+        batch_size(int): The maximum number of rows per yielded batch
+        start_offset(int): Resume parsing from the first line starting at this byte offset
+
+    Yields:
+        batch(tuple): Parsed (chrom, pos, id, ref, alt) tuples in file order and
+                    the byte offset right after the last of them
+    """
+    has_columns_header = False
+    rows = []
+    with open_vcf_stream(vcf_source_path) as stream:
+        offset = 0
+        if start_offset > 0:
+            offset = seek_line(stream, start_offset)
+            has_columns_header = True
+        for line in stream:
+            offset += len(line)
+            if line.startswith(HEADER_PREFIX):
+                if line.startswith(COLUMNS_HEADER_PREFIX):
+                    has_columns_header = True
+                continue
+            if not has_columns_header:
+                raise ValueError("VCF body found before the #CHROM header line!")
+            fields = parse_vcf_line(line)
+            if fields is None:
+                continue
+            rows.append(fields)
+            if len(rows) >= batch_size:
+                yield rows, offset
+                rows = []
+        if len(rows) > 0:
+            yield rows, offset
+
+def iter_parallel_batches(vcf_source_path,workers,start_offset=0):
+    """
+    Parse the VCF file in byte ranges on a process pool. The results are consumed
+    in file order so the caller can number the lines as they arrive. Only a bounded
+    window of chunks is submitted ahead of the consumer, so a slow writer never lets
+    parsed chunks pile up in memory.
+
+    Args:
+        vcf_source_path(str): The full path of the file
+        workers(int): The number of parser processes
+        start_offset(int): Resume parsing from the first line starting at this byte offset
+
+    Yields:
+        batch(tuple): The parsed (chrom, pos, id, ref, alt) tuples of a range in file
+                    order and the end offset of that range
+    """
+    ranges = split_byte_ranges(vcf_source_path, workers * CHUNKS_PER_WORKER,
+        start_offset=start_offset)
+    tasks = [(vcf_source_path, start, end) for start, end in ranges]
+    logger.info(f"Parsing {len(tasks)} chunks on {workers} worker processes")
+    window = workers * PENDING_CHUNKS_PER_WORKER
+    with multiprocessing.Pool(workers) as pool:
+        pending = deque()
+        for task in tasks:
+            pending.append((task[2], pool.apply_async(parse_vcf_chunk, (task,))))
+            if len(pending) >= window:
+                end, result = pending.popleft()
+                yield result.get(), end
+        while pending:
+            end, result = pending.popleft()
+            yield result.get(), end
+
+def start_import(vcf_filename,vcf_source_path,fingerprint,resume):
+    """
+    Get the Vcf entry and checkpoint an import should write to. On resume this is
+    the checkpoint left by an interrupted import of the same file, otherwise any
+    previous data is replaced by a new Vcf entry.
+
     Args:
         vcf_filename(str): The name of the file
         vcf_source_path(str): The full path of the file
+        fingerprint(str): The fingerprint of the file
+        resume(bool): Whether we should look for a checkpoint
+
+    Returns:
+        checkpoint(ImportCheckpoint): The checkpoint of the import
     """
-    cnt=0
-    try:
-        # Open file, this will read in the header
-        reader = vcfpy.Reader.from_path(vcf_source_path)
+    if resume:
+        checkpoint = ImportCheckpoint.objects.filter(fingerprint=fingerprint).first()
+        if checkpoint:
+            logger.info(f"Resuming import after line {checkpoint.line_id} "
+                f"at byte offset {checkpoint.byte_offset}")
+            # Anything past the checkpoint was never committed, this is just a safeguard
+            VcfRow.objects.filter(vcf_id=checkpoint.vcf_id,
+                sort_key__gt=checkpoint.line_id * SORT_KEY_GAP).delete()
+            return checkpoint
+        logger.info("No checkpoint found for this file, starting a new import")
+    with transaction.atomic():
         # Create a new VCF entry. Delete the old first for this basic assignemt implementation
         Vcf.objects.all().delete()
         vcf_file = Vcf(name=vcf_filename,fullpath=vcf_source_path)
         vcf_file.save()
+        return ImportCheckpoint.objects.create(vcf=vcf_file,fingerprint=fingerprint)
+
+def insert_vcf_file(vcf_filename,vcf_source_path,batch_size=MAX_BULK_LINES,workers=1,
+        resume=False):
+    """
+    This function will stream the indicated VCF file and tokenize the columns we store.
+    It will then insert it to the associated database via raw executemany batches.
+    Every batch is committed together with a checkpoint of the byte offset it ended at,
+    so an interrupted import can be resumed. With more than one worker the parsing is
+    spread over a process pool while this process remains the single db writer.
+
+    Args:
+        vcf_filename(str): The name of the file
+        vcf_source_path(str): The full path of the file
+        batch_size(int): The number of rows written per executemany call
+        workers(int): The number of parser processes
+        resume(bool): Continue an interrupted import of the same file if possible
 
-        ritems = []
-        for record in reader:
-            cnt+=1
-            # Add record to the db also setting the correct line numbers
-            alt = [alt.value for alt in record.ALT]
-            row = VcfRow(line_id=cnt,vcf_id=vcf_file.id,chrom=record.CHROM,pos=record.POS,
-                id=";".join(record.ID),ref=record.REF,alt="".join(alt))
-            ritems.append(row)
-            if len(ritems) >= MAX_BULK_LINES:
-                VcfRow.objects.bulk_create(ritems,ignore_conflicts=True)
-                ritems = []
-        if len(ritems) > 0:
-            VcfRow.objects.bulk_create(ritems,ignore_conflicts=True)
-            ritems = []
+    Returns:
+        cnt(int): The number of lines processed
+    """
+    cnt=0
+    start = time.monotonic()
+    try:
+        if workers > 1 and is_gzipped(vcf_source_path):
+            logger.info("Compressed files can not be split in byte ranges, using a single worker")
+            workers = 1
+        # Validate the header before touching any existing data
+        find_body_offset(vcf_source_path)
+        fingerprint = file_fingerprint(vcf_source_path)
+        checkpoint = start_import(vcf_filename,vcf_source_path,fingerprint,resume)
+        line_id = checkpoint.line_id
+        if workers > 1:
+            batches = iter_parallel_batches(vcf_source_path,workers,checkpoint.byte_offset)
+        else:
+            batches = iter_stream_batches(vcf_source_path,batch_size,checkpoint.byte_offset)
+
+        insert_sql = get_insert_sql()
+        for rows, byte_offset in batches:
+            with transaction.atomic(), connection.cursor() as cursor:
+                # Add records to the db with sort keys spaced out by their line numbers
+                for i in range(0, len(rows), batch_size):
+                    ritems = [((line_id + j) * SORT_KEY_GAP, checkpoint.vcf_id) + fields
+                        for j, fields in enumerate(rows[i:i + batch_size], start=1)]
+                    cursor.executemany(insert_sql, ritems)
+                    line_id += len(ritems)
+                    cnt += len(ritems)
+                ImportCheckpoint.objects.filter(id=checkpoint.id).update(
+                    byte_offset=byte_offset,line_id=line_id)
+        # The import is complete, nothing left to resume
+        RowCount.set_total(checkpoint.vcf_id, line_id)
+        checkpoint.delete()
     except Exception as err:
         logger.error(f"Error while inserting file{vcf_source_path}!")
         logger.logException(err)
     finally:
-        logger.info(f"Final count of lines processed:{cnt}")
+        # The stored rows changed, even if the import did not complete
+        bump_data_version()
+        elapsed = time.monotonic() - start
+        rate = cnt / elapsed if elapsed > 0 else 0
+        logger.info(f"Final count of lines processed:{cnt} in {elapsed:.2f}s ({rate:.0f} rows/sec)")
+    return cnt
 
 class Command(BaseCommand):
 
@@ -54,9 +216,20 @@ class Command(BaseCommand):
 
     help = 'DB Update command. Inserts a filepath set on the VCF_FILE_SOURCE env variable'
 
+    def add_arguments(self, parser):
+        """
+        Register the optional tuning arguments of the importer
+        """
+        parser.add_argument('--batch-size', type=int, default=MAX_BULK_LINES,
+            help='Number of rows written per bulk insert statement')
+        parser.add_argument('--workers', type=int, default=1,
+            help='Number of processes parsing the file in parallel')
+        parser.add_argument('--resume', action='store_true',
+            help='Continue an interrupted import of the same file from its last checkpoint')
+
     def handle(self, *args, **options):
         """
-        This function implements the importing functionality sourcing the path 
+        This function implements the importing functionality sourcing the path
         from preset (by bash script) environment variables
         """
         logger.info('Starting DB Updater...')
@@ -68,7 +241,8 @@ class Command(BaseCommand):
             if 'VCF_FILE_NAME' in os.environ:
                 vcf_filename = os.environ['VCF_FILE_NAME']
             if vcf_source_path and os.path.isfile(vcf_source_path):
-                insert_vcf_file(vcf_filename,vcf_source_path)
+                insert_vcf_file(vcf_filename,vcf_source_path,batch_size=options['batch_size'],
+                    workers=options['workers'],resume=options['resume'])
             else:
                 logger.error('Indicated source file is invalid. Exiting...')
                 return
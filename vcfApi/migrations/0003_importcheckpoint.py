@@ -0,0 +1,25 @@
+# Generated by Django 5.2.18 on 2026-10-18 09:51
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vcfApi', '0002_alter_vcfrow_alt_alter_vcfrow_chrom_alter_vcfrow_ref'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ImportCheckpoint',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('fingerprint', models.CharField(max_length=100)),
+                ('byte_offset', models.BigIntegerField(default=0)),
+                ('line_id', models.BigIntegerField(default=0)),
+                ('date_modified', models.DateTimeField(auto_now=True)),
+                ('vcf', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, to='vcfApi.vcf')),
+            ],
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 5.2.18 on 2026-10-18 09:52
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vcfApi', '0003_importcheckpoint'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='deleted',
+            index=models.Index(fields=['line_id'], name='deleted_line_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='vcfrow',
+            index=models.Index(fields=['line_id'], name='vcfrow_line_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='vcfrow',
+            index=models.Index(fields=['chrom', 'pos'], name='vcfrow_chrom_pos_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='vcfrow',
+            index=models.Index(fields=['pos'], name='vcfrow_pos_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='vcfrow',
+            index=models.Index(fields=['id'], name='vcfrow_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='vcfrow',
+            index=models.Index(condition=models.Q(('dirty', True)), fields=['line_id'], name='vcfrow_dirty_idx'),
+        ),
+    ]
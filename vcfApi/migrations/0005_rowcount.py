@@ -0,0 +1,27 @@
+# Generated by Django 5.2.18 on 2026-10-18 09:55
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vcfApi', '0004_vcfrow_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RowCount',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('filter_key', models.CharField(blank=True, default='', max_length=250)),
+                ('count', models.BigIntegerField(default=0)),
+                ('date_modified', models.DateTimeField(auto_now=True)),
+                ('vcf', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='vcfApi.vcf')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('vcf', 'filter_key'), name='rowcount_vcf_key_uniq')],
+            },
+        ),
+    ]
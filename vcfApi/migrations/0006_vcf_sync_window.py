@@ -0,0 +1,38 @@
+# Generated by Django 5.2.18 on 2026-10-18 10:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vcfApi', '0005_rowcount'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='vcf',
+            name='coalesced_changes',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='vcf',
+            name='first_change',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='vcf',
+            name='last_change',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='vcf',
+            name='pending_changes',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='vcf',
+            name='rewrite_count',
+            field=models.BigIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 5.2.18 on 2026-10-18 10:03
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vcfApi', '0006_vcf_sync_window'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OutboxEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('changes', models.IntegerField(default=1)),
+                ('date_created', models.DateTimeField(auto_now_add=True)),
+                ('vcf', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='vcfApi.vcf')),
+            ],
+            options={
+                'ordering': ['id'],
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 10:13
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vcfApi', '0007_outboxevent'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='deleted',
+            name='line_shift',
+            field=models.BigIntegerField(null=True),
+        ),
+    ]
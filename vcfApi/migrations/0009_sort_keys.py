@@ -0,0 +1,75 @@
+# Generated by Django 5.2.18 on 2026-10-18 10:30
+
+from django.db import migrations, models
+from django.db.models import F
+
+SORT_KEY_GAP = 1 << 32
+
+
+def space_out_sort_keys(apps, schema_editor):
+    """
+    The former line ids become the sort keys the lines are imported with
+    """
+    for model_name in ('VcfRow', 'Deleted'):
+        apps.get_model('vcfApi', model_name).objects.update(sort_key=F('sort_key') * SORT_KEY_GAP)
+
+
+def restore_line_ids(apps, schema_editor):
+    """
+    Only keys that were never placed in between rows convert back to line ids
+    """
+    for model_name in ('VcfRow', 'Deleted'):
+        apps.get_model('vcfApi', model_name).objects.update(sort_key=F('sort_key') / SORT_KEY_GAP)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vcfApi', '0008_deleted_line_shift'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='deleted',
+            name='line_shift',
+        ),
+        migrations.RemoveIndex(
+            model_name='deleted',
+            name='deleted_line_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='vcfrow',
+            name='vcfrow_line_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='vcfrow',
+            name='vcfrow_dirty_idx',
+        ),
+        migrations.RenameField(
+            model_name='vcfrow',
+            old_name='line_id',
+            new_name='sort_key',
+        ),
+        migrations.RenameField(
+            model_name='deleted',
+            old_name='line_id',
+            new_name='sort_key',
+        ),
+        migrations.AlterModelOptions(
+            name='vcfrow',
+            options={'ordering': ['sort_key']},
+        ),
+        migrations.AddIndex(
+            model_name='deleted',
+            index=models.Index(fields=['sort_key'], name='deleted_sort_key_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='vcfrow',
+            index=models.Index(fields=['sort_key'], name='vcfrow_sort_key_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='vcfrow',
+            index=models.Index(condition=models.Q(('dirty', True)), fields=['sort_key'], name='vcfrow_dirty_idx'),
+        ),
+        migrations.RunPython(space_out_sort_keys, restore_line_ids),
+    ]
@@ -0,0 +1,105 @@
+# Generated by Django 5.2.18 on 2026-10-18 10:26
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+UPDATED = 2
+DELETED = 3
+VALUE_FIELDS = ('chrom', 'pos', 'id', 'ref', 'alt')
+BATCH_SIZE = 10000
+
+
+def journal_pending_changes(apps, schema_editor):
+    """
+    The dirty rows and the deleted rows not synced yet become the pending row events
+    """
+    Vcf = apps.get_model('vcfApi', 'Vcf')
+    VcfRow = apps.get_model('vcfApi', 'VcfRow')
+    Deleted = apps.get_model('vcfApi', 'Deleted')
+    RowEvent = apps.get_model('vcfApi', 'RowEvent')
+    vcf_file = Vcf.objects.first()
+    if vcf_file is None:
+        return
+    # Deleted rows do not record their file, there is only one
+    RowEvent.objects.bulk_create((RowEvent(vcf_id=vcf_file.id, row_id=row_id, sort_key=sort_key,
+        kind=DELETED) for row_id, sort_key in Deleted.objects.order_by('id')
+            .values_list('row_id', 'sort_key').iterator()), batch_size=BATCH_SIZE)
+    RowEvent.objects.bulk_create((RowEvent(vcf_id=row.vcf_id, row_id=row.row_id,
+        sort_key=row.sort_key, kind=UPDATED, **{field: getattr(row, field)
+            for field in VALUE_FIELDS}) for row in VcfRow.objects.filter(dirty=True)
+                .order_by('sort_key').iterator()), batch_size=BATCH_SIZE)
+
+
+def restore_pending_changes(apps, schema_editor):
+    """
+    The pending row events become dirty and deleted rows again
+    """
+    VcfRow = apps.get_model('vcfApi', 'VcfRow')
+    Deleted = apps.get_model('vcfApi', 'Deleted')
+    RowEvent = apps.get_model('vcfApi', 'RowEvent')
+    Deleted.objects.bulk_create((Deleted(row_id=row_id, sort_key=sort_key)
+        for row_id, sort_key in RowEvent.objects.filter(kind=DELETED)
+            .values_list('row_id', 'sort_key').iterator()), batch_size=BATCH_SIZE)
+    VcfRow.objects.filter(row_id__in=RowEvent.objects.exclude(kind=DELETED)
+        .values('row_id')).update(dirty=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vcfApi', '0009_sort_keys'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RowEvent',
+            fields=[
+                ('seq', models.BigAutoField(primary_key=True, serialize=False)),
+                ('row_id', models.BigIntegerField()),
+                ('sort_key', models.BigIntegerField(null=True)),
+                ('kind', models.PositiveSmallIntegerField(choices=[(1, 'created'), (2, 'updated'), (3, 'deleted')])),
+                ('chrom', models.CharField(max_length=50, null=True)),
+                ('pos', models.PositiveIntegerField(null=True)),
+                ('id', models.TextField(null=True)),
+                ('ref', models.CharField(max_length=100, null=True)),
+                ('alt', models.CharField(max_length=100, null=True)),
+            ],
+            options={
+                'ordering': ['seq'],
+            },
+        ),
+        migrations.AddField(
+            model_name='vcf',
+            name='synced_seq',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='rowevent',
+            name='vcf',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='vcfApi.vcf'),
+        ),
+        migrations.AddIndex(
+            model_name='rowevent',
+            index=models.Index(fields=['vcf', 'seq'], name='rowevent_vcf_seq_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='rowevent',
+            index=models.Index(fields=['row_id', 'seq'], name='rowevent_row_seq_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='rowevent',
+            index=models.Index(condition=models.Q(('kind', 3)), fields=['sort_key'], name='rowevent_deleted_key_idx'),
+        ),
+        migrations.RunPython(journal_pending_changes, restore_pending_changes),
+        migrations.DeleteModel(
+            name='Deleted',
+        ),
+        migrations.RemoveIndex(
+            model_name='vcfrow',
+            name='vcfrow_dirty_idx',
+        ),
+        migrations.RemoveField(
+            model_name='vcfrow',
+            name='dirty',
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.2.18 on 2026-10-18 10:30
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vcfApi', '0010_row_events'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='rowevent',
+            name='date_created',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.AddField(
+            model_name='vcf',
+            name='pruned_seq',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AddIndex(
+            model_name='rowevent',
+            index=models.Index(condition=models.Q(('kind', 3)), fields=['date_created'], name='rowevent_deleted_date_idx'),
+        ),
+    ]
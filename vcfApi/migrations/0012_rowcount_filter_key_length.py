@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 10:52
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vcfApi', '0011_change_feed'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='rowcount',
+            name='filter_key',
+            field=models.CharField(blank=True, default='', max_length=266),
+        ),
+    ]
@@ -0,0 +1,43 @@
+# Generated by Django 5.2.18 on 2026-10-18 11:08
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vcfApi', '0012_rowcount_filter_key_length'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='rowevent',
+            name='rowevent_deleted_key_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='vcfrow',
+            name='vcfrow_chrom_pos_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='vcfrow',
+            name='vcfrow_sort_key_idx',
+        ),
+        migrations.AlterField(
+            model_name='vcfrow',
+            name='vcf',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to='vcfApi.vcf'),
+        ),
+        migrations.AddIndex(
+            model_name='rowevent',
+            index=models.Index(condition=models.Q(('kind', 3)), fields=['vcf', 'sort_key'], name='rowevent_deleted_key_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='vcfrow',
+            index=models.Index(fields=['vcf', 'sort_key'], name='vcfrow_vcf_sort_key_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='vcfrow',
+            index=models.Index(fields=['vcf', 'chrom', 'pos'], name='vcfrow_vcf_chrom_pos_idx'),
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 5.2.18 on 2026-10-18 11:13
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vcfApi', '0013_vcfrow_vcf_indexes'),
+    ]
+
+    operations = [
+        migrations.AddConstraint(
+            model_name='vcfrow',
+            constraint=models.UniqueConstraint(fields=('vcf', 'sort_key'), name='vcfrow_vcf_sort_key_uniq'),
+        ),
+        migrations.RemoveIndex(
+            model_name='vcfrow',
+            name='vcfrow_vcf_sort_key_idx',
+        ),
+    ]
@@ -1,8 +1,40 @@
 """
 Contains the Django ORM models
 """
+import datetime
+import itertools
+import collections
+from django.conf import settings
 from django.db import models
 from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+from vcfApi.filesync import SORT_KEY_GAP
+# The filters whose counts are cached. These take few distinct values so their
+# counts are expensive to compute, while i.e. pos or id filters are cheap index searches.
+COUNTED_FIELDS = ('chrom', 'ref', 'alt')
+FILTER_KEY_DEL = '&'
+FILTER_VALUE_DEL = '='
+# Filtered counters are only stored for values found in the data and up to this many keys,
+# so arbitrary query strings can't grow the table or slow down every row write
+MAX_FILTER_COUNTERS = 1000
+# The most counter keys a single statement adjusts, within the SQLite variable limit
+COUNTER_BATCH_SIZE = 500
+# Seconds without new changes before a file is rewritten, and the longest a change may wait
+DEFAULT_SYNC_DEBOUNCE = 1.0
+DEFAULT_SYNC_MAX_LATENCY = 30.0
+# Seconds the deletion events are kept for the change feed after they are applied to the file
+DEFAULT_CHANGES_RETENTION = 7 * 24 * 3600
+# Keep the managed file BGZF compressed with a tabix index
+DEFAULT_BGZF_OUTPUT = False
+# Split the managed file in segments synced in parallel, of at most this many lines each
+DEFAULT_SEGMENTED_FILES = False
+DEFAULT_SEGMENT_LINES = 1000000
+# Rewrites of files from this size on are written in parts by parallel subtasks
+DEFAULT_SYNC_PARTS = 1
+DEFAULT_PARALLEL_SYNC_SIZE = 256 * 1024 * 1024
+# The largest step between the sort keys of rows placed one after the other
+SORT_KEY_STEP = 1 << 16
 
 class Vcf(models.Model):
     """
@@ -16,6 +48,17 @@ class Vcf(models.Model):
     fullpath = models.TextField()
     needs_update = models.BooleanField(blank=True,default=False)
     is_updating = models.BooleanField(blank=True,default=False)
+    # The row changes waiting for the next file rewrite
+    pending_changes = models.IntegerField(default=0)
+    first_change = models.DateTimeField(null=True, blank=True)
+    last_change = models.DateTimeField(null=True, blank=True)
+    # The number of rewrites and of the changes they covered, their ratio is the coalescing rate
+    rewrite_count = models.BigIntegerField(default=0)
+    coalesced_changes = models.BigIntegerField(default=0)
+    # The file-sync watermark: the sequence of the last row event applied to the file
+    synced_seq = models.BigIntegerField(default=0)
+    # The sequence of the last pruned deletion event, the change feed can't resume before it
+    pruned_seq = models.BigIntegerField(default=0)
     date_modified = models.DateTimeField(auto_now=True)
 
     def set_updating(self, value):
@@ -55,6 +98,103 @@ class Vcf(models.Model):
                 vcf.save()
         return vcf
 
+    @staticmethod
+    def get_sync_window():
+        """
+        Get the debounce window and the max latency of the file rewrites from the settings
+
+        Returns:
+            (debounce, max_latency): The durations as timedeltas
+        """
+        debounce = getattr(settings, 'VCFAPI_SYNC_DEBOUNCE', DEFAULT_SYNC_DEBOUNCE)
+        max_latency = getattr(settings, 'VCFAPI_SYNC_MAX_LATENCY', DEFAULT_SYNC_MAX_LATENCY)
+        return datetime.timedelta(seconds=debounce), datetime.timedelta(seconds=max_latency)
+
+    @staticmethod
+    def use_bgzf_output():
+        """
+        Check the settings to see if the managed file is kept BGZF compressed
+
+        Returns:
+            compress(bool): True to write BGZF output with a tabix index
+        """
+        return getattr(settings, 'VCFAPI_BGZF_OUTPUT', DEFAULT_BGZF_OUTPUT)
+
+    @staticmethod
+    def use_segments():
+        """
+        Check the settings to see if the managed file is split in segments
+
+        Returns:
+            segmented(bool): True to keep the file as segments with a manifest
+        """
+        return getattr(settings, 'VCFAPI_SEGMENTED_FILES', DEFAULT_SEGMENTED_FILES)
+
+    @staticmethod
+    def get_segment_lines():
+        """
+        Get the most lines of a segment from the settings
+
+        Returns:
+            lines(int): The line count
+        """
+        return getattr(settings, 'VCFAPI_SEGMENT_LINES', DEFAULT_SEGMENT_LINES)
+
+    @staticmethod
+    def get_sync_parts():
+        """
+        Get how many parallel parts a large file rewrite is split in, and the file size
+        from which it is split, from the settings
+
+        Returns:
+            (parts, min_size): The number of parts, 1 for sequential rewrites, and the size
+        """
+        return (getattr(settings, 'VCFAPI_SYNC_PARTS', DEFAULT_SYNC_PARTS),
+            getattr(settings, 'VCFAPI_PARALLEL_SYNC_SIZE', DEFAULT_PARALLEL_SYNC_SIZE))
+
+    def get_sync_delay(self, now=None):
+        """
+        Get how long the rewrite of the pending changes should wait. Every new change
+        restarts the debounce window, but the wait never exceeds the max latency
+        counted from the first pending change.
+
+        Args:
+            now(datetime): The current time
+
+        Returns:
+            delay(float): The seconds to wait, 0 if the file should be rewritten now
+        """
+        if not self.first_change or not self.last_change:
+            return 0
+        now = now or timezone.now()
+        debounce, max_latency = self.get_sync_window()
+        delay = min(self.last_change + debounce, self.first_change + max_latency) - now
+        return max(delay.total_seconds(), 0)
+
+    def claim_changes(self):
+        """
+        Atomically take over the pending changes before a file rewrite.
+        Changes requested after this point flag the file for another rewrite.
+
+        Returns:
+            changes(int): The number of changes the rewrite covers
+        """
+        with transaction.atomic():
+            vcf = Vcf.objects.select_for_update().get(id=self.id)
+            Vcf.objects.filter(id=self.id).update(needs_update=False, pending_changes=0,
+                first_change=None, last_change=None)
+        return vcf.pending_changes
+
+    def record_rewrite(self, changes):
+        """
+        Update the coalescing metrics after a file rewrite
+
+        Args:
+            changes(int): The number of changes the rewrite covered
+        """
+        Vcf.objects.filter(id=self.id).update(rewrite_count=F('rewrite_count') + 1,
+            coalesced_changes=F('coalesced_changes') + changes)
+
 class VcfRow(models.Model):
     """
     This Model represents a row/line in a VCF file.
@@ -62,28 +202,539 @@ class VcfRow(models.Model):
     class Meta:
         """
         Model Meta class.
-        Sets the ordering for now.
+        Sets the ordering and the indexes backing the API query patterns. The queries are
+        scoped to a file, so the list ordering and the placement of new rows search
+        (vcf, sort_key) and the chrom/pos filters and regions (vcf, chrom, pos), both also
+        serve the lookups by file. The pos filters and the id lookups of the detail views
+        have their own. The (vcf, sort_key) index is unique, two inserts can never place
+        rows at the same sort key of a file.
         """
-        ordering = ["line_id"]
+        ordering = ["sort_key"]
+        constraints = [
+            models.UniqueConstraint(fields=["vcf", "sort_key"], name="vcfrow_vcf_sort_key_uniq"),
+        ]
+        indexes = [
+            models.Index(fields=["vcf", "chrom", "pos"], name="vcfrow_vcf_chrom_pos_idx"),
+            models.Index(fields=["pos"], name="vcfrow_pos_idx"),
+            models.Index(fields=["id"], name="vcfrow_id_idx"),
+        ]
 
     row_id = models.BigAutoField(primary_key=True)
-    line_id = models.BigIntegerField(null=True)
+    # A stable, sparse ordering key. The physical line of a row is only known to the
+    # line index of the file (see vcfApi.filesync), inserts and deletes never renumber rows
+    sort_key = models.BigIntegerField(null=True)
     # date_created = models.DateTimeField(auto_now_add=True)
-    vcf = models.ForeignKey(Vcf, on_delete=models.CASCADE)
+    # The (vcf, ...) indexes cover the lookups by file
+    vcf = models.ForeignKey(Vcf, on_delete=models.CASCADE, db_index=False)
     chrom = models.CharField(max_length=50)
     pos = models.PositiveIntegerField()
     id = models.TextField(null=True)
     ref = models.CharField(max_length=100)
     alt = models.CharField(max_length=100,default=None)
-    dirty = models.BooleanField(blank=True,default=False)
     # date_modified = models.DateTimeField(auto_now=True)
 
-class Deleted(models.Model):
+    def save(self, *args, **kwargs):
+        """
+        Save the row in a transaction, so the change event and file update the post_save
+        signal records are committed with it or not at all
+        """
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+
+    def delete(self, *args, **kwargs):
+        """
+        Delete the row in a transaction, so the change event and file update the post_delete
+        signal records are committed with it or not at all
+        """
+        with transaction.atomic():
+            return super().delete(*args, **kwargs)
+
+    @staticmethod
+    def last_sort_key(vcf_id):
+        """
+        Get the sort key of the last row of a file, counting the deleted rows that are not
+        synced yet, so new rows never share a sort key with a pending deletion
+
+        Args:
+            vcf_id(int): The file id
+
+        Returns:
+            sort_key(int): The sort key, 0 if there are no rows
+        """
+        last_row = VcfRow.objects.filter(vcf_id=vcf_id).aggregate(
+            last=models.Max('sort_key'))['last'] or 0
+        last_deleted = RowEvent.deletions().filter(vcf_id=vcf_id).aggregate(
+            last=models.Max('sort_key'))['last'] or 0
+        return max(last_row, last_deleted)
+
+    @staticmethod
+    def next_sort_key(vcf_id, sort_key):
+        """
+        Get the first sort key of a file after one, counting the deleted rows that are
+        not synced yet
+
+        Args:
+            vcf_id(int): The file id
+            sort_key(int): The sort key
+
+        Returns:
+            sort_key(int): The next sort key, None if there is none
+        """
+        next_row = VcfRow.objects.filter(vcf_id=vcf_id, sort_key__gt=sort_key).aggregate(
+            next=models.Min('sort_key'))['next']
+        next_deleted = RowEvent.deletions().filter(vcf_id=vcf_id, sort_key__gt=sort_key) \
+            .aggregate(next=models.Min('sort_key'))['next']
+        return min((key for key in (next_row, next_deleted) if key is not None), default=None)
+
+    @staticmethod
+    def sort_key_between(previous, following):
+        """
+        Get a sort key for a row placed between two others. Rows placed one after the
+        other take small steps so the gap fits many of them, otherwise the gap is halved.
+
+        Args:
+            previous(int): The sort key of the row before, 0 for the start
+            following(int): The sort key of the row after, None for the end
+
+        Returns:
+            sort_key(int): The sort key or None if there is no room left between the rows
+        """
+        if following is None:
+            return previous + SORT_KEY_GAP
+        step = min((following - previous) // 2, SORT_KEY_STEP)
+        return previous + step if step else None
+
+    @staticmethod
+    def sorted_sort_key(vcf_id, chrom, pos):
+        """
+        Get the sort key that places a new row of a file in genomic order: before the first
+        row of the chromosome with a greater position, after the last row of the chromosome
+        if there is none and at the end for a new chromosome. Each lookup is an index search.
+
+        Args:
+            vcf_id(int): The file id
+            chrom(str): The chromosome of the new row
+            pos(int): The position of the new row
+
+        Returns:
+            sort_key(int): The sort key or None if there is no room left at the position
+        """
+        rows = VcfRow.objects.filter(vcf_id=vcf_id)
+        following = rows.filter(chrom=chrom, pos__gt=pos).order_by('pos', 'sort_key') \
+            .values_list('sort_key', flat=True).first()
+        if following is None:
+            previous = rows.filter(chrom=chrom).order_by('-pos', '-sort_key') \
+                .values_list('sort_key', flat=True).first()
+            if previous is None:
+                return VcfRow.last_sort_key(vcf_id) + SORT_KEY_GAP
+            return VcfRow.sort_key_between(previous, VcfRow.next_sort_key(vcf_id, previous))
+        previous = rows.filter(sort_key__lt=following).aggregate(
+            previous=models.Max('sort_key'))['previous'] or 0
+        previous_deleted = RowEvent.deletions().filter(vcf_id=vcf_id, sort_key__lt=following) \
+            .aggregate(previous=models.Max('sort_key'))['previous'] or 0
+        return VcfRow.sort_key_between(max(previous, previous_deleted), following)
+
+class RowEvent(models.Model):
     """
-    This Model represents a deleted row/line in a VCF file.
-    The relevant Celery task will use it to modify the source file allowing the
-    main table to be cleared immediatelly. After the file is modified the lines on 
-    this table will be deleted.
+    This Model represents a change of a row, in the append-only journal of the row
+    changes. The seq primary key orders the events of all the rows, every write appends
+    events in the same transaction as the row change and the file modify task applies the
+    ones after the file-sync watermark of the Vcf (Vcf.synced_seq). An event carries the
+    row values it left behind, so the file is synced without reading the rows.
+    Applied events stay in the journal for the change feed: only the last event of every row
+    is kept and deletions are pruned after a retention period.
     """
-    row_id = models.BigIntegerField(null=True)
-    line_id = models.BigIntegerField(null=True)
\ No newline at end of file
+    class Meta:
+        """
+        Model Meta class.
+        The file modify task and the change feed read the events after a sequence, the
+        compaction looks up the later events of a row, the placement of new rows the
+        deletions by sort key and the pruning the deletions by age.
+        """
+        ordering = ["seq"]
+        indexes = [
+            models.Index(fields=["vcf", "seq"], name="rowevent_vcf_seq_idx"),
+            models.Index(fields=["row_id", "seq"], name="rowevent_row_seq_idx"),
+            models.Index(fields=["vcf", "sort_key"], condition=models.Q(kind=3),
+                name="rowevent_deleted_key_idx"),
+            models.Index(fields=["date_created"], condition=models.Q(kind=3),
+                name="rowevent_deleted_date_idx"),
+        ]
+
+    CREATED = 1
+    UPDATED = 2
+    DELETED = 3
+    KINDS = [(CREATED, 'created'), (UPDATED, 'updated'), (DELETED, 'deleted')]
+    # The row values an event records
+    VALUE_FIELDS = ('chrom', 'pos', 'id', 'ref', 'alt')
+
+    seq = models.BigAutoField(primary_key=True)
+    vcf = models.ForeignKey(Vcf, on_delete=models.CASCADE)
+    row_id = models.BigIntegerField()
+    sort_key = models.BigIntegerField(null=True)
+    kind = models.PositiveSmallIntegerField(choices=KINDS)
+    # The values of the row after the change, empty for a deletion
+    chrom = models.CharField(max_length=50, null=True)
+    pos = models.PositiveIntegerField(null=True)
+    id = models.TextField(null=True)
+    ref = models.CharField(max_length=100, null=True)
+    alt = models.CharField(max_length=100, null=True)
+    date_created = models.DateTimeField(default=timezone.now)
+
+    @classmethod
+    def from_row(cls, row, kind):
+        """
+        Build the event of a row change
+
+        Args:
+            row(VcfRow): The changed row
+            kind(int): CREATED, UPDATED or DELETED
+
+        Returns:
+            event(RowEvent): The unsaved event
+        """
+        values = {} if kind == cls.DELETED else {field: getattr(row, field)
+            for field in cls.VALUE_FIELDS}
+        return cls(vcf_id=row.vcf_id, row_id=row.row_id, sort_key=row.sort_key, kind=kind,
+            **values)
+
+    @classmethod
+    def record_rows(cls, rows, kind):
+        """
+        Append the events of a number of changed rows with a bulk insert
+
+        Args:
+            rows(list): The changed rows
+            kind(int): CREATED, UPDATED or DELETED
+        """
+        cls.objects.bulk_create([cls.from_row(row, kind) for row in rows])
+
+    @classmethod
+    def deletions(cls):
+        """
+        Get the deletions still in the journal, the ones not applied to the file yet
+        and the ones kept for the change feed
+
+        Returns:
+            events(QuerySet): The deletion events
+        """
+        return cls.objects.filter(kind=cls.DELETED)
+
+    @staticmethod
+    def get_retention():
+        """
+        Get how long the deletion events are kept for the change feed from the settings
+
+        Returns:
+            retention(timedelta): The retention period
+        """
+        return datetime.timedelta(seconds=getattr(settings, 'VCFAPI_CHANGES_RETENTION',
+            DEFAULT_CHANGES_RETENTION))
+
+    @classmethod
+    def prune_deletions(cls, vcf_id, synced_seq, now=None):
+        """
+        Remove the deletion events of a file that were applied to it and are older than
+        the retention period, recording the last removed sequence as the oldest version
+        the change feed can resume from
+
+        Args:
+            vcf_id(int): The VCF file entities int PK on our DB.
+            synced_seq(int): The file-sync watermark
+            now(datetime): The current time
+
+        Returns:
+            removed(int): The number of removed events
+        """
+        cutoff = (now or timezone.now()) - cls.get_retention()
+        expired = cls.deletions().filter(vcf_id=vcf_id, seq__lte=synced_seq,
+            date_created__lt=cutoff)
+        last_seq = expired.aggregate(last=models.Max('seq'))['last']
+        if last_seq is None:
+            return 0
+        with transaction.atomic():
+            Vcf.objects.filter(id=vcf_id, pruned_seq__lt=last_seq).update(pruned_seq=last_seq)
+            removed, _ = expired.filter(seq__lte=last_seq).delete()
+        return removed
+
+class ImportCheckpoint(models.Model):
+    """
+    This Model records the progress of a running VCF import.
+    It is updated in the same transaction as every committed batch of rows, so
+    an interrupted import can continue from the byte offset after its last batch.
+    The checkpoint is removed when the import completes.
+    """
+    vcf = models.OneToOneField(Vcf, on_delete=models.CASCADE)
+    fingerprint = models.CharField(max_length=100)
+    byte_offset = models.BigIntegerField(default=0)
+    line_id = models.BigIntegerField(default=0)
+    date_modified = models.DateTimeField(auto_now=True)
+
+class RowCount(models.Model):
+    """
+    This Model caches the number of rows of a Vcf, either in total (empty filter_key)
+    or for a combination of exact filters on COUNTED_FIELDS i.e. "chrom=chr1&ref=G".
+    Counters are adjusted on row creation and deletion, filtered counters are dropped
+    on row updates (and recomputed on their next use) and a periodic task reconciles them.
+    A filtered counter is only stored when it matches rows and MAX_FILTER_COUNTERS
+    is not reached, other counts are computed on every request.
+    """
+    class Meta:
+        """
+        Model Meta class.
+        One counter per file and filter combination.
+        """
+        constraints = [
+            models.UniqueConstraint(fields=["vcf", "filter_key"], name="rowcount_vcf_key_uniq"),
+        ]
+
+    vcf = models.ForeignKey(Vcf, on_delete=models.CASCADE)
+    # Long enough for every counted field at its longest, i.e. "alt=...&chrom=...&ref=..."
+    filter_key = models.CharField(max_length=len(FILTER_KEY_DEL) * (len(COUNTED_FIELDS) - 1)
+        + sum(len(field) + len(FILTER_VALUE_DEL) + VcfRow._meta.get_field(field).max_length
+        for field in COUNTED_FIELDS), blank=True, default='')
+    count = models.BigIntegerField(default=0)
+    date_modified = models.DateTimeField(auto_now=True)
+
+    @staticmethod
+    def get_filter_key(filters):
+        """
+        Build the normalized key of a filters dict
+
+        Args:
+            filters(dict): Exact match filters i.e. as returned by query.filter_query
+
+        Returns:
+            key(str): The key or None if the filters can not be counted
+        """
+        if any(field not in COUNTED_FIELDS for field in filters):
+            return None
+        # A value longer than its column matches no row and would not fit in the key
+        if any(len(str(value)) > VcfRow._meta.get_field(field).max_length
+                for field, value in filters.items()):
+            return None
+        return FILTER_KEY_DEL.join(f"{field}{FILTER_VALUE_DEL}{filters[field]}"
+            for field in sorted(filters))
+
+    @staticmethod
+    def parse_filter_key(key):
+        """
+        Get the filters dict back from a key
+
+        Args:
+            key(str): A key built by get_filter_key
+
+        Returns:
+            filters(dict): The exact match filters
+        """
+        if not key:
+            return {}
+        return dict(part.split(FILTER_VALUE_DEL, 1) for part in key.split(FILTER_KEY_DEL))
+
+    @classmethod
+    def get_count(cls, filters):
+        """
+        Get the number of rows matching the filters over all files, computing and
+        storing the counters the first time a filter combination is asked for.
+        Filter combinations that match no rows or exceed the cap are not stored.
+
+        Args:
+            filters(dict): Exact match filters i.e. as returned by query.filter_query
+
+        Returns:
+            count(int): The number of rows or None if the filters can not be counted
+        """
+        key = cls.get_filter_key(filters)
+        if key is None:
+            return None
+        counts = list(cls.objects.filter(filter_key=key).values_list('count', flat=True))
+        if counts:
+            return sum(counts)
+        counts = cls.count_rows(key)
+        if cls.can_store(key, counts):
+            cls.store(key, counts)
+        return sum(counts.values())
+
+    @classmethod
+    def can_store(cls, key, counts):
+        """
+        Check if the counters of a filter key are worth storing. The total always is,
+        a filtered counter only when it matches rows and the cap is not reached.
+
+        Args:
+            key(str): The filter key
+            counts(dict): The counts by file id
+
+        Returns:
+            store(bool): True if the counters should be stored
+        """
+        if not key:
+            return True
+        if not any(counts.values()):
+            return False
+        stored = cls.objects.exclude(filter_key='').values('filter_key').distinct().count()
+        return stored < MAX_FILTER_COUNTERS
+
+    @classmethod
+    def count_rows(cls, key, vcf_id=None):
+        """
+        Count the rows of a filter key with a COUNT query
+
+        Args:
+            key(str): The filter key
+            vcf_id(int): Only count the rows of this file
+
+        Returns:
+            counts(dict): The counts by file id
+        """
+        vcf_ids = [vcf_id] if vcf_id else list(Vcf.objects.values_list('id', flat=True))
+        counts = dict.fromkeys(vcf_ids, 0)
+        rows = VcfRow.objects.filter(vcf_id__in=vcf_ids, **cls.parse_filter_key(key))
+        for row in rows.values('vcf_id').annotate(total=models.Count('row_id')).order_by():
+            counts[row['vcf_id']] = row['total']
+        return counts
+
+    @classmethod
+    def refresh(cls, key, vcf_id=None):
+        """
+        Recompute the counters of a filter key with a COUNT query
+
+        Args:
+            key(str): The filter key
+            vcf_id(int): Only recompute the counter of this file
+
+        Returns:
+            counts(dict): The new counts by file id
+        """
+        counts = cls.count_rows(key, vcf_id)
+        cls.store(key, counts)
+        return counts
+
+    @classmethod
+    def store(cls, key, counts):
+        """
+        Store the counters of a filter key
+
+        Args:
+            key(str): The filter key
+            counts(dict): The counts by file id
+        """
+        for vid, count in counts.items():
+            cls.objects.update_or_create(vcf_id=vid, filter_key=key, defaults={'count': count})
+
+    @classmethod
+    def set_total(cls, vcf_id, count):
+        """
+        Store the total number of rows of a file i.e. after an import
+
+        Args:
+            vcf_id(int): The file id
+            count(int): The number of rows
+        """
+        cls.objects.update_or_create(vcf_id=vcf_id, filter_key='', defaults={'count': count})
+
+    @classmethod
+    def add_row(cls, row, delta=1):
+        """
+        Adjust the counters a created (or deleted, with a negative delta) row matches
+
+        Args:
+            row(VcfRow): The row
+            delta(int): The amount the counters change by
+        """
+        cls.add_rows(row.vcf_id, [row], delta=delta)
+
+    @classmethod
+    def get_row_keys(cls, row):
+        """
+        Get the keys of every counter a row matches: the total and every combination of
+        its COUNTED_FIELDS values. A null value matches no exact filter.
+
+        Args:
+            row(VcfRow): The row
+
+        Returns:
+            keys(list): The filter keys
+        """
+        values = {field: getattr(row, field, None) for field in COUNTED_FIELDS}
+        fields = [field for field in COUNTED_FIELDS if values[field] is not None]
+        keys = (cls.get_filter_key({field: values[field] for field in combination})
+            for size in range(len(fields) + 1)
+            for combination in itertools.combinations(fields, size))
+        return [key for key in keys if key is not None]
+
+    @classmethod
+    def add_rows(cls, vcf_id, rows, delta=1):
+        """
+        Adjust the counters of a file for a number of created (or deleted) rows. Only the
+        counters the rows match are looked up, the ones matching the same number of rows
+        are adjusted together with a filter_key IN (...) update.
+
+        Args:
+            vcf_id(int): The file id
+            rows(list): The rows
+            delta(int): The amount the counters change by per matching row
+        """
+        matching = collections.Counter(key for row in rows for key in cls.get_row_keys(row))
+        keys_by_matching = collections.defaultdict(list)
+        for key, count in matching.items():
+            keys_by_matching[count].append(key)
+        for count, keys in keys_by_matching.items():
+            for start in range(0, len(keys), COUNTER_BATCH_SIZE):
+                cls.objects.filter(vcf_id=vcf_id,
+                    filter_key__in=keys[start:start + COUNTER_BATCH_SIZE]) \
+                    .update(count=F('count') + delta * count)
+
+    @classmethod
+    def remove_row(cls, row):
+        """
+        Adjust the counters a deleted row matches
+
+        Args:
+            row(VcfRow): The row
+        """
+        cls.add_row(row, delta=-1)
+
+    @classmethod
+    def invalidate(cls, vcf_id):
+        """
+        Drop the filtered counters of a file after its rows were modified.
+        The total is not affected by modifications.
+
+        Args:
+            vcf_id(int): The file id
+        """
+        cls.objects.filter(vcf_id=vcf_id).exclude(filter_key='').delete()
+
+    @classmethod
+    def reconcile(cls):
+        """
+        Recompute every stored counter, correcting any drift
+
+        Returns:
+            fixed(int): The number of counters that had drifted
+        """
+        fixed = 0
+        for key in set(cls.objects.values_list('filter_key', flat=True)):
+            stored = dict(cls.objects.filter(filter_key=key).values_list('vcf_id', 'count'))
+            counts = cls.refresh(key)
+            fixed += sum(1 for vid, count in counts.items() if stored.get(vid) != count)
+        return fixed
+
+class OutboxEvent(models.Model):
+    """
+    This Model represents a row change that the file of a Vcf has to pick up.
+    Events are written in the same transaction as the row changes, so a rolled back
+    change never reaches the file, and are relayed to Celery by the outbox relay
+    process, keeping the broker out of the write requests.
+    """
+    class Meta:
+        """
+        Model Meta class.
+        The relay reads the events in id order.
+        """
+        ordering = ["id"]
+
+    vcf = models.ForeignKey(Vcf, on_delete=models.CASCADE)
+    changes = models.IntegerField(default=1)
+    date_created = models.DateTimeField(auto_now_add=True)
@@ -0,0 +1,72 @@
+"""
+This module contains the outbox relay. It moves the committed change events of the
+outbox table to the Vcf files in batches and starts the Celery file modify task,
+so the write requests never wait on the broker.
+"""
+from django.db import transaction
+from django.db.models import F
+from django.db.models import Max
+from django.db.models import Min
+from django.db.models import Sum
+from django.db.models import Value
+from django.db.models.functions import Coalesce
+from vcfApi.models import Vcf
+from vcfApi.models import OutboxEvent
+from vcfApi.tasks import modify_file_rows
+from vcfApi import logger
+OUTBOX_BATCH_SIZE = 1000
+
+def schedule_file_update(vcf_id):
+    """
+    Start the file modify task after the debounce window, unless one is already
+    scheduled or running (it will pick up the new changes).
+
+    Args:
+        vcf_id(int): The VCF file entities int PK on our DB.
+
+    Returns:
+        scheduled(bool): True if a task was started
+    """
+    # Only the caller that flips is_updating schedules the task
+    if not Vcf.objects.filter(id=vcf_id, is_updating=False).update(is_updating=True):
+        return False
+    debounce, _ = Vcf.get_sync_window()
+    try:
+        modify_file_rows.apply_async((vcf_id,), countdown=debounce.total_seconds())
+    except Exception as err:
+        logger.error("Error while trying to start the Celery file modify task!")
+        logger.logException(err)
+        Vcf.objects.filter(id=vcf_id).update(is_updating=False)
+        return False
+    return True
+
+def relay_outbox(batch_size=OUTBOX_BATCH_SIZE):
+    """
+    Relay a batch of outbox events. The events of every file are folded into its
+    pending changes with one UPDATE and deleted in the same transaction, then the
+    file modify task is scheduled for the files that are not being updated already.
+
+    Args:
+        batch_size(int): The max number of events to relay
+
+    Returns:
+        relayed(int): The number of relayed events
+    """
+    with transaction.atomic():
+        event_ids = list(OutboxEvent.objects.select_for_update()
+            .values_list('id', flat=True)[:batch_size])
+        if not event_ids:
+            return 0
+        events = OutboxEvent.objects.filter(id__in=event_ids)
+        summary = events.order_by().values('vcf_id').annotate(total=Sum('changes'),
+            first=Min('date_created'), last=Max('date_created'))
+        vcf_ids = []
+        for item in summary:
+            Vcf.objects.filter(id=item['vcf_id']).update(needs_update=True,
+                pending_changes=F('pending_changes') + item['total'], last_change=item['last'],
+                first_change=Coalesce('first_change', Value(item['first'])))
+            vcf_ids.append(item['vcf_id'])
+        events.delete()
+    for vcf_id in vcf_ids:
+        schedule_file_update(vcf_id)
+    return len(event_ids)
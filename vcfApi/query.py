@@ -2,12 +2,17 @@
 This module contains HTTP Request related helper functions. 
 Mainly to be used by the views.
 """
+import re
 import collections
 import urllib
+from django.db.models import Q
 
 QUERY_STRING = 'QUERY_STRING'
 QSTRING_DEL = '&'
 FILTER_DEL = '='
+REGION_PARAM = 'region'
+# i.e. chr7, chr7:117480000 or chr7:117,480,000-117,670,000
+REGION_FORMAT = re.compile(r'^(?P<chrom>[^:\s]+)(:(?P<start>[\d,]+)(-(?P<end>[\d,]+))?)?$')
 
 def filter_query(metadict,filterset):
     """
@@ -51,3 +56,83 @@ def filter_query(metadict,filterset):
                 my_filters[pfilter[0]] = value
 
     return my_filters
+
+def get_query_values(metadict,name):
+    """
+    Get all the values of a (possibly repeated) parameter from a request.META querystring
+
+    Args:
+        metadict(dict): The request's META dict that contains the querystring
+        name(str): The parameter name
+
+    Returns:
+        values(list): The non empty values of the parameter in querystring order
+    """
+    if not metadict:
+        return []
+    querystring = metadict.get(QUERY_STRING)
+    if not querystring:
+        return []
+    values = []
+    for part in querystring.split(QSTRING_DEL):
+        pfilter = part.strip().split(FILTER_DEL, 1)
+        if len(pfilter) > 1 and pfilter[0] == name:
+            value = urllib.parse.unquote_plus(pfilter[1]).strip()
+            if len(value) > 0:
+                values.append(value)
+    return values
+
+def parse_region(region):
+    """
+    Parse a samtools style region string. Positions are 1-based and inclusive,
+    a missing end means up to the end of the chromosome.
+
+    Args:
+        region(str): A region string i.e. chr7:117,480,000-117,670,000
+
+    Returns:
+        region(tuple): A (chrom, start, end) tuple where start and end may be None
+
+    Raises:
+        ValueError: If the region string is not valid
+    """
+    m = REGION_FORMAT.match(region.strip())
+    if not m:
+        raise ValueError(f"Region {region} not valid! Please use the chrom:start-end format")
+    start = end = None
+    if m.group('start'):
+        start = int(m.group('start').replace(',', ''))
+    if m.group('end'):
+        end = int(m.group('end').replace(',', ''))
+    if start is not None and end is not None and end < start:
+        raise ValueError(f"Region {region} not valid! The end is before the start")
+    return m.group('chrom'), start, end
+
+def region_query(regions, vcf_id=None):
+    """
+    Translate region strings to a Q object selecting the rows whose POS lies in any of them.
+    Every region becomes a range condition on the (vcf, chrom, pos) index, so the file is
+    part of each one rather than an outer filter the OR would not be searched with.
+
+    Args:
+        regions(list): A list of region strings
+        vcf_id(int): Only select the rows of this file
+
+    Returns:
+        query(Q): The combined Q object
+
+    Raises:
+        ValueError: If any of the region strings is not valid
+    """
+    query = Q()
+    for region in regions:
+        chrom, start, end = parse_region(region)
+        condition = Q(chrom=chrom)
+        if vcf_id is not None:
+            condition &= Q(vcf_id=vcf_id)
+        if start is not None:
+            condition &= Q(pos__gte=start)
+        if end is not None:
+            condition &= Q(pos__lte=end)
+        query |= condition
+    return query
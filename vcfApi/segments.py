@@ -0,0 +1,362 @@
+"""
+This module contains the segmented layout of a managed VCF file. The file is split in
+segment files, at the chromosome changes and every max lines, listed in a manifest with
+the first sort key of each. A segment owns the sort keys from its first key up to the first
+key of the next one, so every change belongs to exactly one segment and a sync only touches
+the segments with changes, each with the regular sync engine (see filesync.sync_file).
+Every segment is a complete VCF file with the header. The single VCF file is produced on
+demand by concatenating the segment bodies.
+Like vcfio it deliberately has no Django dependencies.
+"""
+import os
+import json
+import shutil
+from array import array
+from bisect import bisect_right
+from vcfApi.vcfio import FIELD_DEL
+from vcfApi.vcfio import is_gzipped
+from vcfApi.vcfio import open_vcf_stream
+from vcfApi.filesync import LineIndex
+from vcfApi.filesync import StaleIndexError
+from vcfApi.filesync import INDEX_SUFFIX
+from vcfApi.filesync import KEYS_SUFFIX
+from vcfApi.filesync import REWRITE_SUFFIX
+from vcfApi.filesync import COPY_BUFFER_SIZE
+from vcfApi.filesync import OFFSET_TYPECODE
+from vcfApi.filesync import KEY_TYPECODE
+from vcfApi.filesync import iter_merged_lines
+from vcfApi.filesync import load_line_keys
+from vcfApi.filesync import apply_journal
+from vcfApi.filesync import undo_append
+from vcfApi.filesync import copy_range
+from vcfApi.filesync import end_last_line
+from vcfApi.filesync import remove_file
+from vcfApi.filesync import get_uncompressed_path
+from vcfApi.bgzf import TABIX_SUFFIX
+
+SEGMENTS_SUFFIX = '.segments'
+MANIFEST_NAME = 'manifest.json'
+MANIFEST_VERSION = 1
+SEGMENT_NAME = '{:05d}.vcf'
+DEFAULT_SEGMENT_LINES = 1000000
+# A chromosome change only starts a new segment after this many lines,
+# so files with interleaved chromosomes don't end up with tiny segments
+MIN_SEGMENT_LINES = 1000
+
+def is_manifest(path):
+    """
+    Check if a managed file path is the manifest of a segmented file
+
+    Args:
+        path(str): The full path of the managed file
+
+    Returns:
+        segmented(bool): True if the file is segmented
+    """
+    return os.path.basename(path) == MANIFEST_NAME
+
+def get_manifest_path(vcf_path):
+    """
+    Get the path of the manifest a file is split under
+
+    Args:
+        vcf_path(str): The full path of the file
+
+    Returns:
+        path(str): The manifest path, in the segments directory next to the uncompressed file
+    """
+    if is_gzipped(vcf_path):
+        vcf_path = get_uncompressed_path(vcf_path)
+    return os.path.join(vcf_path + SEGMENTS_SUFFIX, MANIFEST_NAME)
+
+def get_export_path(manifest_path):
+    """
+    Get the path of the single file the segments are joined to by default
+
+    Args:
+        manifest_path(str): The full path of the manifest
+
+    Returns:
+        path(str): The file path, next to the segments directory
+    """
+    directory = os.path.dirname(manifest_path)
+    if directory.endswith(SEGMENTS_SUFFIX):
+        return directory[:-len(SEGMENTS_SUFFIX)]
+    return directory + '.vcf'
+
+class Manifest:
+    """
+    The list of the segments of a file in sort key order, each with its file name,
+    its first sort key and the chromosome it started with
+    """
+
+    def __init__(self, path, segments):
+        self.path = path
+        self.segments = segments
+
+    @property
+    def directory(self):
+        """
+        The directory of the segment files
+        """
+        return os.path.dirname(self.path)
+
+    def segment_path(self, segment):
+        """
+        Get the full path of a segment file
+
+        Args:
+            segment(dict): The segment entry
+
+        Returns:
+            path(str): The full path
+        """
+        return os.path.join(self.directory, segment['name'])
+
+    def key_ranges(self):
+        """
+        Get the sort keys every segment owns. The first segment also owns the keys before
+        it and the last one the keys after it.
+
+        Returns:
+            ranges(list): (path, first key, end key) tuples, the keys are None when unbounded
+        """
+        ranges = []
+        for position, segment in enumerate(self.segments):
+            first_key = segment['first_key'] if position else None
+            end_key = self.segments[position + 1]['first_key'] \
+                if position + 1 < len(self.segments) else None
+            ranges.append((self.segment_path(segment), first_key, end_key))
+        return ranges
+
+    def find_segment(self, key):
+        """
+        Get the segment a sort key belongs to
+
+        Args:
+            key(int): The sort key
+
+        Returns:
+            segment(dict): The segment entry
+        """
+        position = bisect_right([segment['first_key'] for segment in self.segments], key)
+        return self.segments[max(position - 1, 0)]
+
+    @classmethod
+    def load(cls, path):
+        """
+        Read a manifest
+
+        Args:
+            path(str): The full path of the manifest
+
+        Returns:
+            manifest(Manifest): The manifest
+
+        Raises:
+            ValueError: If the file is not a manifest of a supported version
+        """
+        with open(path) as stream:
+            content = json.load(stream)
+        if content.get('version') != MANIFEST_VERSION or not content.get('segments'):
+            raise ValueError(f"{path} is not a valid segment manifest!")
+        return cls(path, content['segments'])
+
+    def save(self):
+        """
+        Store the manifest, replacing the previous one once it is complete
+        """
+        with open(self.path + REWRITE_SUFFIX, 'w') as stream:
+            json.dump({'version': MANIFEST_VERSION, 'segments': self.segments}, stream, indent=1)
+            stream.flush()
+            os.fsync(stream.fileno())
+        os.replace(self.path + REWRITE_SUFFIX, self.path)
+
+def get_line_keys(vcf_path):
+    """
+    Get the sort keys of the body lines of a managed file
+
+    Args:
+        vcf_path(str): The full path of the file
+
+    Returns:
+        keys(array): The sort keys
+
+    Raises:
+        StaleIndexError: If they are not stored, see filesync.restore_line_keys
+    """
+    if is_gzipped(vcf_path):
+        keys = load_line_keys(vcf_path)
+        if keys is None:
+            raise StaleIndexError(f"The line keys of {vcf_path} are missing or stale!")
+        return keys
+    # Complete a patch or roll back an append that was interrupted first
+    apply_journal(vcf_path)
+    undo_append(vcf_path)
+    return LineIndex.get(vcf_path).keys
+
+class SegmentWriter:
+    """
+    Writes the segment files of a file being split, with their line indexes
+    """
+
+    def __init__(self, directory, header):
+        self.directory = directory
+        self.header = header
+        self.segments = []
+        self.stream = None
+        self.path = None
+        self.offsets = array(OFFSET_TYPECODE)
+        self.keys = array(KEY_TYPECODE)
+        self.position = 0
+
+    def start(self, key, chrom):
+        """
+        Close the current segment and start a new one
+
+        Args:
+            key(int): The first sort key of the segment
+            chrom(bytes): The chromosome of its first line
+        """
+        self.close()
+        name = SEGMENT_NAME.format(len(self.segments))
+        self.segments.append({'name': name, 'first_key': key, 'chrom': chrom.decode()})
+        self.path = os.path.join(self.directory, name)
+        self.stream = open(self.path, 'wb', buffering=COPY_BUFFER_SIZE)
+        self.stream.write(self.header)
+        self.position = len(self.header)
+
+    def write_line(self, key, line):
+        """
+        Write a body line to the current segment
+
+        Args:
+            key(int): The sort key of the row
+            line(bytes): The line
+        """
+        self.offsets.append(self.position)
+        self.keys.append(key)
+        self.stream.write(line)
+        self.position += len(line)
+
+    def close(self):
+        """
+        Close the current segment and store its index
+        """
+        if self.stream is None:
+            return
+        self.stream.flush()
+        os.fsync(self.stream.fileno())
+        self.stream.close()
+        LineIndex(self.path, len(self.header), self.offsets, self.keys).save()
+        self.stream = None
+        self.offsets = array(OFFSET_TYPECODE)
+        self.keys = array(KEY_TYPECODE)
+
+def split_file(vcf_path, max_lines=DEFAULT_SEGMENT_LINES, min_lines=MIN_SEGMENT_LINES):
+    """
+    Split a managed file in segments in a single pass. A segment ends where the chromosome
+    changes (once it has min_lines lines) or when it reaches max_lines lines. The lines keep
+    their sort keys. The manifest is written last, a split that was interrupted is redone.
+
+    Args:
+        vcf_path(str): The full path of the (compressed) file
+        max_lines(int): The most lines of a segment
+        min_lines(int): The least lines of a segment before a chromosome change ends it
+
+    Returns:
+        manifest_path(str): The full path of the manifest
+    """
+    manifest_path = get_manifest_path(vcf_path)
+    directory = os.path.dirname(manifest_path)
+    if os.path.isdir(directory):
+        shutil.rmtree(directory)
+    os.makedirs(directory)
+    keys = get_line_keys(vcf_path)
+    header = bytearray()
+    writer = None
+    previous = None
+    count = 0
+    with open_vcf_stream(vcf_path) as source:
+        for key, line in iter_merged_lines(source, [], keys):
+            if key is None:
+                header.extend(line)
+                continue
+            if writer is None:
+                writer = SegmentWriter(directory, bytes(header))
+            chrom = line.split(FIELD_DEL, 1)[0]
+            if writer.stream is None or count >= max_lines or \
+                    (chrom != previous and count >= min_lines):
+                writer.start(key, chrom)
+                count = 0
+            writer.write_line(key, line)
+            previous = chrom
+            count += 1
+    if writer is None:
+        # A file without rows still gets a segment, new rows go there
+        writer = SegmentWriter(directory, bytes(header))
+        writer.start(0, b'')
+    writer.close()
+    Manifest(manifest_path, writer.segments).save()
+    return manifest_path
+
+def join_segments(manifest_path, vcf_path, save_index=False):
+    """
+    Concatenate the segments of a file to a single VCF file: the header and the body of
+    the first segment, then the bodies of the others, copied as raw byte ranges. The file
+    replaces any previous one once it is complete.
+
+    Args:
+        manifest_path(str): The full path of the manifest
+        vcf_path(str): The full path of the file to write
+        save_index(bool): True to store the line index of the file, with the sort keys
+
+    Returns:
+        size(int): The size of the file
+    """
+    manifest = Manifest.load(manifest_path)
+    offsets = array(OFFSET_TYPECODE)
+    keys = array(KEY_TYPECODE)
+    body_offset = None
+    position = 0
+    with open(vcf_path + REWRITE_SUFFIX, 'wb', buffering=COPY_BUFFER_SIZE) as target:
+        for path, _, _ in manifest.key_ranges():
+            # Complete a patch or roll back an append of the segment that was interrupted
+            apply_journal(path)
+            undo_append(path)
+            index = LineIndex.get(path)
+            start = index.body_offset if body_offset is not None else 0
+            if body_offset is None:
+                body_offset = index.body_offset
+            if save_index:
+                offsets.extend(array(OFFSET_TYPECODE,
+                    [offset + position - start for offset in index.offsets]))
+                keys.extend(index.keys)
+            end = index.line_offset(index.line_count + 1)
+            with open(path, 'rb') as source:
+                copy_range(source, target, start, end)
+                position = end_last_line(index, source, target, position + end - start)
+        target.flush()
+        os.fsync(target.fileno())
+    os.replace(vcf_path + REWRITE_SUFFIX, vcf_path)
+    if save_index:
+        LineIndex(vcf_path, body_offset, offsets, keys).save()
+    return position
+
+def remove_segments(manifest_path):
+    """
+    Remove the segments of a file once it was joined to a single file
+
+    Args:
+        manifest_path(str): The full path of the manifest
+    """
+    shutil.rmtree(os.path.dirname(manifest_path), ignore_errors=True)
+
+def remove_source_file(vcf_path):
+    """
+    Remove a file once it was split in segments, with its side files
+
+    Args:
+        vcf_path(str): The full path of the file
+    """
+    remove_file(vcf_path, (INDEX_SUFFIX, KEYS_SUFFIX, TABIX_SUFFIX))
@@ -2,13 +2,110 @@
 Contains Django DRF serializers to be used by the API views
 """
 import re
+from django.db import IntegrityError
+from django.db import transaction
 from rest_framework import serializers
 from vcfApi.models import Vcf
 from vcfApi.models import VcfRow
+from vcfApi.models import RowCount
+from vcfApi.models import RowEvent
+from vcfApi.dispatch import notify_rows_changed
+from vcfApi.filesync import SORT_KEY_GAP
 MAX_CHROM_NUM = 22
 VALID_CHROM = re.compile(r'^chr((\d){1,2}+$|[XYM]?+$)')
 VALID_ID = re.compile(r'^rs[0-9]+$')
 GEN_ALLOWED_VALUES = ['A','C','G','T','.']
+NO_FILE_ERROR = {'message': 'No Vcf File was initialised in the db!'}
+NO_ROOM_ERROR = {'message': 'No room left to place the row in order, please append it instead.'}
+# Where new rows are placed: after the last row or in chrom/pos order
+PLACEMENT_END = 'end'
+PLACEMENT_SORTED = 'sorted'
+PLACEMENTS = (PLACEMENT_END, PLACEMENT_SORTED)
+# How many times an insert is retried when another writer took its sort keys first
+SORT_KEY_RETRIES = 3
+
+def insert_rows(vcf_id, insert):
+    """
+    Run an insert of new rows in a transaction that locks the file row first, so
+    concurrent inserts into a file allocate their sort keys one after the other. A writer
+    that does not take the lock can still take the same keys, the unique (vcf, sort_key)
+    constraint rejects the later insert and it is retried with newly allocated keys.
+
+    Args:
+        vcf_id(int): The file id
+        insert(callable): Allocates the sort keys and inserts the rows
+
+    Returns:
+        The return value of insert
+
+    Raises:
+        IntegrityError: If the insert still fails after SORT_KEY_RETRIES attempts
+    """
+    for attempt in range(1, SORT_KEY_RETRIES + 1):
+        try:
+            with transaction.atomic():
+                list(Vcf.objects.select_for_update().filter(id=vcf_id).values_list('id'))
+                return insert()
+        except IntegrityError:
+            if attempt == SORT_KEY_RETRIES:
+                raise
+    return None
+
+def get_sort_key(vcf_id, item, placement):
+    """
+    Get the sort key of a new row
+
+    Args:
+        vcf_id(int): The file id
+        item(dict): The validated row values
+        placement(str): One of PLACEMENTS
+
+    Returns:
+        sort_key(int): The sort key
+    """
+    if placement != PLACEMENT_SORTED:
+        return VcfRow.last_sort_key(vcf_id) + SORT_KEY_GAP
+    sort_key = VcfRow.sorted_sort_key(vcf_id, item.get('chrom'), item.get('pos'))
+    if sort_key is None:
+        raise serializers.ValidationError(NO_ROOM_ERROR)
+    return sort_key
+
+class VcfRowListSerializer(serializers.ListSerializer):
+    """
+    This is the list serializer used when many VcfRows are posted at once.
+    The rows are validated as a batch and inserted with a single bulk insert.
+    """
+    def create(self, validated_data):
+        """
+        Handle the creation of many new VcfRows via POST. The rows get consecutive
+        sort keys after the last one, or are placed in chrom/pos order one by one,
+        their creation events are journaled and a single file update is requested in the
+        same transaction.
+        """
+        # Note: In this assignment we assume/support only one
+        # Vcf file on the db. So all rows belong to it...
+        vcf_file = Vcf.objects.first()
+        if not vcf_file:
+            raise serializers.ValidationError(NO_FILE_ERROR)
+        placement = self.context.get('placement', PLACEMENT_END)
+
+        def insert():
+            if placement == PLACEMENT_SORTED:
+                # Every row is placed after the ones before it are stored
+                rows = [VcfRow.objects.bulk_create([VcfRow(vcf_id=vcf_file.id,
+                    sort_key=get_sort_key(vcf_file.id, item, placement),**item)])[0]
+                    for item in validated_data]
+            else:
+                last_key = VcfRow.last_sort_key(vcf_file.id)
+                rows = VcfRow.objects.bulk_create([VcfRow(sort_key=last_key + i * SORT_KEY_GAP,
+                    vcf_id=vcf_file.id,chrom=item.get('chrom'),pos=item.get('pos'),
+                        id=item.get('id'),ref=item.get('ref'),alt=item.get('alt'))
+                    for i, item in enumerate(validated_data, start=1)])
+            RowEvent.record_rows(rows, RowEvent.CREATED)
+            RowCount.add_rows(vcf_file.id, rows)
+            notify_rows_changed(vcf_file.id, len(rows))
+            return rows
+        return insert_rows(vcf_file.id, insert)
 
 class VcfRowSerializer(serializers.ModelSerializer):
     """This is the serializer class for the VcfRow model. Used by the VcfRowsList Class."""
@@ -18,6 +115,7 @@ class VcfRowSerializer(serializers.ModelSerializer):
         """
         model = VcfRow
         fields = ['chrom', 'pos', 'id', 'ref', 'alt']
+        list_serializer_class = VcfRowListSerializer
 
     def validate_chrom(self, value):
         """
@@ -77,7 +175,8 @@ class VcfRowSerializer(serializers.ModelSerializer):
 
     def create(self, validated_data):
         """
-        Handle the creation of a new VcfRow via POST
+        Handle the creation of a new VcfRow via POST. The row is saved in the same
+        transaction as the event and file update the post_save signal records.
         """
         # Note: In this assignment we assume/support only one
         # Vcf file on the db. So all rows belong to it...
@@ -85,18 +184,15 @@ class VcfRowSerializer(serializers.ModelSerializer):
         vcf_files = Vcf.objects.all()
         if len(vcf_files) > 0:
             vcf_file = vcf_files[0]
-            line_id = 1
-            try:
-                last_row = VcfRow.objects.latest('line_id')
-                if last_row and last_row.line_id:
-                    line_id = last_row.line_id + 1
-            except:
-                pass
-            row = VcfRow(line_id=line_id,vcf_id=vcf_file.id,chrom=validated_data.get('chrom')
-                    ,pos=validated_data.get('pos'),id=validated_data.get('id'),
-                        ref=validated_data.get('ref') ,alt=validated_data.get('alt'),
-                            dirty=True)
-            row.save()
-            return row
-        error = {'message': 'No Vcf File was initialised in the db!'}
-        raise serializers.ValidationError(error)
+            placement = self.context.get('placement', PLACEMENT_END)
+
+            def insert():
+                sort_key = get_sort_key(vcf_file.id, validated_data, placement)
+                row = VcfRow(sort_key=sort_key,vcf_id=vcf_file.id,
+                    chrom=validated_data.get('chrom'),pos=validated_data.get('pos'),
+                    id=validated_data.get('id'),ref=validated_data.get('ref'),
+                    alt=validated_data.get('alt'))
+                row.save()
+                return row
+            return insert_rows(vcf_file.id, insert)
+        raise serializers.ValidationError(NO_FILE_ERROR)
@@ -2,110 +2,537 @@
 The Celery tasks that will perform the necessary File operations.
 These are spawned by the Django Signals module
 """
-import os
-import vcfpy
-from vcfpy import Record as VcfRecord
+from celery import chord
 from celery import shared_task
-from django.db.models import F
+import os
+import heapq
+import functools
+from django.db.models import Max
+from django.db.models import Min
+from django.db.models import Exists
+from django.db.models import OuterRef
 from vcfApi.models import Vcf
 from vcfApi.models import VcfRow
-from vcfApi.models import Deleted
+from vcfApi.models import RowEvent
+from vcfApi.models import RowCount
 from vcfApi import logger
-import time
-# import gzip
+from vcfApi.cache import bump_data_version
+from vcfApi.vcfio import is_gzipped
+from vcfApi.filesync import sync_file
+from vcfApi.filesync import restore_line_keys
+from vcfApi.filesync import regenerate_file
+from vcfApi.filesync import StaleIndexError
+from vcfApi.filesync import plan_parts
+from vcfApi.filesync import get_part_path
+from vcfApi.filesync import write_part
+from vcfApi.filesync import join_parts
+from vcfApi.filesync import remove_parts
+from vcfApi.segments import Manifest
+from vcfApi.segments import is_manifest
+from vcfApi.segments import split_file
+from vcfApi.segments import join_segments
+from vcfApi.segments import get_export_path
+from vcfApi.segments import remove_segments
+from vcfApi.segments import remove_source_file
+SYNC_CHUNK_SIZE = 2000
+
+def get_pending_events(vcf_id, after_seq, last_seq):
+    """
+    Get the row events of a file a sync pass covers
+
+    Args:
+        vcf_id(int): The VCF file entities int PK on our DB.
+        after_seq(int): The file-sync watermark, the last event applied to the file
+        last_seq(int): The last event the pass covers
+
+    Returns:
+        events(QuerySet): The RowEvents
+    """
+    return RowEvent.objects.filter(vcf_id=vcf_id, seq__gt=after_seq, seq__lte=last_seq)
+
+def compact_row_events(vcf_id, after_seq, last_seq):
+    """
+    Fold the events of every row changed after the watermark into its last one, which
+    carries the net change: the values the row was left with or its deletion. Its events
+    before the watermark are dropped as well, so the journal keeps one event per row.
+    Deletions are kept even for rows created after the watermark, an interrupted sync may
+    have written them to the file already, and applying them is a no-op otherwise.
+
+    Args:
+        vcf_id(int): The VCF file entities int PK on our DB.
+        after_seq(int): The file-sync watermark, the last event applied to the file
+        last_seq(int): The last event the pass covers
+
+    Returns:
+        folded(int): The number of removed events
+    """
+    later = RowEvent.objects.filter(row_id=OuterRef('row_id'), seq__gt=OuterRef('seq'),
+        seq__lte=last_seq)
+    changed_rows = get_pending_events(vcf_id, after_seq, last_seq).values('row_id')
+    folded, _ = RowEvent.objects.filter(vcf_id=vcf_id, seq__lte=last_seq,
+        row_id__in=changed_rows).filter(Exists(later)).delete()
+    return folded
+
+def filter_key_range(events, first_key=None, end_key=None):
+    """
+    Limit row events to a range of sort keys
+
+    Args:
+        events(QuerySet): The RowEvents
+        first_key(int): The first sort key of the range, None for no lower bound
+        end_key(int): The sort key after the range, None for no upper bound
+
+    Returns:
+        events(QuerySet): The RowEvents in the range
+    """
+    if first_key is not None:
+        events = events.filter(sort_key__gte=first_key)
+    if end_key is not None:
+        events = events.filter(sort_key__lt=end_key)
+    return events
+
+def iter_row_changes(vcf_id, after_seq, last_seq, first_key=None, end_key=None):
+    """
+    Stream the compacted events of a file in sort key order from a server side cursor,
+    as the change stream the sync functions consume
+
+    Args:
+        vcf_id(int): The VCF file entities int PK on our DB.
+        after_seq(int): The file-sync watermark, the last event applied to the file
+        last_seq(int): The last event the pass covers
+        first_key(int): Only stream the sort keys from this one on
+        end_key(int): Only stream the sort keys before this one
+
+    Returns:
+        changes(iterator): (sort key, values) tuples sorted by sort key, values are
+            (chrom, pos, id, ref, alt) or None for a deletion
+    """
+    # Rows without a sort key are not placed in the file
+    events = get_pending_events(vcf_id, after_seq, last_seq).filter(sort_key__isnull=False)
+    events = filter_key_range(events, first_key, end_key).order_by('sort_key', 'seq') \
+        .values_list('sort_key', 'kind', *RowEvent.VALUE_FIELDS) \
+        .iterator(chunk_size=SYNC_CHUNK_SIZE)
+    for sort_key, kind, *values in events:
+        yield sort_key, None if kind == RowEvent.DELETED else tuple(values)
+
+def get_synced_keys(vcf_id, synced_seq, count, first_key=None, end_key=None):
+    """
+    Get the sort keys of the rows a file holds as of its file-sync watermark, to rebuild
+    the index of its lines: the rows stored now, without the ones created after the
+    watermark and with the ones deleted after it
+
+    Args:
+        vcf_id(int): The VCF file entities int PK on our DB.
+        synced_seq(int): The file-sync watermark, the last event applied to the file
+        count(int): The number of lines of the file
+        first_key(int): Only get the sort keys from this one on
+        end_key(int): Only get the sort keys before this one
+
+    Returns:
+        keys(iterator): The sort keys in order
+    """
+    logger.info(f"Rebuilding the sort keys of {count} lines of VCF file:{vcf_id}")
+    events = filter_key_range(RowEvent.objects.filter(vcf_id=vcf_id, seq__gt=synced_seq,
+        sort_key__isnull=False), first_key, end_key).order_by('seq') \
+        .values_list('row_id', 'sort_key', 'kind').iterator(chunk_size=SYNC_CHUNK_SIZE)
+    # The first event of a row after the watermark tells if the file has its line
+    first_events = {}
+    for row_id, sort_key, kind in events:
+        first_events.setdefault(row_id, (sort_key, kind))
+    rows = filter_key_range(VcfRow.objects.filter(vcf_id=vcf_id, sort_key__isnull=False),
+        first_key, end_key).order_by('sort_key').values_list('row_id', 'sort_key') \
+        .iterator(chunk_size=SYNC_CHUNK_SIZE)
+    keys = []
+    stored = set()
+    for row_id, sort_key in rows:
+        event = first_events.get(row_id)
+        if event is not None:
+            stored.add(row_id)
+            if event[1] == RowEvent.CREATED:
+                continue
+        keys.append(sort_key)
+    deleted = sorted(sort_key for row_id, (sort_key, kind) in first_events.items()
+        if row_id not in stored and kind != RowEvent.CREATED)
+    return heapq.merge(keys, deleted)
+
+def iter_file_rows(vcf_id, first_key=None, end_key=None):
+    """
+    Stream the rows of a file in sort key order from a server side cursor,
+    to regenerate the file from
+
+    Args:
+        vcf_id(int): The VCF file entities int PK on our DB.
+        first_key(int): Only stream the sort keys from this one on
+        end_key(int): Only stream the sort keys before this one
+
+    Returns:
+        rows(iterator): (sort key, (chrom, pos, id, ref, alt)) tuples sorted by sort key
+    """
+    rows = filter_key_range(VcfRow.objects.filter(vcf_id=vcf_id, sort_key__isnull=False),
+        first_key, end_key).order_by('sort_key') \
+        .values_list('sort_key', *RowEvent.VALUE_FIELDS).iterator(chunk_size=SYNC_CHUNK_SIZE)
+    for sort_key, *values in rows:
+        yield sort_key, tuple(values)
+
+def restore_file_keys(vcf_file, path, first_key=None, end_key=None):
+    """
+    Make sure the sort keys of the lines of a file (or of a segment) are stored before it
+    is synced and before its events are compacted. A lost or stale index is rebuilt from
+    the rows the file holds as of the watermark. When those don't match its lines, the
+    file is regenerated from the rows, the columns they don't store are lost.
+
+    Args:
+        vcf_file(Vcf): The VCF file entity
+        path(str): The full path of the file or segment
+        first_key(int): The first sort key of the segment, None for no lower bound
+        end_key(int): The first sort key of the next segment, None for the last one
+    """
+    try:
+        restore_line_keys(path, functools.partial(get_synced_keys, vcf_file.id,
+            vcf_file.synced_seq, first_key=first_key, end_key=end_key))
+    except StaleIndexError as err:
+        logger.error(f"The lines of {path} don't match the rows of VCF file:{vcf_file.id}! "
+            f"{err} Regenerating it from the rows")
+        rewritten = regenerate_file(path, iter_file_rows(vcf_file.id, first_key, end_key))
+        logger.info(f"Regenerated {path} with {rewritten} bytes")
+
+def sync_file_rows(vcf_file, last_seq):
+    """
+    Transfer the row events after the file-sync watermark to a VCF file. The events are
+    compacted first so the sync costs the net changes, then merged with the file in a
+    single pass. Only a chunk of them is held in memory.
+
+    Args:
+        vcf_file(Vcf): The VCF file entity
+        last_seq(int): The last event the pass covers
+
+    Returns:
+        (path, rewritten): The path of the synced file and the number of bytes written
+    """
+    folded = compact_row_events(vcf_file.id, vcf_file.synced_seq, last_seq)
+    logger.info(f"Modifying VCF file:{vcf_file.id} folded {folded} superseded row events")
+    return sync_file(vcf_file.fullpath,
+        iter_row_changes(vcf_file.id, vcf_file.synced_seq, last_seq), Vcf.use_bgzf_output())
+
+def finish_file_sync(vcf_id, last_seq):
+    """
+    Advance the file-sync watermark once the file holds the events up to a sequence.
+    The applied events stay for the change feed, only the expired deletions are pruned.
+    An interrupted sync resumes from the watermark, applying the same events again
+    leaves the file as it is.
+
+    Args:
+        vcf_id(int): The VCF file entities int PK on our DB.
+        last_seq(int): The last applied event
+    """
+    Vcf.objects.filter(id=vcf_id, synced_seq__lt=last_seq).update(synced_seq=last_seq)
+    removed = RowEvent.prune_deletions(vcf_id, last_seq)
+    logger.info(f"Removed {removed} expired deletion events")
+
+def get_last_seq(vcf_file):
+    """
+    Get the last event a sync pass covers. The writers are serialized by the database,
+    no lower sequence can commit after this.
+
+    Args:
+        vcf_file(Vcf): The VCF file entity
+
+    Returns:
+        last_seq(int): The sequence of the last event of the file
+    """
+    return RowEvent.objects.filter(vcf_id=vcf_file.id).aggregate(
+        Max('seq'))['seq__max'] or vcf_file.synced_seq
+
+def prepare_file_layout(vcf_file):
+    """
+    Split the managed file in segments, or join its segments back to a single file,
+    when the layout in the settings changed
+
+    Args:
+        vcf_file(Vcf): The VCF file entity
+
+    Returns:
+        vcf_file(Vcf): The entity with the path of the managed file in the current layout
+    """
+    path = vcf_file.fullpath
+    segmented = Vcf.use_segments()
+    if segmented == is_manifest(path):
+        return vcf_file
+    if segmented:
+        restore_file_keys(vcf_file, path)
+        new_path = split_file(path, Vcf.get_segment_lines())
+        logger.info(f"Split VCF file:{vcf_file.id} in {len(Manifest.load(new_path).segments)} "
+            f"segments")
+    else:
+        for segment_path, first_key, end_key in Manifest.load(path).key_ranges():
+            restore_file_keys(vcf_file, segment_path, first_key, end_key)
+        new_path = get_export_path(path)
+        join_segments(path, new_path, save_index=True)
+        logger.info(f"Joined the segments of VCF file:{vcf_file.id}")
+    Vcf.objects.filter(id=vcf_file.id).update(fullpath=new_path)
+    if segmented:
+        remove_source_file(path)
+    else:
+        remove_segments(path)
+    vcf_file.fullpath = new_path
+    return vcf_file
+
+def dispatch_segment_sync(vcf_file, last_seq, changes):
+    """
+    Transfer the row events of a segmented file to the segments that own them, as
+    parallel subtasks on any worker, one per segment with events. A callback advances
+    the watermark and releases the file once they are all done.
+
+    Args:
+        vcf_file(Vcf): The VCF file entity
+        last_seq(int): The last event the pass covers
+        changes(int): The number of changes the pass covers
+    """
+    manifest = Manifest.load(vcf_file.fullpath)
+    events = get_pending_events(vcf_file.id, vcf_file.synced_seq, last_seq) \
+        .filter(sort_key__isnull=False)
+    ranges = [(path, first_key, end_key) for path, first_key, end_key in manifest.key_ranges()
+        if filter_key_range(events, first_key, end_key).exists()]
+    for path, first_key, end_key in ranges:
+        restore_file_keys(vcf_file, path, first_key, end_key)
+    folded = compact_row_events(vcf_file.id, vcf_file.synced_seq, last_seq)
+    logger.info(f"Modifying VCF file:{vcf_file.id} folded {folded} superseded row events")
+    subtasks = [sync_file_segment.si(vcf_file.id, path, first_key, end_key,
+        vcf_file.synced_seq, last_seq) for path, first_key, end_key in ranges]
+    logger.info(f"Modifying VCF file:{vcf_file.id} syncing {len(subtasks)} of "
+        f"{len(manifest.segments)} segments")
+    if not subtasks:
+        finish_parallel_sync([], vcf_file.id, last_seq, changes)
+        return
+    chord(subtasks)(finish_parallel_sync.s(vcf_file.id, last_seq, changes))
+
+@shared_task
+def sync_file_segment(file_id, segment_path, first_key, end_key, after_seq, last_seq):
+    """
+    Transfer the row events of a range of sort keys to a segment of a file.
+    Segments are separate files, so they are synced in parallel.
+
+    Args:
+        file_id(int): The VCF file entities int PK on our DB.
+        segment_path(str): The full path of the segment file
+        first_key(int): The first sort key of the segment, None for no lower bound
+        end_key(int): The first sort key of the next segment, None for the last one
+        after_seq(int): The file-sync watermark, the last event applied to the file
+        last_seq(int): The last event the pass covers
+
+    Returns:
+        rewritten(int): The number of bytes written, None if the sync failed
+    """
+    try:
+        _, rewritten = sync_file(segment_path,
+            iter_row_changes(file_id, after_seq, last_seq, first_key, end_key))
+    except Exception as err:
+        logger.error(f"Error Modifying segment {segment_path} of VCF file:{file_id}!")
+        logger.logException(err)
+        return None
+    logger.info(f"Modifying VCF file:{file_id} rewrote {rewritten} bytes of {segment_path}")
+    return rewritten
+
+def dispatch_parallel_rewrite(vcf_file, last_seq, changes):
+    """
+    Rewrite a large file in parts, when the row events would have most of it rewritten.
+    Every part is a range of lines written with its changes by a subtask on any worker,
+    a callback joins the parts, replaces the file and releases it.
+
+    Args:
+        vcf_file(Vcf): The VCF file entity
+        last_seq(int): The last event the pass covers
+        changes(int): The number of changes the pass covers
+
+    Returns:
+        dispatched(bool): False if the file is synced sequentially instead
+    """
+    parts, min_size = Vcf.get_sync_parts()
+    path = vcf_file.fullpath
+    if parts < 2 or Vcf.use_bgzf_output() or is_gzipped(path) or \
+            os.path.getsize(path) < min_size:
+        return False
+    folded = compact_row_events(vcf_file.id, vcf_file.synced_seq, last_seq)
+    logger.info(f"Modifying VCF file:{vcf_file.id} folded {folded} superseded row events")
+    lowest_key = get_pending_events(vcf_file.id, vcf_file.synced_seq, last_seq) \
+        .aggregate(Min('sort_key'))['sort_key__min']
+    if lowest_key is None:
+        return False
+    start, ranges = plan_parts(path, lowest_key, parts)
+    if not ranges:
+        return False
+    logger.info(f"Modifying VCF file:{vcf_file.id} rewriting in {len(ranges)} parts")
+    subtasks = [write_file_part.si(vcf_file.id, path, first_line, end_line, first_key,
+        end_key, vcf_file.synced_seq, last_seq, get_part_path(path, part))
+        for part, (first_line, end_line, first_key, end_key) in enumerate(ranges)]
+    chord(subtasks)(join_file_parts.s(vcf_file.id, path, start,
+        [get_part_path(path, part) for part in range(len(ranges))], last_seq, changes))
+    return True
+
+@shared_task
+def write_file_part(file_id, vcf_path, first_line, end_line, first_key, end_key, after_seq,
+        last_seq, part_path):
+    """
+    Write a part of a parallel file rewrite: a range of lines with the row events
+    of its sort keys applied
+
+    Args:
+        file_id(int): The VCF file entities int PK on our DB.
+        vcf_path(str): The full path of the file
+        first_line(int): The id of the first line of the part
+        end_line(int): The id of the line after the part
+        first_key(int): The first sort key of the part, None for no lower bound
+        end_key(int): The first sort key of the next part, None for the last one
+        after_seq(int): The file-sync watermark, the last event applied to the file
+        last_seq(int): The last event the pass covers
+        part_path(str): The full path of the part file
+
+    Returns:
+        written(int): The size of the part, None if it failed
+    """
+    try:
+        return write_part(vcf_path, first_line, end_line,
+            iter_row_changes(file_id, after_seq, last_seq, first_key, end_key), part_path)
+    except Exception as err:
+        logger.error(f"Error writing part {part_path} of VCF file:{file_id}!")
+        logger.logException(err)
+        return None
+
+@shared_task
+def join_file_parts(results, file_id, vcf_path, start, part_paths, last_seq, changes):
+    """
+    Complete a parallel file rewrite once all its parts are written: the parts are joined
+    to the new file that replaces the original. A failed rewrite leaves the file as it was.
+
+    Args:
+        results(list): The size of every part, None for a failed one
+        file_id(int): The VCF file entities int PK on our DB.
+        vcf_path(str): The full path of the file
+        start(int): The id of the first changed line
+        part_paths(list): The full paths of the part files, in line order
+        last_seq(int): The last event the pass covers
+        changes(int): The number of changes the pass covers
+    """
+    if None not in results:
+        try:
+            results = [join_parts(vcf_path, start, part_paths)]
+        except Exception as err:
+            logger.error(f"Error joining the parts of VCF file:{file_id}!")
+            logger.logException(err)
+            results = [None]
+    remove_parts(part_paths)
+    return finish_parallel_sync(results, file_id, last_seq, changes)
+
+@shared_task
+def finish_parallel_sync(results, file_id, last_seq, changes):
+    """
+    Complete a sync that ran as parallel subtasks: once they all succeeded the watermark
+    advances, otherwise the events stay pending for the next sync. The file is released.
+
+    Args:
+        results(list): The bytes written by every subtask, None for a failed one
+        file_id(int): The VCF file entities int PK on our DB.
+        last_seq(int): The last event the pass covers
+        changes(int): The number of changes the pass covers
+    """
+    vcf_file = Vcf.objects.get(id=file_id)
+    try:
+        if None in results:
+            logger.error(f"Error Modifying VCF file:{vcf_file.name}! "
+                f"{results.count(None)} of {len(results)} parts failed")
+            return 'failed'
+        logger.info(f"Modifying VCF file:{file_id} rewrote {sum(results)} bytes")
+        finish_file_sync(file_id, last_seq)
+        vcf_file.record_rewrite(changes)
+        logger.info(f"Modifying VCF file:{file_id} rewrite covered {changes} changes")
+    finally:
+        release_file_sync(vcf_file)
+    logger.info(f"Modifying VCF file:{file_id} completed")
+    return 'success'
+
+def release_file_sync(vcf_file):
+    """
+    Clear the updating flag of a file once a sync is over. Changes that came in after the
+    last check found the sync still running get a new one.
+
+    Args:
+        vcf_file(Vcf): The VCF file entity
+    """
+    vcf_file.set_updating(False)
+    if Vcf.objects.filter(id=vcf_file.id, needs_update=True, is_updating=False) \
+            .update(is_updating=True):
+        debounce, _ = Vcf.get_sync_window()
+        modify_file_rows.apply_async((vcf_file.id,), countdown=debounce.total_seconds())
 
 @shared_task
 def modify_file_rows(file_id):
     """
-    Modify a VCF file that has undergone changes
+    Modify a VCF file that has undergone changes. While changes keep coming in
+    the task postpones itself, within the debounce window and max latency limits.
     
     Args:
         file_id(int): The VCF file entities int PK on our DB.
     """
-    time.sleep(1)
     vcf_file = None
     try:
         vcf_file = Vcf.objects.get(id=file_id)
     except Exception as err:
         logger.logException(err)
     if vcf_file:
+        delay = vcf_file.get_sync_delay()
+        if delay > 0:
+            # Still receiving changes, is_updating stays set so nothing else is scheduled
+            modify_file_rows.apply_async((file_id,), countdown=delay)
+            return 'deferred'
+        dispatched = False
         try:
-            vcf_file = vcf_file.set_needsupdate(False)
+            changes = vcf_file.claim_changes()
             needsUpdate = True
             while needsUpdate:
                 logger.info(f"Modifying VCF file:{file_id}")
-                # TODO This is a first simplified implementation that needs looking
-                # into and optimizing... To make this production ready we would need to 
-                # implement Event Sourcing i.e. and proper handling in a sidecar process...
-                # Get all the rows that are dirty by line order for now
-                dirtyrows = VcfRow.objects.filter(dirty=True).order_by('line_id')
-                deletedrows = Deleted.objects.all().order_by('line_id')
-                reader = vcfpy.Reader.from_path(vcf_file.fullpath)
-                copy_path = vcf_file.fullpath[:vcf_file.fullpath.index(".")]+"_copy.vcf"
-                logger.info(copy_path)
-                writer = vcfpy.Writer.from_path(copy_path, reader.header)
-                # Get the dirty lines
-                dirty_lines = {row.line_id:row for row in dirtyrows}
-                deleted_lines = [row.line_id for row in deletedrows]
-                logger.info(dirty_lines)
-                line_cnt = 0
-                # TODO this is a temp hack to make vcfpy play nice...
-                row_format = None
-                rowcalls = None
-                for record in reader:
-                    line_cnt+=1
-                    row_format = record.FORMAT
-                    rowcalls = record.calls
-                    if line_cnt in dirty_lines:
-                        row = dirty_lines[line_cnt]
-                        # Modify record before writing
-                        logger.info(f"Modifying {row.row_id} for line {line_cnt}")
-                        record.CHROM = row.chrom
-                        record.POS = row.pos
-                        record.ID = [row.id]
-                        record.REF = row.ref
-                        record.ALT = [vcfpy.Substitution(type_="SNV",value=row.alt)]
-                    if line_cnt not in deleted_lines:
-                        writer.write_record(record)
-                # Write any new lines that may have been added
-                for row in dirtyrows:
-                    if row.line_id > line_cnt:
-                        logger.info(f"Adding {row.row_id} for line {row.line_id}")
-                        rc = VcfRecord(CHROM=row.chrom, POS=row.pos, ID=[row.id], REF=row.ref,
-                            ALT=[vcfpy.Substitution(type_="SNV",value=row.alt)], QUAL=None,
-                                FILTER=[], INFO={}, FORMAT=row_format, calls=rowcalls)
-                        writer.write_record(rc)
-                # Now gz the copy file and delete the original
-                os.remove(vcf_file.fullpath)
-                # TODO if the original was not gz change the path and name to gz
-                # TODO This seems to mess up something for the parser
-                # with open(copy_path, 'rb') as copy_file:
-                #     with gzip.open(vcf_file.fullpath, 'wb') as zipped_file:
-                #         zipped_file.writelines(copy_file)
-                # TODO for now we leave uncompressed due to weird vcfpy errors...
-                os.rename(copy_path,copy_path.replace("_copy",""))
-                Vcf.objects.filter(id=file_id).update(fullpath=copy_path.replace("_copy",""))
+                vcf_file = prepare_file_layout(vcf_file)
+                # Only the events up to here are synced and pruned by this pass
+                last_seq = get_last_seq(vcf_file)
+                if is_manifest(vcf_file.fullpath):
+                    # The segments are synced by subtasks, their callback releases the file
+                    dispatch_segment_sync(vcf_file, last_seq, changes)
+                    dispatched = True
+                    return 'dispatched'
+                # The lines are matched to the rows before the events are compacted
+                restore_file_keys(vcf_file, vcf_file.fullpath)
+                if dispatch_parallel_rewrite(vcf_file, last_seq, changes):
+                    dispatched = True
+                    return 'dispatched'
+                path, rewritten = sync_file_rows(vcf_file, last_seq)
+                if path != vcf_file.fullpath:
+                    Vcf.objects.filter(id=file_id).update(fullpath=path)
+                logger.info(f"Modifying VCF file:{file_id} rewrote {rewritten} bytes")
+                finish_file_sync(file_id, last_seq)
+                vcf_file.record_rewrite(changes)
+                logger.info(f"Modifying VCF file:{file_id} rewrite covered {changes} changes")
                 # Check if an update was requested while in the process
                 vcf_file = Vcf.objects.get(id=file_id)
                 needsUpdate = vcf_file.needs_update
-                if not needsUpdate:
-                    # Set the rows back to clean
-                    dirty_idq = dirtyrows.values('row_id')
-                    dirty_ids = [i['row_id'] for i in dirty_idq]
-                    logger.info(dirty_ids)
-                    VcfRow.objects.filter(row_id__in=dirty_ids).update(dirty=False)
-                    # Handle deleted lines
-                    for dl in deletedrows:
-                        logger.info(f"Deleted:{dl.line_id}")
-                        VcfRow.objects.filter(line_id__gt=dl.line_id).update(line_id=F('line_id')-1)
-                        Deleted.objects.filter(line_id__gt=dl.line_id).update(line_id=F('line_id')-1)
-                        dl.delete()
-                else:
-                    vcf_file = vcf_file.set_needsupdate(False)
+                if needsUpdate:
+                    changes = vcf_file.claim_changes()
         except Exception as err:
             logger.error(f"Error Modifying VCF file:{vcf_file.name}!")
             logger.logException(err)
         finally:
-            vcf_file.set_updating(False)
+            if not dispatched:
+                release_file_sync(vcf_file)
     logger.info(f"Modifying VCF file:{file_id} completed")
     return 'success'
+
+@shared_task
+def reconcile_row_counts():
+    """
+    Recompute the maintained row counters, correcting any drift from
+    writes that bypassed the signals
+    """
+    fixed = RowCount.reconcile()
+    logger.info(f"Row counters reconciled, {fixed} had drifted")
+    if fixed:
+        # The cached list responses carry the drifted counts
+        bump_data_version()
+    return fixed
@@ -3,13 +3,21 @@ This module Contains various tests for the views POST functionality
 """
 import json
 from collections import OrderedDict
+from unittest import mock
 from rest_framework import status
+from django.db import connection
+from django.db import IntegrityError
+from django.db import transaction
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 from django.conf import settings
 from vcfApi.models import Vcf
 from vcfApi.models import VcfRow
+from vcfApi.models import OutboxEvent
+from vcfApi.models import RowEvent
 from vcfApi.serializers import VcfRowSerializer
+from vcfApi.filesync import SORT_KEY_GAP
 
 class CreateVcfRowTest(TestCase):
     """ Test module for the Create VcfRow API """
@@ -153,3 +161,153 @@ class CreateVcfRowTest(TestCase):
         response = self.client.post(reverse('vcfrow-list'),data=json.dumps(self.valid_payload),
             content_type='application/json',HTTP_AUTHORIZATION="Wrong_secret")
         self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_create_unique_sort_key(self):
+        """
+        Test two rows of a file can't share a sort key
+        """
+        VcfRow.objects.create(vcf_id=self.vcf.id,sort_key=7,chrom='chr1',pos=1,ref='G',alt='A')
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            VcfRow.objects.create(vcf_id=self.vcf.id,sort_key=7,chrom='chr1',pos=2,ref='G',
+                alt='A')
+
+    def test_create_sort_key_taken(self):
+        """
+        Test a row whose sort key another writer took meanwhile gets the next free one
+        """
+        VcfRow.objects.create(vcf_id=self.vcf.id,sort_key=SORT_KEY_GAP,chrom='chr1',pos=1,
+            id='rs1',ref='G',alt='A')
+        payload = {'chrom': 'chrX', 'pos': 123456, 'id':'rs123456', 'ref':"G", 'alt':"A"}
+        # The first allocation reads the last key from before the other insert
+        with mock.patch.object(VcfRow, 'last_sort_key',
+                side_effect=[0, SORT_KEY_GAP]) as last_sort_key:
+            response = self.client.post(reverse('vcfrow-list'),data=json.dumps(payload),
+                content_type='application/json',HTTP_AUTHORIZATION=self.secret)
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(list(VcfRow.objects.values_list('id','sort_key')),
+            [('rs1',SORT_KEY_GAP),('rs123456',2 * SORT_KEY_GAP)])
+        self.assertEqual(last_sort_key.call_count,2)
+
+class BulkCreateVcfRowTest(TestCase):
+    """ Test module for the bulk Create VcfRow API """
+
+    def setUp(self):
+        """
+        DB Setup
+        """
+        self.vcf = Vcf.objects.create(name='file1.vcf', fullpath='path/to/file/file1.vcf')
+        VcfRow.objects.create(vcf_id=self.vcf.id,sort_key=7,chrom='chr1', pos=12345,
+            id='rs123456',ref='G',alt='A')
+        self.secret = settings.PREDEFINED_SECRET
+        self.valid_payload = [
+            {'chrom': 'chrX', 'pos': 123456, 'id':'rs1', 'ref':"G", 'alt':"A"},
+            {'chrom': 'chr2', 'pos': 123, 'id':'rs2', 'ref':"C", 'alt':"T"},
+            {'chrom': 'chrM', 'pos': 5, 'id':'rs3', 'ref':"A", 'alt':"."},
+        ]
+
+    def test_bulk_create_valid_rows(self):
+        """
+        Test Creating many rows in one request with a single file update
+        """
+        response = self.client.post(reverse('vcfrow-list'),
+            data=json.dumps(self.valid_payload),content_type='application/json',
+            HTTP_AUTHORIZATION=self.secret)
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual([OrderedDict(row) for row in response.data],
+            [OrderedDict(row) for row in self.valid_payload])
+        rows = VcfRow.objects.filter(sort_key__gt=7)
+        self.assertEqual([row.sort_key for row in rows],
+            [7 + SORT_KEY_GAP, 7 + 2 * SORT_KEY_GAP, 7 + 3 * SORT_KEY_GAP])
+        self.assertEqual([row.id for row in rows],['rs1','rs2','rs3'])
+        self.assertEqual(list(RowEvent.objects.filter(row_id__in=[row.row_id for row in rows])
+            .values_list('sort_key', 'kind', 'id')), [(row.sort_key, RowEvent.CREATED, row.id)
+                for row in rows])
+        self.assertEqual(list(OutboxEvent.objects.values_list('vcf_id','changes')),
+            [(self.vcf.id,3)])
+
+    def test_bulk_create_constant_queries(self):
+        """
+        Test that only the number of bulk insert batches depends on the number of rows
+        """
+        queries = []
+        for size in (1, 200):
+            payload = [dict(self.valid_payload[0], id=f'rs{i}') for i in range(size)]
+            with CaptureQueriesContext(connection) as context:
+                response = self.client.post(reverse('vcfrow-list'),data=json.dumps(payload),
+                    content_type='application/json',HTTP_AUTHORIZATION=self.secret)
+            self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+            queries.append(len([query for query in context.captured_queries
+                if not query['sql'].startswith('INSERT')]))
+        self.assertEqual(queries[0],queries[1])
+        self.assertEqual(VcfRow.objects.count(),202)
+
+    def test_bulk_create_invalid_row(self):
+        """
+        Test one invalid row rejects the whole batch
+        """
+        self.valid_payload[1]['chrom'] = 'chr23'
+        response = self.client.post(reverse('vcfrow-list'),data=json.dumps(self.valid_payload),
+            content_type='application/json',HTTP_AUTHORIZATION=self.secret)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('chrom', response.data[1])
+        self.assertEqual(VcfRow.objects.count(),1)
+
+    def test_bulk_create_empty(self):
+        """
+        Test an empty list is rejected
+        """
+        response = self.client.post(reverse('vcfrow-list'),data=json.dumps([]),
+            content_type='application/json',HTTP_AUTHORIZATION=self.secret)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_bulk_create_unauth(self):
+        """
+        Test Creating many rows with the wrong secret
+        """
+        response = self.client.post(reverse('vcfrow-list'),data=json.dumps(self.valid_payload),
+            content_type='application/json',HTTP_AUTHORIZATION="Wrong_secret")
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_bulk_create_sorted(self):
+        """
+        Test rows placed in chrom/pos order go in between the existing ones
+        without changing their sort keys
+        """
+        VcfRow.objects.create(vcf_id=self.vcf.id,sort_key=7 + SORT_KEY_GAP,chrom='chr2',
+            pos=500,id='rs500',ref='G',alt='A')
+        response = self.client.post(reverse('vcfrow-list') + '?placement=sorted',
+            data=json.dumps(self.valid_payload),content_type='application/json',
+            HTTP_AUTHORIZATION=self.secret)
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(list(VcfRow.objects.values_list('chrom','pos')),
+            [('chr1',12345),('chr2',123),('chr2',500),('chrX',123456),('chrM',5)])
+        self.assertEqual(list(VcfRow.objects.filter(id__in=['rs123456','rs500'])
+            .values_list('sort_key', flat=True)),[7, 7 + SORT_KEY_GAP])
+
+    def test_bulk_create_sort_key_taken(self):
+        """
+        Test rows whose sort keys another writer took meanwhile get the next free ones
+        """
+        VcfRow.objects.create(vcf_id=self.vcf.id,sort_key=7 + 2 * SORT_KEY_GAP,chrom='chr1',
+            pos=1,id='rs0',ref='G',alt='A')
+        # The first allocation reads the last key from before the other insert
+        with mock.patch.object(VcfRow, 'last_sort_key',
+                side_effect=[7, 7 + 2 * SORT_KEY_GAP]):
+            response = self.client.post(reverse('vcfrow-list'),
+                data=json.dumps(self.valid_payload),content_type='application/json',
+                HTTP_AUTHORIZATION=self.secret)
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(list(VcfRow.objects.values_list('id', flat=True)),
+            ['rs123456','rs0','rs1','rs2','rs3'])
+        # The events of the rejected attempt are rolled back with it
+        self.assertEqual(RowEvent.objects.filter(kind=RowEvent.CREATED).count(),3)
+
+    def test_bulk_create_invalid_placement(self):
+        """
+        Test an unknown placement is rejected
+        """
+        response = self.client.post(reverse('vcfrow-list') + '?placement=middle',
+            data=json.dumps(self.valid_payload),content_type='application/json',
+            HTTP_AUTHORIZATION=self.secret)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(VcfRow.objects.count(),1)
@@ -4,10 +4,15 @@ This module Contains various tests for the views DELETE functionality
 import json
 from rest_framework import status
 from django.test import TestCase
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 from django.conf import settings
 from vcfApi.models import Vcf
 from vcfApi.models import VcfRow
+from vcfApi.models import OutboxEvent
+from vcfApi.models import RowEvent
+from vcfApi.models import RowCount
 from vcfApi.serializers import VcfRowSerializer
 
 class DeleteVcfRowTest(TestCase):
@@ -65,3 +70,95 @@ class DeleteVcfRowTest(TestCase):
         response = self.client.delete(reverse('vcfrow-detail',kwargs={'id': self.row1.id}),
             content_type='application/json',HTTP_AUTHORIZATION="Wrong_secret")
         self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_delete_constant_queries(self):
+        """
+        Test Deleting the rows sharing an id runs the same queries whatever their number
+        """
+        queries = []
+        for rsid, size in (('rs1', 1), ('rs2', 50)):
+            VcfRow.objects.bulk_create([VcfRow(vcf_id=self.vcf.id,sort_key=i,chrom='chr2',
+                pos=i,id=rsid,ref='G',alt='A') for i in range(1, size + 1)])
+            deleted = RowEvent.deletions().count()
+            with CaptureQueriesContext(connection) as context:
+                response = self.client.delete(reverse('vcfrow-detail',kwargs={'id': rsid}),
+                    HTTP_AUTHORIZATION=self.secret)
+            self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+            self.assertEqual(RowEvent.deletions().count() - deleted, size)
+            queries.append(len(context.captured_queries))
+        self.assertEqual(queries[0],queries[1])
+        self.assertEqual(VcfRow.objects.filter(chrom='chr2').count(),0)
+
+class BulkDeleteVcfRowTest(TestCase):
+    """ Test module for the filter based bulk Destroy VcfRow API """
+
+    def setUp(self):
+        """
+        DB Setup
+        """
+        self.vcf = Vcf.objects.create(name='file1.vcf', fullpath='path/to/file/file1.vcf')
+        for line_id, (chrom, pos, alt) in enumerate([('chr1', 100, 'A'), ('chr1', 200, 'T'),
+                ('chr2', 100, 'A'), ('chr2', 300, 'G')], start=1):
+            VcfRow.objects.create(vcf_id=self.vcf.id,sort_key=line_id,chrom=chrom,pos=pos,
+                id=f'rs{line_id}',ref='C',alt=alt)
+        RowCount.set_total(self.vcf.id, 4)
+        self.secret = settings.PREDEFINED_SECRET
+
+    def test_bulk_delete_filtered_rows(self):
+        """
+        Test Deleting all the rows matching a filter with a single file update
+        """
+        response = self.client.delete(reverse('vcfrow-list')+"?alt=A",
+            HTTP_AUTHORIZATION=self.secret)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data, {"count": 2})
+        self.assertEqual(list(VcfRow.objects.values_list('id', flat=True)), ['rs2', 'rs4'])
+        self.assertEqual(sorted(RowEvent.deletions().values_list('sort_key', flat=True)), [1, 3])
+        self.assertEqual(RowCount.get_count({}), 2)
+        self.assertEqual(list(OutboxEvent.objects.values_list('vcf_id','changes')),
+            [(self.vcf.id,2)])
+
+    def test_bulk_delete_region(self):
+        """
+        Test Deleting the rows of a region
+        """
+        response = self.client.delete(reverse('vcfrow-list')+"?region=chr2:1-200",
+            HTTP_AUTHORIZATION=self.secret)
+        self.assertEqual(response.data, {"count": 1})
+        self.assertFalse(VcfRow.objects.filter(id='rs3').exists())
+
+    def test_bulk_delete_dry_run(self):
+        """
+        Test a dry run only returns the number of rows that would be deleted
+        """
+        response = self.client.delete(reverse('vcfrow-list')+"?chrom=chr1&dry_run=true",
+            HTTP_AUTHORIZATION=self.secret)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data, {"count": 2, "dry_run": True})
+        self.assertEqual(VcfRow.objects.count(), 4)
+        self.assertEqual(RowEvent.deletions().count(), 0)
+
+    def test_bulk_delete_requires_filter(self):
+        """
+        Test a bulk delete without filters is rejected
+        """
+        response = self.client.delete(reverse('vcfrow-list'),HTTP_AUTHORIZATION=self.secret)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(VcfRow.objects.count(), 4)
+
+    def test_bulk_delete_no_match(self):
+        """
+        Test a bulk delete matching no rows
+        """
+        response = self.client.delete(reverse('vcfrow-list')+"?chrom=chr9",
+            HTTP_AUTHORIZATION=self.secret)
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_bulk_delete_wrong_secret(self):
+        """
+        Test a bulk delete with the wrong secret
+        """
+        response = self.client.delete(reverse('vcfrow-list')+"?chrom=chr1",
+            HTTP_AUTHORIZATION="Wrong_secret")
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+        self.assertEqual(VcfRow.objects.count(), 4)
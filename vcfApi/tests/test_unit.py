@@ -2,13 +2,72 @@
 Test various Helper functions and methods
 """
 import os
+import gzip
+import shutil
 import vcfpy
-# import tempfile
+import datetime
+import tempfile
+from array import array
+from unittest import mock
+from django.db import transaction
+from django.db import DatabaseError
+from django.db.models.signals import post_save
+from django.db.models.signals import post_delete
+from django.core.management import call_command
 from django.test import TestCase
-# from django.test import override_settings
+from django.test import override_settings
+from django.utils import timezone
 import vcfApi.query as query
 from vcfApi.models import Vcf
-from vcfApi.management.commands.update_db import insert_vcf_file 
+from vcfApi.models import VcfRow
+from vcfApi.models import ImportCheckpoint
+from vcfApi.models import RowCount
+from vcfApi.models import RowEvent
+from vcfApi.management.commands.update_db import insert_vcf_file
+from vcfApi.management.commands.update_db import iter_parallel_batches
+from vcfApi.management.commands.benchmark import endpoint_querysets
+from vcfApi.management.commands.benchmark import is_full_scan
+from vcfApi.management.commands.benchmark import is_slow_plan
+from vcfApi.vcfio import parse_vcf_chunk
+from vcfApi.vcfio import split_byte_ranges
+from vcfApi.vcfio import file_fingerprint
+from vcfApi.dispatch import request_file_update
+from vcfApi.outbox import relay_outbox
+from vcfApi.models import OutboxEvent
+from vcfApi.serializers import VcfRowSerializer
+from vcfApi.tasks import modify_file_rows
+from vcfApi.tasks import compact_row_events
+from vcfApi.tasks import iter_row_changes
+from vcfApi.bulk import bulk_update_rows
+from vcfApi.bulk import bulk_delete_rows
+from vcfApi.filesync import LineIndex
+from vcfApi.filesync import StaleIndexError
+from vcfApi.filesync import default_keys
+from vcfApi.filesync import scan_offsets
+from vcfApi.filesync import restore_line_keys
+from vcfApi.filesync import JOURNAL_SUFFIX
+from vcfApi.filesync import JOURNAL_HEADER
+from vcfApi.filesync import JOURNAL_MAGIC
+from vcfApi.filesync import apply_journal
+from vcfApi.filesync import APPEND_SUFFIX
+from vcfApi.filesync import write_append_marker
+from vcfApi.filesync import undo_append
+from vcfApi.filesync import patch_file
+from vcfApi.filesync import sync_file
+from vcfApi.filesync import merge_changes
+from vcfApi.filesync import SORT_KEY_GAP
+from vcfApi.filesync import KEYS_SUFFIX
+from vcfApi.filesync import write_part
+from vcfApi.filesync import get_part_path
+from vcfApi.bgzf import TABIX_SUFFIX
+from vcfApi.bgzf import BgzfWriter
+from vcfApi.bgzf import BgzfReader
+from vcfApi.bgzf import TabixIndex
+from vcfApi.bgzf import read_region
+from vcfApi.segments import Manifest
+from vcfApi.segments import SEGMENTS_SUFFIX
+from saph_assignment.celery import app as celery_app
+from vcfApi.models import SORT_KEY_STEP
 
 VALID_METADICT_SAMPLE = {'TERM_PROGRAM': 'Apple_Terminal', 'TERM': 'xterm-256color', 'SHELL': '/bin/bash',
 'TMPDIR': '/var/folders/8b/4k6l5n6j1xv1lts_4kmnmxc00000gn/T/', 'TERM_PROGRAM_VERSION': '453',
@@ -113,32 +172,1011 @@ class TestVcfModelMethods(TestCase):
         self.vcf = self.vcf.set_needsupdate(False)
         self.assertEqual(self.vcf.needs_update,False)
 
-# TODO See if we can convince vcfpy to read mock files. 
-# Otherwise we need to find out how to construct a minimal acceptable 
-# header for this test...
-# class TestVcfImporting(TestCase):
-#     """
-#     Test the VCF file importer
-#     """
-#
-#     @override_settings(MEDIA_ROOT=tempfile.gettempdir())
-#     def test_vcf_fileimport(self):
-#         """
-#         Test Vcf importing in the DB via a mock file
-#         """
-#         temp_file = tempfile.NamedTemporaryFile()
-#         header = vcfpy.Header(samples=vcfpy.SamplesInfos([]))
-#         with vcfpy.Writer.from_path(temp_file.name, header) as writer:
-#             record = vcfpy.Record(
-#                 CHROM="chr1", POS=1, ID=["rs12345"], REF="G", ALT=[vcfpy.Substitution(type_="SNV",value="A")],
-#                   QUAL=None, FILTER=[], INFO={}, FORMAT=[]
-#             )
-#             writer.write_record(record)
-#
-#         insert_vcf_file("tmp.vcf",temp_file.name)
-#         print(Vcf.objects.all())
-#         vcf_file = Vcf.objects.get(name="tmp.vcf")
-#         vcfrow =  Vcf.objects.get(chrom="chr1")
-#         self.assertEqual(vcfrow.id,"rs12345")
-#         self.assertEqual(vcfrow.alt,"A")
-#         temp_file.close()
+    def test_sorted_sort_key(self):
+        """
+        Test new rows are placed in chrom/pos order between the existing sort keys
+        and that a full gap is reported
+        """
+        for sort_key, pos in ((SORT_KEY_GAP, 100), (2 * SORT_KEY_GAP, 300),
+                (2 * SORT_KEY_GAP + 1, 400)):
+            VcfRow.objects.create(vcf=self.vcf,sort_key=sort_key,chrom='chr1',pos=pos,
+                ref='A',alt='G')
+        self.assertEqual(VcfRow.sorted_sort_key(self.vcf.id, 'chr1', 50),SORT_KEY_STEP)
+        self.assertEqual(VcfRow.sorted_sort_key(self.vcf.id, 'chr1', 200),
+            SORT_KEY_GAP + SORT_KEY_STEP)
+        self.assertIsNone(VcfRow.sorted_sort_key(self.vcf.id, 'chr1', 350))
+        self.assertEqual(VcfRow.sorted_sort_key(self.vcf.id, 'chr1', 500),3 * SORT_KEY_GAP + 1)
+        self.assertEqual(VcfRow.sorted_sort_key(self.vcf.id, 'chr2', 1),3 * SORT_KEY_GAP + 1)
+
+VCF_SAMPLE_HEADER = (
+    "##fileformat=VCFv4.2\n"
+    "##contig=<ID=chr1>\n"
+    "#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tNA12877\n"
+)
+VCF_SAMPLE_BODY = (
+    "chr1\t13118\trs62028691\tA\tG\t50\tPASS\tDP=10\tGT\t0/1\n"
+    "chr1\t13656\t.\tCAG\tC\t50\tPASS\tDP=12\tGT\t1/1\n"
+    "chr2\t1235\trs1234;rs5678\tA\tG,T\t.\t.\t.\tGT\t1/2\n"
+)
+
+def write_sample_vcf(body=VCF_SAMPLE_BODY, header=VCF_SAMPLE_HEADER):
+    """
+    Write a small VCF file to a temporary location and return its path
+    """
+    temp_file = tempfile.NamedTemporaryFile(mode='w', suffix='.vcf', delete=False)
+    temp_file.write(header + body)
+    temp_file.close()
+    return temp_file.name
+
+def connect_row_signals(test):
+    """
+    Connect the row signals for the duration of a test, the test settings leave them out
+    """
+    # Importing the module connects the receivers the first time only
+    import vcfApi.signals as signals
+    for signal, receiver, uid in (
+            (post_save, signals.handle_vcfrowpostsave, signals.VCFROW_CMP_POST_SAVE_UUID),
+            (post_delete, signals.handle_vcfrowpostdelete, signals.VCFROW_CMP_POST_DELETE_UUID)):
+        signal.connect(receiver, sender=VcfRow, weak=False, dispatch_uid=uid)
+        test.addCleanup(signal.disconnect, sender=VcfRow, dispatch_uid=uid)
+
+class TestVcfImporting(TestCase):
+    """
+    Test the VCF file importer
+    """
+    def setUp(self):
+        """
+        Write the sample file
+        """
+        self.path = write_sample_vcf()
+
+    def tearDown(self):
+        """
+        Remove the sample file
+        """
+        os.remove(self.path)
+
+    def test_vcf_fileimport(self):
+        """
+        Test Vcf importing in the DB via a temporary file
+        """
+        cnt = insert_vcf_file("tmp.vcf",self.path,batch_size=2)
+        self.assertEqual(cnt,3)
+        vcf_file = Vcf.objects.get(name="tmp.vcf")
+        rows = list(VcfRow.objects.filter(vcf_id=vcf_file.id))
+        self.assertEqual([row.sort_key for row in rows],
+            [SORT_KEY_GAP, 2 * SORT_KEY_GAP, 3 * SORT_KEY_GAP])
+        self.assertEqual(rows[0].id,"rs62028691")
+        self.assertEqual(rows[0].alt,"G")
+        self.assertEqual(rows[1].id,"")
+        self.assertEqual(rows[1].ref,"CAG")
+        self.assertEqual(rows[2].id,"rs1234;rs5678")
+        self.assertEqual(rows[2].alt,"GT")
+        self.assertFalse(RowEvent.objects.exists())
+
+    def test_vcf_fileimport_matches_vcfpy(self):
+        """
+        Test that the tokenizer stores the same values the vcfpy parser produces
+        """
+        insert_vcf_file("tmp.vcf",self.path)
+        reader = vcfpy.Reader.from_path(self.path)
+        for row, record in zip(VcfRow.objects.all(), reader):
+            self.assertEqual(row.chrom,record.CHROM)
+            self.assertEqual(row.pos,record.POS)
+            self.assertEqual(row.id,";".join(record.ID))
+            self.assertEqual(row.ref,record.REF)
+            self.assertEqual(row.alt,"".join(alt.value for alt in record.ALT))
+
+    def test_vcf_fileimport_replaces_previous(self):
+        """
+        Test that a reimport replaces the previously imported file
+        """
+        insert_vcf_file("tmp.vcf",self.path)
+        insert_vcf_file("tmp2.vcf",self.path)
+        self.assertEqual(Vcf.objects.count(),1)
+        self.assertEqual(VcfRow.objects.count(),3)
+
+    def test_vcf_fileimport_no_header(self):
+        """
+        Test that a file without the #CHROM header line is rejected and nothing is stored
+        """
+        os.remove(self.path)
+        self.path = write_sample_vcf(header="")
+        insert_vcf_file("tmp.vcf",self.path)
+        self.assertEqual(Vcf.objects.count(),0)
+        self.assertEqual(VcfRow.objects.count(),0)
+
+    def test_vcf_fileimport_workers(self):
+        """
+        Test that a parallel import stores the same rows and line numbers as a sequential one
+        """
+        insert_vcf_file("tmp.vcf",self.path)
+        expected = list(VcfRow.objects.values_list('sort_key','chrom','pos','id','ref','alt'))
+        cnt = insert_vcf_file("tmp.vcf",self.path,workers=2)
+        self.assertEqual(cnt,3)
+        result = list(VcfRow.objects.values_list('sort_key','chrom','pos','id','ref','alt'))
+        self.assertEqual(result,expected)
+
+    def test_vcf_chunks_cover_every_line_once(self):
+        """
+        Test that unaligned byte ranges yield every body line exactly once and in order
+        """
+        ranges = split_byte_ranges(self.path, 7, min_chunk_size=1)
+        self.assertEqual(len(ranges),7)
+        rows = []
+        for start, end in ranges:
+            rows.extend(parse_vcf_chunk((self.path, start, end)))
+        self.assertEqual([row[1] for row in rows],[13118,13656,1235])
+
+    def test_vcf_parallel_chunks_bounded(self):
+        """
+        Test that the parallel parser only keeps a bounded window of chunks in flight
+        """
+        submitted = []
+
+        class InlinePool:
+            def __init__(self, workers):
+                pass
+            def __enter__(self):
+                return self
+            def __exit__(self, *args):
+                return False
+            def apply_async(self, func, args):
+                submitted.append(args)
+                return mock.Mock(get=lambda: func(*args))
+
+        ranges = split_byte_ranges(self.path, 7, min_chunk_size=1)
+        in_flight = []
+        rows = []
+        with mock.patch('vcfApi.management.commands.update_db.multiprocessing.Pool',
+                InlinePool), \
+                mock.patch('vcfApi.management.commands.update_db.split_byte_ranges',
+                return_value=ranges):
+            for count, (batch, _) in enumerate(iter_parallel_batches(self.path, 1), start=1):
+                in_flight.append(len(submitted) - count)
+                rows.extend(batch)
+        self.assertEqual(len(submitted),7)
+        self.assertLessEqual(max(in_flight),1)
+        self.assertEqual([row[1] for row in rows],[13118,13656,1235])
+
+    def test_vcf_fileimport_resume(self):
+        """
+        Test that a resumed import continues after the checkpoint without duplicating rows
+        """
+        insert_vcf_file("tmp.vcf",self.path)
+        vcf_file = Vcf.objects.get(name="tmp.vcf")
+        # Simulate an import that crashed after committing the first line
+        VcfRow.objects.filter(sort_key__gt=SORT_KEY_GAP).delete()
+        first_line_end = len(VCF_SAMPLE_HEADER) + len(VCF_SAMPLE_BODY.splitlines(True)[0])
+        ImportCheckpoint.objects.create(vcf=vcf_file,fingerprint=file_fingerprint(self.path),
+            byte_offset=first_line_end,line_id=1)
+        cnt = insert_vcf_file("tmp.vcf",self.path,resume=True)
+        self.assertEqual(cnt,2)
+        self.assertEqual(Vcf.objects.get().id,vcf_file.id)
+        self.assertEqual(list(VcfRow.objects.values_list('sort_key','pos')),
+            [(SORT_KEY_GAP,13118),(2 * SORT_KEY_GAP,13656),(3 * SORT_KEY_GAP,1235)])
+        self.assertEqual(ImportCheckpoint.objects.count(),0)
+
+    def test_vcf_fileimport_resume_parallel(self):
+        """
+        Test that a resume from an unaligned range end picks up the following line
+        """
+        insert_vcf_file("tmp.vcf",self.path)
+        vcf_file = Vcf.objects.get(name="tmp.vcf")
+        VcfRow.objects.filter(sort_key__gt=SORT_KEY_GAP).delete()
+        # A range end inside the second line means the second line belongs to the next range
+        first_line_end = len(VCF_SAMPLE_HEADER) + len(VCF_SAMPLE_BODY.splitlines(True)[0])
+        ImportCheckpoint.objects.create(vcf=vcf_file,fingerprint=file_fingerprint(self.path),
+            byte_offset=first_line_end + 1,line_id=1)
+        insert_vcf_file("tmp.vcf",self.path,workers=2,resume=True)
+        self.assertEqual(list(VcfRow.objects.values_list('sort_key','pos')),
+            [(SORT_KEY_GAP,13118),(2 * SORT_KEY_GAP,1235)])
+
+    def test_vcf_fileimport_checkpoint_on_failure(self):
+        """
+        Test that a failing import keeps the committed batches and their checkpoint
+        """
+        os.remove(self.path)
+        self.path = write_sample_vcf(body=VCF_SAMPLE_BODY.replace("13656","bad_pos"))
+        insert_vcf_file("tmp.vcf",self.path,batch_size=1)
+        checkpoint = ImportCheckpoint.objects.get()
+        self.assertEqual(checkpoint.line_id,1)
+        self.assertEqual(VcfRow.objects.count(),1)
+        self.assertEqual(checkpoint.fingerprint,file_fingerprint(self.path))
+
+class TestQueryPlans(TestCase):
+    """
+    Test that the hot path queries are served by indexes
+    """
+    def setUp(self):
+        """
+        DB Setup
+        """
+        self.vcf = Vcf.objects.create(name='file1.vcf', fullpath='path/to/file/file1.vcf')
+        for line_id in range(1, 6):
+            VcfRow.objects.create(vcf_id=self.vcf.id,sort_key=line_id,chrom='chr1',
+                pos=1000 + line_id,id=f'rs{line_id}',ref='G',alt='A')
+
+    def test_no_full_table_scans(self):
+        """
+        Test that none of the endpoint and task queries scans the whole table
+        or misses the (vcf, ...) index it is scoped for
+        """
+        sample_row = VcfRow.objects.last()
+        for name, queryset in endpoint_querysets(sample_row):
+            plan = queryset.explain()
+            self.assertFalse(is_slow_plan(name, plan),
+                f"{name} is not served by its index:\n{plan}")
+
+    def test_full_table_scan_detected(self):
+        """
+        Test that an unindexed query is reported as a full table scan
+        """
+        plan = VcfRow.objects.filter(alt='A').order_by('ref').explain()
+        self.assertTrue(is_full_scan(plan))
+
+class TestRegionFunctions(TestCase):
+    """
+    Test the region query helper functions
+    """
+    def test_parse_region(self):
+        """
+        Test parsing the supported region formats
+        """
+        self.assertEqual(query.parse_region("chr7:117,480,000-117,670,000"),
+            ("chr7",117480000,117670000))
+        self.assertEqual(query.parse_region("chrX:100"),("chrX",100,None))
+        self.assertEqual(query.parse_region("chr1"),("chr1",None,None))
+
+    def test_parse_region_invalid(self):
+        """
+        Test parsing invalid regions
+        """
+        for region in ["chr1:a-b", "chr1:10-5", "", "chr1:1-2-3"]:
+            with self.assertRaises(ValueError):
+                query.parse_region(region)
+
+    def test_get_query_values(self):
+        """
+        Test getting the values of a repeated parameter
+        """
+        metadict = {'QUERY_STRING': 'region=chr1%3A1-10&pos=5&region=chr2&region='}
+        self.assertEqual(query.get_query_values(metadict,'region'),['chr1:1-10','chr2'])
+        self.assertEqual(query.get_query_values({},'region'),[])
+
+    def test_region_query_uses_index(self):
+        """
+        Test that every region of a file is a range search on the (vcf, chrom, pos) index
+        """
+        plan = VcfRow.objects.filter(query.region_query(["chr1:1-100", "chr2:5-9"], 1)).explain()
+        self.assertEqual(plan.count("vcfrow_vcf_chrom_pos_idx"),2)
+        self.assertFalse(is_full_scan(plan))
+
+class TestRowCounts(TestCase):
+    """
+    Test the maintained row counters
+    """
+    def setUp(self):
+        """
+        DB Setup
+        """
+        self.vcf = Vcf.objects.create(name='file1.vcf', fullpath='path/to/file/file1.vcf')
+        for line_id, chrom in enumerate(['chr1', 'chr1', 'chr2'], start=1):
+            VcfRow.objects.create(vcf_id=self.vcf.id,sort_key=line_id,chrom=chrom,
+                pos=1000 + line_id,id=f'rs{line_id}',ref='G',alt='A')
+
+    def test_get_count(self):
+        """
+        Test counters are computed once and then served from the table
+        """
+        self.assertEqual(RowCount.get_count({}),3)
+        self.assertEqual(RowCount.get_count({'chrom':'chr1'}),2)
+        self.assertEqual(RowCount.objects.count(),2)
+        with self.assertNumQueries(1):
+            self.assertEqual(RowCount.get_count({'chrom':'chr1'}),2)
+
+    def test_get_count_not_counted(self):
+        """
+        Test selective filters are not counted
+        """
+        self.assertEqual(RowCount.get_count({'pos':'1001'}),None)
+        self.assertEqual(RowCount.get_filter_key({'ref':'G','chrom':'chr1'}),'chrom=chr1&ref=G')
+
+    def test_get_count_not_stored(self):
+        """
+        Test filter values without rows or past the cap are counted but not stored
+        """
+        self.assertEqual(RowCount.get_count({'chrom':'chrUnknown'}),0)
+        self.assertEqual(RowCount.objects.count(),0)
+        with mock.patch('vcfApi.models.MAX_FILTER_COUNTERS', 1):
+            self.assertEqual(RowCount.get_count({'chrom':'chr1'}),2)
+            self.assertEqual(RowCount.get_count({'chrom':'chr2'}),1)
+        self.assertEqual(list(RowCount.objects.values_list('filter_key',flat=True)),
+            ['chrom=chr1'])
+
+    def test_filter_key_length(self):
+        """
+        Test the longest counted key fits the column and longer values are not counted
+        """
+        filters = {'chrom':'c' * 50, 'ref':'G' * 100, 'alt':'A' * 100}
+        key = RowCount.get_filter_key(filters)
+        self.assertEqual(len(key),RowCount._meta.get_field('filter_key').max_length)
+        self.assertEqual(RowCount.get_filter_key({'chrom':'c' * 51}),None)
+
+    def test_add_remove_row(self):
+        """
+        Test row creation and deletion adjust the matching counters only
+        """
+        RowCount.get_count({})
+        RowCount.get_count({'chrom':'chr1'})
+        RowCount.get_count({'chrom':'chr2'})
+        row = VcfRow.objects.create(vcf_id=self.vcf.id,sort_key=4,chrom='chr2',
+            pos=1004,id='rs4',ref='G',alt='A')
+        RowCount.add_row(row)
+        self.assertEqual(RowCount.get_count({}),4)
+        self.assertEqual(RowCount.get_count({'chrom':'chr1'}),2)
+        self.assertEqual(RowCount.get_count({'chrom':'chr2'}),2)
+        RowCount.remove_row(row)
+        self.assertEqual(RowCount.get_count({}),3)
+        self.assertEqual(RowCount.get_count({'chrom':'chr2'}),1)
+
+    def test_add_row_matching_keys(self):
+        """
+        Test a created row only updates the counters of its own values, with a single
+        statement whatever the number of stored counters, and a null value matches none
+        """
+        RowCount.get_count({})
+        RowCount.get_count({'chrom':'chr1','ref':'G'})
+        RowCount.objects.bulk_create([RowCount(vcf_id=self.vcf.id,filter_key=f'chrom=chr{number}',
+            count=1) for number in range(3, 500)] + [RowCount(vcf_id=self.vcf.id,
+            filter_key='alt=None',count=1)])
+        row = VcfRow(vcf_id=self.vcf.id,sort_key=4,chrom='chr1',pos=1004,ref='G',alt=None)
+        with self.assertNumQueries(1):
+            RowCount.add_row(row)
+        self.assertEqual(RowCount.get_count({}),4)
+        self.assertEqual(RowCount.get_count({'chrom':'chr1','ref':'G'}),3)
+        self.assertEqual(RowCount.get_count({'alt':'None'}),1)
+        self.assertEqual(sorted(RowCount.get_row_keys(row)),
+            ['', 'chrom=chr1', 'chrom=chr1&ref=G', 'ref=G'])
+
+    def test_invalidate(self):
+        """
+        Test modifications drop the filtered counters but keep the total
+        """
+        RowCount.get_count({})
+        RowCount.get_count({'chrom':'chr1'})
+        RowCount.invalidate(self.vcf.id)
+        self.assertEqual(list(RowCount.objects.values_list('filter_key',flat=True)),[''])
+
+    def test_reconcile(self):
+        """
+        Test the reconcile job corrects drifted counters
+        """
+        RowCount.get_count({})
+        RowCount.get_count({'chrom':'chr1'})
+        VcfRow.objects.filter(chrom='chr1').delete()
+        self.assertEqual(RowCount.reconcile(),2)
+        self.assertEqual(RowCount.get_count({}),1)
+        self.assertEqual(RowCount.get_count({'chrom':'chr1'}),0)
+        self.assertEqual(RowCount.reconcile(),0)
+
+    def test_import_sets_total(self):
+        """
+        Test the importer stores the total of the imported file
+        """
+        path = write_sample_vcf()
+        insert_vcf_file("tmp.vcf",path)
+        os.remove(path)
+        vcf_file = Vcf.objects.get()
+        self.assertEqual(RowCount.objects.get(vcf_id=vcf_file.id,filter_key='').count,3)
+
+@override_settings(VCFAPI_SYNC_DEBOUNCE=2.0, VCFAPI_SYNC_MAX_LATENCY=10.0)
+class TestSyncDispatch(TestCase):
+    """
+    Test the coalescing of row changes into file rewrites
+    """
+    def setUp(self):
+        """
+        DB Setup
+        """
+        self.vcf = Vcf.objects.create(name='file1.vcf', fullpath='path/to/file/file1.vcf')
+
+    def test_changes_coalesced(self):
+        """
+        Test a burst of changes is relayed as a single scheduled task and is counted
+        """
+        for changes in (1, 5, 1):
+            request_file_update(self.vcf.id, changes)
+        self.assertEqual(OutboxEvent.objects.count(),3)
+        with mock.patch('vcfApi.outbox.modify_file_rows.apply_async') as apply_async:
+            self.assertEqual(relay_outbox(),3)
+            request_file_update(self.vcf.id)
+            self.assertEqual(relay_outbox(),1)
+        apply_async.assert_called_once_with((self.vcf.id,), countdown=2.0)
+        self.assertEqual(OutboxEvent.objects.count(),0)
+        vcf_file = Vcf.objects.get(id=self.vcf.id)
+        self.assertTrue(vcf_file.needs_update and vcf_file.is_updating)
+        self.assertEqual(vcf_file.pending_changes,8)
+        self.assertLessEqual(vcf_file.first_change,vcf_file.last_change)
+        self.assertEqual(vcf_file.claim_changes(),8)
+        vcf_file = Vcf.objects.get(id=self.vcf.id)
+        self.assertFalse(vcf_file.needs_update)
+        self.assertEqual((vcf_file.pending_changes,vcf_file.first_change),(0,None))
+
+    def test_outbox_rollback(self):
+        """
+        Test a rolled back change leaves nothing to relay
+        """
+        try:
+            with transaction.atomic():
+                serializer = VcfRowSerializer(data=[{'chrom': 'chr1', 'pos': 1, 'id': 'rs1',
+                    'ref': 'A', 'alt': 'G'}], many=True)
+                serializer.is_valid(raise_exception=True)
+                serializer.save()
+                self.assertEqual(OutboxEvent.objects.count(),1)
+                raise RuntimeError("rollback")
+        except RuntimeError:
+            pass
+        self.assertEqual(OutboxEvent.objects.count(),0)
+        with mock.patch('vcfApi.outbox.modify_file_rows.apply_async') as apply_async:
+            self.assertEqual(relay_outbox(),0)
+        apply_async.assert_not_called()
+
+    def test_outbox_failure_rolls_back_row(self):
+        """
+        Test a single row is not committed when its file update can not be recorded
+        """
+        connect_row_signals(self)
+        serializer = VcfRowSerializer(data={'chrom': 'chr1', 'pos': 1, 'id': 'rs1',
+            'ref': 'A', 'alt': 'G'})
+        serializer.is_valid(raise_exception=True)
+        with mock.patch('vcfApi.dispatch.OutboxEvent.objects.create',
+                side_effect=DatabaseError("outbox")):
+            with self.assertRaises(DatabaseError):
+                serializer.save()
+        self.assertEqual(VcfRow.objects.count(),0)
+        self.assertEqual(RowEvent.objects.count(),0)
+
+    def test_event_failure_rolls_back_row(self):
+        """
+        Test a row change is not committed when its journal event can not be written
+        """
+        connect_row_signals(self)
+        row = VcfRow(vcf_id=self.vcf.id,sort_key=SORT_KEY_GAP,chrom='chr1',pos=1,id='rs1',
+            ref='A',alt='G')
+        with mock.patch.object(RowEvent, 'save', side_effect=DatabaseError("journal")):
+            with self.assertRaises(DatabaseError):
+                row.save()
+        self.assertEqual(VcfRow.objects.count(),0)
+        row = VcfRow(vcf_id=self.vcf.id,sort_key=SORT_KEY_GAP,chrom='chr1',pos=1,id='rs1',
+            ref='A',alt='G')
+        row.save()
+        row.alt = 'T'
+        with mock.patch.object(RowEvent, 'save', side_effect=DatabaseError("journal")):
+            with self.assertRaises(DatabaseError):
+                row.save()
+            with self.assertRaises(DatabaseError):
+                row.delete()
+        self.assertEqual(list(VcfRow.objects.values_list('alt',flat=True)),['G'])
+        self.assertEqual(list(RowEvent.objects.values_list('kind',flat=True)),
+            [RowEvent.CREATED])
+        self.assertEqual(OutboxEvent.objects.count(),1)
+
+    def test_sync_delay(self):
+        """
+        Test the debounce window restarts on changes but is bounded by the max latency
+        """
+        now = timezone.now()
+        self.assertEqual(self.vcf.get_sync_delay(now),0)
+        self.vcf.first_change = now - datetime.timedelta(seconds=1)
+        self.vcf.last_change = now - datetime.timedelta(seconds=0.5)
+        self.assertEqual(self.vcf.get_sync_delay(now),1.5)
+        self.vcf.first_change = now - datetime.timedelta(seconds=9)
+        self.assertEqual(self.vcf.get_sync_delay(now),1.0)
+        self.vcf.first_change = now - datetime.timedelta(seconds=11)
+        self.assertEqual(self.vcf.get_sync_delay(now),0)
+
+    def test_task_deferred(self):
+        """
+        Test the file modify task postpones itself while changes keep coming in
+        """
+        now = timezone.now()
+        Vcf.objects.filter(id=self.vcf.id).update(needs_update=True, is_updating=True,
+            pending_changes=3, first_change=now, last_change=now)
+        with mock.patch('vcfApi.tasks.modify_file_rows.apply_async') as apply_async:
+            self.assertEqual(modify_file_rows(self.vcf.id),'deferred')
+        self.assertEqual(apply_async.call_args.args[0],(self.vcf.id,))
+        self.assertGreater(apply_async.call_args.kwargs['countdown'],0)
+        vcf_file = Vcf.objects.get(id=self.vcf.id)
+        self.assertTrue(vcf_file.is_updating)
+        self.assertEqual(vcf_file.pending_changes,3)
+
+class TestFileSync(TestCase):
+    """
+    Test the transfer of row changes to the VCF file
+    """
+    def setUp(self):
+        """
+        Write a sample file, indexed with the sort keys it is imported with
+        """
+        self.path = write_sample_vcf()
+        LineIndex.get(self.path, default_keys)
+
+    def tearDown(self):
+        """
+        Remove the sample file and its index
+        """
+        for path in (self.path, self.path + '.lidx', self.path + APPEND_SUFFIX,
+                self.path + '.gz', self.path + '.gz' + TABIX_SUFFIX, self.path + '.gz' + KEYS_SUFFIX):
+            if os.path.isfile(path):
+                os.remove(path)
+        shutil.rmtree(self.path + SEGMENTS_SUFFIX, ignore_errors=True)
+
+    def read_body(self):
+        """
+        Read the body lines of the sample file
+        """
+        with open(self.path) as stream:
+            return [line for line in stream if not line.startswith('#')]
+
+    def test_line_index(self):
+        """
+        Test the index is stored, verified and only rebuilt with the keys of the lines
+        when the file changes behind it
+        """
+        index = LineIndex.get(self.path)
+        self.assertEqual(index.line_count,3)
+        self.assertEqual(index.line_offset(1),len(VCF_SAMPLE_HEADER))
+        self.assertEqual(list(LineIndex.load(self.path).offsets),list(index.offsets))
+        with open(self.path, 'a') as stream:
+            stream.write("chr3\t1\t.\tA\tG\t.\t.\t.\tGT\t0/1\n")
+        self.assertIsNone(LineIndex.load(self.path))
+        with self.assertRaises(StaleIndexError):
+            LineIndex.get(self.path)
+        with self.assertRaises(StaleIndexError):
+            LineIndex.get(self.path, lambda count: default_keys(3))
+        self.assertEqual(LineIndex.get(self.path, default_keys).line_count,4)
+
+    def test_scan_offsets(self):
+        """
+        Test the lines with fewer than the fixed columns are skipped like on import
+        """
+        lines = VCF_SAMPLE_BODY.splitlines(True)
+        short_line = "chr1\t13200\t.\tA\n\n"
+        with open(self.path, 'w') as stream:
+            stream.write(VCF_SAMPLE_HEADER + lines[0] + short_line + lines[1])
+        start = len(VCF_SAMPLE_HEADER)
+        self.assertEqual(list(scan_offsets(self.path, start)),
+            [start, start + len(lines[0]) + len(short_line)])
+        insert_vcf_file("tmp.vcf",self.path)
+        self.assertEqual(VcfRow.objects.count(),2)
+        restore_line_keys(self.path, default_keys)
+        self.assertEqual(list(LineIndex.load(self.path).keys),[SORT_KEY_GAP, 2 * SORT_KEY_GAP])
+
+    def test_patch_file(self):
+        """
+        Test only the tail of the file after the first changed line is rewritten
+        """
+        index = LineIndex.get(self.path)
+        second_line = VCF_SAMPLE_BODY.splitlines(True)[1]
+        rewritten = patch_file(index, [(3 * SORT_KEY_GAP, ('chr2', 1236, 'rs1', 'A', 'C')),
+            (4 * SORT_KEY_GAP, ('chrX', 5, '', 'G', ''))])
+        body = self.read_body()
+        self.assertEqual(body[1],second_line)
+        self.assertEqual(body[2],"chr2\t1236\trs1\tA\tC\t.\t.\t.\tGT\t1/2\n")
+        self.assertEqual(body[3],"chrX\t5\t.\tG\t.\t.\t.\t.\tGT\t./.\n")
+        self.assertEqual(rewritten,len(body[2]) + len(body[3]))
+        self.assertEqual(list(LineIndex.load(self.path).offsets),
+            list(scan_offsets(self.path, len(VCF_SAMPLE_HEADER))))
+        patch_file(LineIndex.get(self.path), merge_changes([], [SORT_KEY_GAP, 4 * SORT_KEY_GAP]))
+        self.assertEqual(self.read_body(),[second_line, body[2]])
+        self.assertEqual(list(LineIndex.get(self.path).keys),[2 * SORT_KEY_GAP, 3 * SORT_KEY_GAP])
+
+    def test_rewrite_file(self):
+        """
+        Test a change at the start of the file rewrites a copy with the other lines verbatim
+        """
+        lines = VCF_SAMPLE_BODY.splitlines(True)
+        path, rewritten = sync_file(self.path,
+            [(SORT_KEY_GAP, ('chr1', 13119, 'rs62028691', 'A', 'G'))])
+        self.assertEqual(path,self.path)
+        self.assertEqual(rewritten,os.path.getsize(self.path))
+        self.assertFalse(os.path.isfile(self.path + JOURNAL_SUFFIX))
+        self.assertEqual(self.read_body(),[lines[0].replace('13118','13119')] + lines[1:])
+        self.assertEqual(list(LineIndex.load(self.path).offsets),
+            list(scan_offsets(self.path, len(VCF_SAMPLE_HEADER))))
+
+    def test_change_stream(self):
+        """
+        Test a merged change stream is consumed in one pass: a deletion wins over
+        a change of the same line and lines are appended after a last line without a line end
+        """
+        with open(self.path, 'rb+') as stream:
+            stream.truncate(os.path.getsize(self.path) - 1)
+        LineIndex.get(self.path, default_keys)
+        lines = VCF_SAMPLE_BODY.splitlines(True)
+        changes = merge_changes(iter([(2 * SORT_KEY_GAP, ('chr1', 1, '', 'A', '')),
+            (5 * SORT_KEY_GAP, ('chrX', 5, 'rs5', 'G', 'T'))]), iter([2 * SORT_KEY_GAP]))
+        sync_file(self.path, changes)
+        self.assertEqual(self.read_body(),
+            [lines[0], lines[2], "chrX\t5\trs5\tG\tT\t.\t.\t.\tGT\t./.\n"])
+        self.assertEqual(list(LineIndex.load(self.path).offsets),
+            list(scan_offsets(self.path, len(VCF_SAMPLE_HEADER))))
+
+    def test_convert_file(self):
+        """
+        Test a compressed file is synced to an uncompressed copy with its index
+        """
+        gz_path = self.path + '.gz'
+        with open(self.path, 'rb') as source, gzip.open(gz_path, 'wb') as target:
+            target.write(source.read())
+        os.remove(self.path)
+        with self.assertRaises(StaleIndexError):
+            sync_file(gz_path, [])
+        restore_line_keys(gz_path, default_keys)
+        path, _ = sync_file(gz_path, merge_changes([
+            (SORT_KEY_GAP + 1, ('chr1', 1, 'rs1', 'A', 'C')),
+            (4 * SORT_KEY_GAP, ('chrX', 5, 'rs5', 'G', 'T'))], [2 * SORT_KEY_GAP]))
+        self.assertEqual(path,self.path)
+        self.assertFalse(os.path.isfile(gz_path))
+        lines = VCF_SAMPLE_BODY.splitlines(True)
+        self.assertEqual(self.read_body(), [lines[0], "chr1\t1\trs1\tA\tC\t.\t.\t.\tGT\t./.\n",
+            lines[2], "chrX\t5\trs5\tG\tT\t.\t.\t.\tGT\t./.\n"])
+        self.assertEqual(list(LineIndex.load(self.path).keys),
+            [SORT_KEY_GAP, SORT_KEY_GAP + 1, 3 * SORT_KEY_GAP, 4 * SORT_KEY_GAP])
+
+    def test_compress_file(self):
+        """
+        Test a compressed sync writes a BGZF file with a tabix index, keeps the sort keys
+        of its lines for the next sync and answers region reads from the file
+        """
+        gz_path = self.path + '.gz'
+        lines = VCF_SAMPLE_BODY.splitlines(True)
+        path, rewritten = sync_file(self.path,
+            [(SORT_KEY_GAP + 1, ('chr1', 13500, 'rs1', 'A', 'C'))], compress=True)
+        self.assertEqual(path,gz_path)
+        self.assertEqual(rewritten,os.path.getsize(gz_path))
+        self.assertFalse(os.path.isfile(self.path))
+        self.assertFalse(os.path.isfile(self.path + '.lidx'))
+        new_line = "chr1\t13500\trs1\tA\tC\t.\t.\t.\tGT\t./.\n"
+        self.assertEqual([line.decode() for line in read_region(gz_path, 'chr1', 13119, 13656)],
+            [new_line, lines[1]])
+        self.assertEqual(list(read_region(gz_path, 'chr1', 13119, 13499)),[])
+        self.assertEqual(list(read_region(gz_path, 'chr2', 1, 1234)),[])
+        self.assertEqual(list(read_region(gz_path, 'chrX', 1, 100)),[])
+        sync_file(gz_path, merge_changes([(SORT_KEY_GAP + 2, ('chr1', 13501, '', 'G', ''))],
+            [SORT_KEY_GAP]), compress=True)
+        self.assertEqual([line.decode() for line in read_region(gz_path, 'chr1', 1, 20000)],
+            [new_line, "chr1\t13501\t.\tG\t.\t.\t.\t.\tGT\t./.\n", lines[1]])
+        path, _ = sync_file(gz_path, [])
+        self.assertEqual(path,self.path)
+        self.assertFalse(os.path.isfile(gz_path + TABIX_SUFFIX))
+        self.assertEqual(list(LineIndex.load(self.path).keys),
+            [SORT_KEY_GAP + 1, SORT_KEY_GAP + 2, 2 * SORT_KEY_GAP, 3 * SORT_KEY_GAP])
+
+    def test_bgzf_blocks(self):
+        """
+        Test lines spanning blocks are read back from their virtual offsets and a tabix
+        index of rows out of position order finds all the rows of a region
+        """
+        gz_path = self.path + '.gz'
+        index = TabixIndex()
+        offsets = []
+        with open(gz_path, 'wb') as stream:
+            writer = BgzfWriter(stream)
+            for number in range(3000):
+                line = f"chr1\t{(number * 7919) % 100000 + 1}\t.\tA\tG\t{'Q' * number}\n"
+                offsets.append(writer.tell())
+                writer.write(line.encode())
+                index.add(b'chr1', (number * 7919) % 100000, (number * 7919) % 100000 + 1,
+                    offsets[-1], writer.tell())
+            writer.close()
+        index.save(gz_path + TABIX_SUFFIX)
+        self.assertGreater(offsets[-1] >> 16,0)
+        with open(gz_path, 'rb') as stream, gzip.open(gz_path) as plain:
+            reader = BgzfReader(stream)
+            reader.seek(offsets[2999])
+            plain_lines = plain.readlines()
+            self.assertEqual(reader.readline(),plain_lines[2999])
+            reader.seek(offsets[1500])
+            self.assertEqual(reader.readline(),plain_lines[1500])
+            self.assertEqual(reader.tell(),offsets[1501])
+        expected = sorted(number for number in range(3000)
+            if 20000 < (number * 7919) % 100000 + 1 <= 60000)
+        found = [plain_lines.index(line) for line in read_region(gz_path, 'chr1', 20001, 60000)]
+        self.assertEqual(found,expected)
+
+    def test_append_file(self):
+        """
+        Test changes after the last line are appended without copying the file,
+        skipping the rows deleted before they were synced
+        """
+        index = LineIndex.get(self.path)
+        size = os.path.getsize(self.path)
+        lines = VCF_SAMPLE_BODY.splitlines(True)
+        with mock.patch('vcfApi.filesync.patch_file') as patch, \
+                mock.patch('vcfApi.filesync.rewrite_file') as rewrite:
+            _, rewritten = sync_file(self.path, merge_changes([
+                (4 * SORT_KEY_GAP, ('chrX', 5, 'rs5', 'G', 'T')),
+                (6 * SORT_KEY_GAP, ('chrY', 7, '', 'C', ''))], [5 * SORT_KEY_GAP]))
+        patch.assert_not_called()
+        rewrite.assert_not_called()
+        new_lines = ["chrX\t5\trs5\tG\tT\t.\t.\t.\tGT\t./.\n",
+            "chrY\t7\t.\tC\t.\t.\t.\t.\tGT\t./.\n"]
+        self.assertEqual(self.read_body(),lines + new_lines)
+        self.assertEqual(rewritten,os.path.getsize(self.path) - size)
+        self.assertFalse(os.path.isfile(self.path + APPEND_SUFFIX))
+        index = LineIndex.load(self.path)
+        self.assertEqual(list(index.keys),[key * SORT_KEY_GAP for key in (1, 2, 3, 4, 6)])
+        self.assertEqual(list(index.offsets),list(scan_offsets(self.path, len(VCF_SAMPLE_HEADER))))
+
+    def test_append_recovery(self):
+        """
+        Test an append interrupted before its index was stored is rolled back to the
+        recorded end offset, while a completed one is kept
+        """
+        LineIndex.get(self.path)
+        size = os.path.getsize(self.path)
+        write_append_marker(self.path, size)
+        with open(self.path, 'a') as stream:
+            stream.write("chrX\t5\trs5")
+        self.assertTrue(undo_append(self.path))
+        self.assertEqual(os.path.getsize(self.path),size)
+        self.assertFalse(os.path.isfile(self.path + APPEND_SUFFIX))
+        self.assertIsNotNone(LineIndex.load(self.path))
+        sync_file(self.path, [(4 * SORT_KEY_GAP, ('chrX', 5, 'rs5', 'G', 'T'))])
+        write_append_marker(self.path, size)
+        self.assertFalse(undo_append(self.path))
+        self.assertEqual(len(self.read_body()),4)
+
+    def test_journal_recovery(self):
+        """
+        Test an interrupted patch is completed from its journal, including the sort keys
+        of the patched lines in the index
+        """
+        LineIndex.get(self.path)
+        lines = VCF_SAMPLE_BODY.splitlines(True)
+        offset = len(VCF_SAMPLE_HEADER) + len(lines[0])
+        content = b"chr1\t1\t.\tA\tG\n"
+        with open(self.path + JOURNAL_SUFFIX, 'wb') as journal:
+            journal.write(JOURNAL_HEADER.pack(JOURNAL_MAGIC, offset, len(content), 1) + content)
+            array('q', [SORT_KEY_GAP + 1]).tofile(journal)
+        self.assertTrue(apply_journal(self.path))
+        self.assertFalse(os.path.isfile(self.path + JOURNAL_SUFFIX))
+        self.assertEqual(self.read_body(),[lines[0], "chr1\t1\t.\tA\tG\n"])
+        self.assertEqual(list(LineIndex.load(self.path).keys),[SORT_KEY_GAP, SORT_KEY_GAP + 1])
+        self.assertFalse(apply_journal(self.path))
+
+    def test_modify_file_rows(self):
+        """
+        Test the file modify task transfers updates, deletions, insertions and appends
+        to the file, leaving the sort keys of the rows unchanged
+        """
+        insert_vcf_file("tmp.vcf",self.path)
+        vcf_file = Vcf.objects.get()
+        bulk_update_rows(VcfRow.objects.filter(sort_key=3 * SORT_KEY_GAP), {'pos': 1240})
+        bulk_delete_rows(VcfRow.objects.filter(sort_key=SORT_KEY_GAP))
+        for placement, chrom, pos in (('end', 'chrX', 5), ('sorted', 'chr1', 13700)):
+            serializer = VcfRowSerializer(data=[{'chrom': chrom, 'pos': pos, 'id': 'rs5',
+                'ref': 'G', 'alt': 'T'}], many=True, context={'placement': placement})
+            serializer.is_valid(raise_exception=True)
+            serializer.save()
+        self.assertEqual(modify_file_rows(vcf_file.id),'success')
+        body = self.read_body()
+        self.assertEqual([line.split('\t')[:2] for line in body],
+            [['chr1', '13656'], ['chr1', '13700'], ['chr2', '1240'], ['chrX', '5']])
+        sort_keys = [2 * SORT_KEY_GAP, 2 * SORT_KEY_GAP + SORT_KEY_STEP, 3 * SORT_KEY_GAP,
+            4 * SORT_KEY_GAP]
+        self.assertEqual(list(VcfRow.objects.values_list('sort_key','pos')),
+            list(zip(sort_keys, [13656, 13700, 1240, 5])))
+        self.assertEqual(list(LineIndex.get(self.path).keys),sort_keys)
+        # The applied events stay for the change feed
+        self.assertEqual(RowEvent.objects.count(),4)
+        self.assertEqual(Vcf.objects.get().synced_seq,RowEvent.objects.last().seq)
+        self.assertEqual(Vcf.objects.get().rewrite_count,1)
+
+    def insert_row(self, chrom, pos):
+        """
+        Post a row at its sorted place
+        """
+        serializer = VcfRowSerializer(data=[{'chrom': chrom, 'pos': pos, 'id': 'rs5',
+            'ref': 'G', 'alt': 'T'}], many=True, context={'placement': 'sorted'})
+        serializer.is_valid(raise_exception=True)
+        serializer.save()
+
+    def read_positions(self):
+        """
+        Read the chromosome and position of the body lines of the sample file
+        """
+        return [line.split('\t')[:2] for line in self.read_body()]
+
+    def test_restore_after_insert(self):
+        """
+        Test a lost index of a file with a synced sorted insert is rebuilt with the keys
+        of the rows it holds, so a change goes to the line of its row
+        """
+        insert_vcf_file("tmp.vcf",self.path)
+        vcf_file = Vcf.objects.get()
+        lines = VCF_SAMPLE_BODY.splitlines(True)
+        self.insert_row('chr1', 13200)
+        self.assertEqual(modify_file_rows(vcf_file.id),'success')
+        os.remove(self.path + '.lidx')
+        # The pending insert is not in the file yet
+        self.insert_row('chr1', 13300)
+        bulk_update_rows(VcfRow.objects.filter(sort_key=2 * SORT_KEY_GAP), {'pos': 13657})
+        self.assertEqual(modify_file_rows(vcf_file.id),'success')
+        self.assertEqual(self.read_positions(),[['chr1', '13118'], ['chr1', '13200'],
+            ['chr1', '13300'], ['chr1', '13657'], ['chr2', '1235']])
+        self.assertEqual([self.read_body()[0], self.read_body()[4]],[lines[0], lines[2]])
+        self.assertEqual(list(LineIndex.load(self.path).keys),
+            list(VcfRow.objects.order_by('sort_key').values_list('sort_key', flat=True)))
+
+    def test_restore_after_deletion(self):
+        """
+        Test a lost index of a file with a synced deletion is rebuilt with the keys of the
+        rows it holds, including a row deleted since the last sync
+        """
+        insert_vcf_file("tmp.vcf",self.path)
+        vcf_file = Vcf.objects.get()
+        bulk_delete_rows(VcfRow.objects.filter(sort_key=SORT_KEY_GAP))
+        self.assertEqual(modify_file_rows(vcf_file.id),'success')
+        os.remove(self.path + '.lidx')
+        bulk_delete_rows(VcfRow.objects.filter(sort_key=2 * SORT_KEY_GAP))
+        bulk_update_rows(VcfRow.objects.filter(sort_key=3 * SORT_KEY_GAP), {'pos': 1240})
+        self.assertEqual(modify_file_rows(vcf_file.id),'success')
+        self.assertEqual(self.read_positions(),[['chr2', '1240']])
+        self.assertEqual(list(LineIndex.load(self.path).keys),[3 * SORT_KEY_GAP])
+
+    def test_regenerate_file(self):
+        """
+        Test a file whose lines don't match its rows anymore is regenerated from the rows
+        """
+        insert_vcf_file("tmp.vcf",self.path)
+        vcf_file = Vcf.objects.get()
+        with open(self.path, 'a') as stream:
+            stream.write("chr3\t1\t.\tA\tG\t.\t.\t.\tGT\t0/1\n")
+        bulk_update_rows(VcfRow.objects.filter(sort_key=SORT_KEY_GAP), {'pos': 13119})
+        self.assertEqual(modify_file_rows(vcf_file.id),'success')
+        # The columns the rows don't store are lost
+        self.assertEqual(self.read_body(),["chr1\t13119\trs62028691\tA\tG\t.\t.\t.\tGT\t./.\n",
+            "chr1\t13656\t.\tCAG\tC\t.\t.\t.\tGT\t./.\n",
+            "chr2\t1235\trs1234;rs5678\tA\tGT\t.\t.\t.\tGT\t./.\n"])
+        self.assertEqual(list(LineIndex.load(self.path).keys),
+            [SORT_KEY_GAP, 2 * SORT_KEY_GAP, 3 * SORT_KEY_GAP])
+        with open(self.path) as stream:
+            self.assertTrue(stream.read().startswith(VCF_SAMPLE_HEADER))
+
+    def test_segmented_sync(self):
+        """
+        Test a segmented file only syncs the segments with changes, in subtasks, and is
+        exported or joined back to the single file with the rows in sort key order
+        """
+        insert_vcf_file("tmp.vcf",self.path)
+        vcf_file = Vcf.objects.get()
+        lines = VCF_SAMPLE_BODY.splitlines(True)
+        bulk_update_rows(VcfRow.objects.filter(sort_key=3 * SORT_KEY_GAP), {'pos': 1240})
+        serializer = VcfRowSerializer(data=[{'chrom': 'chrX', 'pos': 5, 'id': 'rs5',
+            'ref': 'G', 'alt': 'T'}], many=True)
+        serializer.is_valid(raise_exception=True)
+        serializer.save()
+        # Run the subtasks and their callback in process
+        self.addCleanup(setattr, celery_app.conf, 'task_always_eager',
+            celery_app.conf.task_always_eager)
+        celery_app.conf.task_always_eager = True
+        with override_settings(VCFAPI_SEGMENTED_FILES=True, VCFAPI_SEGMENT_LINES=1), \
+                mock.patch('vcfApi.tasks.sync_file', wraps=sync_file) as synced:
+            self.assertEqual(modify_file_rows(vcf_file.id),'dispatched')
+        vcf_file = Vcf.objects.get()
+        manifest = Manifest.load(vcf_file.fullpath)
+        self.assertFalse(os.path.isfile(self.path))
+        self.assertEqual([segment['chrom'] for segment in manifest.segments],
+            ['chr1', 'chr1', 'chr2'])
+        # Both changes belong to the last segment
+        self.assertEqual([call.args[0] for call in synced.call_args_list],
+            [manifest.segment_path(manifest.segments[2])])
+        self.assertEqual(vcf_file.synced_seq,RowEvent.objects.last().seq)
+        self.assertFalse(vcf_file.is_updating)
+        self.assertEqual(vcf_file.rewrite_count,1)
+        expected = [lines[0], lines[1], lines[2].replace('1235', '1240').replace('G,T', 'GT'),
+            "chrX\t5\trs5\tG\tT\t.\t.\t.\tGT\t./.\n"]
+        call_command('export_vcf', stdout=open(os.devnull, 'w'))
+        self.assertEqual(self.read_body(),expected)
+        os.remove(self.path)
+        self.assertEqual(modify_file_rows(vcf_file.id),'success')
+        self.assertEqual(Vcf.objects.get().fullpath,self.path)
+        self.assertFalse(os.path.isdir(self.path + SEGMENTS_SUFFIX))
+        self.assertEqual(self.read_body(),expected)
+        self.assertEqual(list(LineIndex.load(self.path).keys),
+            [SORT_KEY_GAP, 2 * SORT_KEY_GAP, 3 * SORT_KEY_GAP, 4 * SORT_KEY_GAP])
+
+    def test_parallel_rewrite(self):
+        """
+        Test a rewrite of the whole file is written in parts by subtasks and joined,
+        and that a failed part leaves the file and the watermark as they were
+        """
+        insert_vcf_file("tmp.vcf",self.path)
+        vcf_file = Vcf.objects.get()
+        lines = VCF_SAMPLE_BODY.splitlines(True)
+        self.addCleanup(setattr, celery_app.conf, 'task_always_eager',
+            celery_app.conf.task_always_eager)
+        celery_app.conf.task_always_eager = True
+        bulk_update_rows(VcfRow.objects.filter(sort_key=SORT_KEY_GAP), {'pos': 13119})
+        bulk_delete_rows(VcfRow.objects.filter(sort_key=3 * SORT_KEY_GAP))
+        with override_settings(VCFAPI_SYNC_PARTS=2, VCFAPI_PARALLEL_SYNC_SIZE=0):
+            with mock.patch('vcfApi.tasks.write_part', side_effect=OSError("disk full")):
+                self.assertEqual(modify_file_rows(vcf_file.id),'dispatched')
+            self.assertEqual(self.read_body(),lines)
+            self.assertEqual(Vcf.objects.get().synced_seq,0)
+            self.assertFalse(Vcf.objects.get().is_updating)
+            with mock.patch('vcfApi.tasks.write_part', wraps=write_part) as written:
+                self.assertEqual(modify_file_rows(vcf_file.id),'dispatched')
+        self.assertEqual([call.args[1:3] for call in written.call_args_list],[(1, 2), (2, 4)])
+        self.assertEqual(self.read_body(),[lines[0].replace('13118', '13119'), lines[1]])
+        self.assertEqual(list(LineIndex.load(self.path).keys),[SORT_KEY_GAP, 2 * SORT_KEY_GAP])
+        self.assertEqual(Vcf.objects.get().synced_seq,RowEvent.objects.last().seq)
+        self.assertFalse(os.path.isfile(get_part_path(self.path, 0)))
+
+    def test_compact_row_events(self):
+        """
+        Test the events of every row are folded into the last one before they are streamed
+        in sort key order, deletions of rows created after the watermark included
+        """
+        insert_vcf_file("tmp.vcf",self.path)
+        vcf_file = Vcf.objects.get()
+        for pos in (1240, 1241):
+            bulk_update_rows(VcfRow.objects.filter(sort_key=3 * SORT_KEY_GAP), {'pos': pos})
+        serializer = VcfRowSerializer(data=[{'chrom': 'chrX', 'pos': 5, 'id': 'rs5',
+            'ref': 'G', 'alt': 'T'}], many=True)
+        serializer.is_valid(raise_exception=True)
+        serializer.save()
+        bulk_update_rows(VcfRow.objects.filter(chrom='chrX'), {'pos': 6})
+        bulk_delete_rows(VcfRow.objects.filter(sort_key__in=[SORT_KEY_GAP, 4 * SORT_KEY_GAP]))
+        last_seq = RowEvent.objects.last().seq
+        self.assertEqual(RowEvent.objects.count(),6)
+        self.assertEqual(compact_row_events(vcf_file.id, 0, last_seq),3)
+        self.assertEqual([(key, values and values[1]) for key, values in
+            iter_row_changes(vcf_file.id, 0, last_seq)],
+            [(SORT_KEY_GAP, None), (3 * SORT_KEY_GAP, 1241), (4 * SORT_KEY_GAP, None)])
+        self.assertEqual(list(iter_row_changes(vcf_file.id, last_seq, last_seq)),[])
+        bulk_update_rows(VcfRow.objects.filter(sort_key=3 * SORT_KEY_GAP), {'pos': 1242})
+        next_seq = RowEvent.objects.last().seq
+        self.assertEqual(compact_row_events(vcf_file.id, last_seq, next_seq),1)
+        self.assertEqual(list(RowEvent.objects.filter(sort_key=3 * SORT_KEY_GAP)
+            .values_list('seq', 'pos')),[(next_seq, 1242)])
+
+    def test_modify_file_rows_resume(self):
+        """
+        Test a sync that failed leaves the watermark and the events in place,
+        so the next one applies them
+        """
+        insert_vcf_file("tmp.vcf",self.path)
+        vcf_file = Vcf.objects.get()
+        bulk_update_rows(VcfRow.objects.filter(sort_key=3 * SORT_KEY_GAP), {'pos': 1240})
+        with mock.patch('vcfApi.tasks.sync_file', side_effect=OSError("disk full")):
+            modify_file_rows(vcf_file.id)
+        self.assertEqual(Vcf.objects.get().synced_seq,0)
+        self.assertEqual(RowEvent.objects.count(),1)
+        last_seq = RowEvent.objects.get().seq
+        self.assertEqual(modify_file_rows(vcf_file.id),'success')
+        self.assertEqual(self.read_body()[2].split('\t')[:2],['chr2', '1240'])
+        self.assertEqual(Vcf.objects.get().synced_seq,last_seq)
+        self.assertEqual(RowEvent.objects.count(),1)
+
+    def test_prune_deletions(self):
+        """
+        Test only the applied deletion events older than the retention period are pruned,
+        recording the oldest version the change feed can resume from
+        """
+        insert_vcf_file("tmp.vcf",self.path)
+        vcf_file = Vcf.objects.get()
+        bulk_delete_rows(VcfRow.objects.filter(sort_key__lte=2 * SORT_KEY_GAP))
+        bulk_update_rows(VcfRow.objects.all(), {'pos': 1})
+        seqs = list(RowEvent.objects.values_list('seq', flat=True))
+        later = timezone.now() + RowEvent.get_retention() + datetime.timedelta(seconds=1)
+        self.assertEqual(RowEvent.prune_deletions(vcf_file.id, seqs[0], now=later),1)
+        self.assertEqual(Vcf.objects.get().pruned_seq,seqs[0])
+        self.assertEqual(RowEvent.prune_deletions(vcf_file.id, seqs[-1]),0)
+        self.assertEqual(RowEvent.prune_deletions(vcf_file.id, seqs[-1], now=later),1)
+        self.assertEqual(list(RowEvent.objects.values_list('kind', flat=True)),
+            [RowEvent.UPDATED])
+        self.assertEqual(Vcf.objects.get().pruned_seq,seqs[1])
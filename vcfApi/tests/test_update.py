@@ -5,10 +5,14 @@ import json
 from collections import OrderedDict
 from rest_framework import status
 from django.test import TestCase
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 from django.conf import settings
 from vcfApi.models import Vcf
 from vcfApi.models import VcfRow
+from vcfApi.models import OutboxEvent
+from vcfApi.models import RowEvent
 from vcfApi.serializers import VcfRowSerializer
 
 class EditVcfRowTest(TestCase):
@@ -190,3 +194,82 @@ class EditVcfRowTest(TestCase):
         response = self.client.put(reverse('vcfrow-detail',kwargs={'id': self.row1.id}),data=json.dumps(self.valid_payload),
             content_type='application/json',HTTP_AUTHORIZATION="Wrong_secret")
         self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_update_constant_queries(self):
+        """
+        Test Updating the rows sharing an id runs the same queries whatever their number
+        """
+        queries = []
+        for rsid, size in (('rs1', 1), ('rs2', 50)):
+            VcfRow.objects.bulk_create([VcfRow(vcf_id=self.vcf.id,sort_key=size * 1000 + i,
+                chrom='chr2',pos=i,id=rsid,ref='G',alt='A') for i in range(1, size + 1)])
+            with CaptureQueriesContext(connection) as context:
+                response = self.client.patch(reverse('vcfrow-detail',kwargs={'id': rsid}),
+                    data=json.dumps({'alt': 'T'}),content_type='application/json',
+                    HTTP_AUTHORIZATION=self.secret)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            queries.append(len(context.captured_queries))
+            self.assertTrue(all(row.alt == 'T' for row in VcfRow.objects.filter(id=rsid)))
+            self.assertEqual(RowEvent.objects.filter(kind=RowEvent.UPDATED,
+                row_id__in=VcfRow.objects.filter(id=rsid).values('row_id')).count(), size)
+        self.assertEqual(queries[0],queries[1])
+
+class BulkEditVcfRowTest(TestCase):
+    """ Test module for the filter based bulk PATCH VcfRow API """
+
+    def setUp(self):
+        """
+        DB Setup
+        """
+        self.vcf = Vcf.objects.create(name='file1.vcf', fullpath='path/to/file/file1.vcf')
+        for line_id, chrom in enumerate(['chr1', 'chr2', 'chr1'], start=1):
+            VcfRow.objects.create(vcf_id=self.vcf.id,sort_key=line_id,chrom=chrom,pos=line_id,
+                id=f'rs{line_id}',ref='C',alt='A')
+        self.secret = settings.PREDEFINED_SECRET
+
+    def test_bulk_update_filtered_rows(self):
+        """
+        Test Updating all the rows matching a filter with a single file update
+        """
+        response = self.client.patch(reverse('vcfrow-list')+"?chrom=chr1",
+            data=json.dumps({'chrom': 'chrX', 'alt': 'G'}),
+            content_type='application/json',HTTP_AUTHORIZATION=self.secret)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data, {"count": 2})
+        rows = VcfRow.objects.filter(chrom='chrX')
+        self.assertEqual([row.id for row in rows], ['rs1', 'rs3'])
+        self.assertTrue(all(row.alt == 'G' for row in rows))
+        self.assertEqual(list(RowEvent.objects.filter(kind=RowEvent.UPDATED)
+            .values_list('row_id', 'chrom', 'alt')),
+                [(row.row_id, 'chrX', 'G') for row in rows])
+        self.assertEqual(list(OutboxEvent.objects.values_list('vcf_id','changes')),
+            [(self.vcf.id,2)])
+
+    def test_bulk_update_dry_run(self):
+        """
+        Test a dry run only returns the number of rows that would be updated
+        """
+        response = self.client.patch(reverse('vcfrow-list')+"?chrom=chr1&dry_run=true",
+            data=json.dumps({'chrom': 'chrX'}),
+            content_type='application/json',HTTP_AUTHORIZATION=self.secret)
+        self.assertEqual(response.data, {"count": 2, "dry_run": True})
+        self.assertEqual(VcfRow.objects.filter(chrom='chrX').count(), 0)
+
+    def test_bulk_update_invalid_data(self):
+        """
+        Test a bulk update with invalid or no values is rejected
+        """
+        for payload in ({'chrom': 'chr23'}, {}):
+            response = self.client.patch(reverse('vcfrow-list')+"?chrom=chr1",
+                data=json.dumps(payload),
+                content_type='application/json',HTTP_AUTHORIZATION=self.secret)
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(VcfRow.objects.filter(chrom='chr1').count(), 2)
+
+    def test_bulk_update_requires_filter(self):
+        """
+        Test a bulk update without filters is rejected
+        """
+        response = self.client.patch(reverse('vcfrow-list'),data=json.dumps({'alt': 'G'}),
+            content_type='application/json',HTTP_AUTHORIZATION=self.secret)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
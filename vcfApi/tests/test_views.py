@@ -1,12 +1,38 @@
 """
 This module Contains various tests for the views GET functionality
 """
+import os
+import json
+import time
+import threading
+from unittest import mock
 from rest_framework import status
+from django.core.cache import caches
+from django.db import connection
 from django.test import TestCase
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 from vcfApi.models import Vcf
 from vcfApi.models import VcfRow
+from vcfApi.models import RowCount
+from vcfApi.models import RowEvent
 from vcfApi.serializers import VcfRowSerializer
+from vcfApi.cache import get_cache
+from vcfApi.cache import bump_data_version
+from vcfApi.cache import CACHE_ALIAS
+from vcfApi.cache import VERSION_KEY
+from vcfApi.cache import VERSION_CHECK_INTERVAL
+from vcfApi.cache import get_data_version
+from vcfApi.cache import wait_for_data_change
+from vcfApi.changefeed import wait_for_changes
+from vcfApi.tasks import reconcile_row_counts
+from saph_assignment import settings as server_settings
+from saph_assignment import proc_settings
+from vcfApi.bulk import bulk_update_rows
+from vcfApi.bulk import bulk_delete_rows
+from vcfApi.management.commands.update_db import insert_vcf_file
+from vcfApi.tests.test_unit import write_sample_vcf
 
 class GetListVcfRowTest(TestCase):
     """ Test module for the GET VcfRowList API """
@@ -401,3 +427,493 @@ class GetDetailVcfRowTest(TestCase):
         response = self.client.get(response_data['previous'])
         self.assertEqual(len(response_data['results']), 1)
         self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+class GetRegionVcfRowTest(TestCase):
+    """ Test module for the region queries of the VcfRowList API """
+
+    def setUp(self):
+        """
+        DB Setup
+        """
+        self.vcf = Vcf.objects.create(name='file1.vcf', fullpath='path/to/file/file1.vcf')
+        for line_id, (chrom, pos) in enumerate([('chr1', 1234), ('chr1', 12345),
+                ('chr1', 12346), ('chr2', 1235), ('chr2', 1236), ('chr7', 117480000)], start=1):
+            VcfRow.objects.create(vcf_id=self.vcf.id,sort_key=line_id,chrom=chrom,pos=pos,
+                id=f'rs{line_id}',ref='G',alt='A')
+
+    def test_get_region(self):
+        """
+        Test Get the rows of a region with inclusive bounds
+        """
+        response = self.client.get(reverse('vcfrow-list',query={"region":"chr1:12345-12346"}))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([row['pos'] for row in response.data['results']],[12345,12346])
+
+    def test_get_region_thousands_separator(self):
+        """
+        Test Get a region written with thousands separators
+        """
+        response = self.client.get(reverse('vcfrow-list',
+            query={"region":"chr7:117,480,000-117,670,000"}))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([row['id'] for row in response.data['results']],['rs6'])
+
+    def test_get_region_whole_chrom_and_filter(self):
+        """
+        Test Get a whole chromosome region combined with a field filter
+        """
+        response = self.client.get(reverse('vcfrow-list',query={"region":"chr2","pos":1236}))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([row['id'] for row in response.data['results']],['rs5'])
+
+    def test_get_multiple_regions(self):
+        """
+        Test Get the rows of repeated region parameters
+        """
+        response = self.client.get(reverse('vcfrow-list')+"?region=chr1:1-2000&region=chr2:1236")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([row['id'] for row in response.data['results']],['rs1','rs5'])
+
+    def test_get_region_no_rows(self):
+        """
+        Test Get a region without rows
+        """
+        response = self.client.get(reverse('vcfrow-list',query={"region":"chr3:1-100"}))
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_get_invalid_region(self):
+        """
+        Test Get a region with the end before the start
+        """
+        response = self.client.get(reverse('vcfrow-list',query={"region":"chr1:200-100"}))
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_post_regions(self):
+        """
+        Test Post a list of regions
+        """
+        payload = {"regions": ["chr1:12,000-13,000", "chr7:117480000-117480000"]}
+        response = self.client.post(reverse('vcfrow-regions'),data=json.dumps(payload),
+            content_type='application/json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([row['id'] for row in response.data['results']],['rs2','rs3','rs6'])
+
+    def test_post_regions_invalid(self):
+        """
+        Test Post an invalid list of regions
+        """
+        response = self.client.post(reverse('vcfrow-regions'),data=json.dumps({"regions":[1]}),
+            content_type='application/json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.post(reverse('vcfrow-regions'),data=json.dumps({}),
+            content_type='application/json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+class GetCursorVcfRowTest(TestCase):
+    """ Test module for the cursor pagination of the VcfRowList API """
+
+    def setUp(self):
+        """
+        DB Setup
+        """
+        self.vcf = Vcf.objects.create(name='file1.vcf', fullpath='path/to/file/file1.vcf')
+        for line_id in range(1, 8):
+            VcfRow.objects.create(vcf_id=self.vcf.id,sort_key=line_id,
+                chrom='chr1' if line_id % 2 else 'chr2',pos=1000 + line_id,
+                id=f'rs{line_id}',ref='G',alt='A')
+
+    def walk(self, url, link):
+        """
+        Follow the next or previous links from url and return the ids of every page
+        """
+        pages = []
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            pages.append([row['id'] for row in response.data['results']])
+            url = response.data[link]
+        return pages, response
+
+    def test_get_cursor_pages(self):
+        """
+        Test walking forward and back through all the rows via the cursor links
+        """
+        pages, response = self.walk(reverse('vcfrow-list',
+            query={"paging":"cursor","page_size":3}), 'next')
+        self.assertEqual(pages,[['rs1','rs2','rs3'],['rs4','rs5','rs6'],['rs7']])
+        self.assertNotIn('count', response.data)
+        self.assertNotIn('total_pages', response.data)
+        pages, response = self.walk(response.data['previous'], 'previous')
+        self.assertEqual(pages,[['rs4','rs5','rs6'],['rs1','rs2','rs3']])
+        self.assertEqual(response.data['previous'],None)
+        self.assertNotEqual(response.data['next'],None)
+
+    def test_get_cursor_filtered_with_count(self):
+        """
+        Test cursor pages honor the filters and report the count when asked to
+        """
+        pages, response = self.walk(reverse('vcfrow-list',
+            query={"paging":"cursor","page_size":2,"chrom":"chr1","with_count":"true"}), 'next')
+        self.assertEqual(pages,[['rs1','rs3'],['rs5','rs7']])
+        self.assertEqual(response.data['count'],4)
+
+    def test_get_cursor_constant_queries(self):
+        """
+        Test a deep cursor page costs a single query
+        """
+        response = self.client.get(reverse('vcfrow-list',
+            query={"paging":"cursor","page_size":5}))
+        with self.assertNumQueries(1):
+            response = self.client.get(response.data['next'])
+        self.assertEqual([row['id'] for row in response.data['results']],['rs6','rs7'])
+
+    def test_get_invalid_cursor(self):
+        """
+        Test Get with an invalid cursor
+        """
+        response = self.client.get(reverse('vcfrow-list',query={"cursor":"notacursor"}))
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+class GetCountVcfRowTest(TestCase):
+    """ Test module for the cached counts of the VcfRowList API """
+
+    def setUp(self):
+        """
+        DB Setup
+        """
+        self.vcf = Vcf.objects.create(name='file1.vcf', fullpath='path/to/file/file1.vcf')
+        for line_id in range(1, 6):
+            VcfRow.objects.create(vcf_id=self.vcf.id,sort_key=line_id,chrom='chr1',
+                pos=1000 + line_id,id=f'rs{line_id}',ref='G',alt='A')
+
+    def test_get_list_uses_counter(self):
+        """
+        Test the list count comes from the counters once they exist
+        """
+        response = self.client.get(reverse('vcfrow-list',query={"page_size":2}))
+        self.assertEqual(response.data['count'],5)
+        self.assertEqual(response.data['total_pages'],3)
+        # A stale counter proves the count no longer comes from a COUNT query
+        RowCount.objects.filter(filter_key='').update(count=6)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('vcfrow-list',query={"page_size":2}))
+        self.assertEqual(response.data['count'],6)
+        self.assertFalse(any('COUNT(' in query['sql'] for query in queries.captured_queries))
+
+    def test_get_list_filtered_counter(self):
+        """
+        Test a counted filter gets its own counter and an uncounted one does not
+        """
+        response = self.client.get(reverse('vcfrow-list',query={"chrom":"chr1"}))
+        self.assertEqual(response.data['count'],5)
+        response = self.client.get(reverse('vcfrow-list',query={"pos":1001}))
+        self.assertEqual(response.data['count'],1)
+        self.assertEqual(sorted(RowCount.objects.values_list('filter_key',flat=True)),
+            ['chrom=chr1'])
+
+@override_settings(CACHES={
+    'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+    'vcfapi': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'vcfapi-tests'},
+})
+class GetCachedVcfRowTest(TestCase):
+    """ Test module for the response cache of the GET APIs """
+
+    def setUp(self):
+        """
+        DB Setup
+        """
+        get_cache().clear()
+        self.vcf = Vcf.objects.create(name='file1.vcf', fullpath='path/to/file/file1.vcf')
+        for line_id in range(1, 4):
+            VcfRow.objects.create(vcf_id=self.vcf.id,sort_key=line_id,chrom='chr1',
+                pos=1000 + line_id,id=f'rs{line_id}',ref='G',alt='A')
+
+    def test_get_list_cached(self):
+        """
+        Test a repeated list request skips the db
+        """
+        response = self.client.get(reverse('vcfrow-list',query={"page_size":2,"chrom":"chr1"}))
+        with self.assertNumQueries(0):
+            cached = self.client.get(reverse('vcfrow-list',
+                query={"chrom":"chr1","page_size":2}))
+        self.assertEqual(cached.status_code, status.HTTP_200_OK)
+        self.assertEqual(cached.data, response.data)
+
+    def test_get_detail_cached(self):
+        """
+        Test a repeated detail request skips the db, also for missing ids
+        """
+        response = self.client.get(reverse('vcfrow-detail',kwargs={'id': 'rs1'}))
+        self.client.get(reverse('vcfrow-detail',kwargs={'id': 'rs9'}))
+        with self.assertNumQueries(0):
+            cached = self.client.get(reverse('vcfrow-detail',kwargs={'id': 'rs1'}),
+                HTTP_ACCEPT='application/xml')
+            missing = self.client.get(reverse('vcfrow-detail',kwargs={'id': 'rs9'}))
+        self.assertEqual(cached.data, response.data)
+        self.assertEqual(cached['Content-Type'], 'application/xml; charset=utf-8')
+        self.assertEqual(missing.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_get_invalidated_on_change(self):
+        """
+        Test a data version bump invalidates the cached responses
+        """
+        response = self.client.get(reverse('vcfrow-detail',kwargs={'id': 'rs1'}))
+        VcfRow.objects.filter(id='rs1').update(alt='T')
+        response = self.client.get(reverse('vcfrow-detail',kwargs={'id': 'rs1'}))
+        self.assertEqual(response.data['results'][0]['alt'], 'A')
+        bump_data_version()
+        response = self.client.get(reverse('vcfrow-detail',kwargs={'id': 'rs1'}))
+        self.assertEqual(response.data['results'][0]['alt'], 'T')
+
+    def test_get_invalidated_on_import(self):
+        """
+        Test an import invalidates the cached responses
+        """
+        response = self.client.get(reverse('vcfrow-list'))
+        self.assertEqual(response.data['count'], 3)
+        path = write_sample_vcf()
+        insert_vcf_file("tmp.vcf",path)
+        os.remove(path)
+        response = self.client.get(reverse('vcfrow-list'))
+        self.assertEqual(response.data['count'], 3)
+        self.assertEqual([row['pos'] for row in response.data['results']],[13118,13656,1235])
+
+    def test_get_invalidated_by_other_process(self):
+        """
+        Test a version bump through another connection to the cache backend, as a worker
+        or an import command makes, invalidates the responses cached by this one
+        """
+        self.client.get(reverse('vcfrow-detail',kwargs={'id': 'rs1'}))
+        VcfRow.objects.filter(id='rs1').update(alt='T')
+        other_cache = caches.create_connection(CACHE_ALIAS)
+        self.assertIsNot(other_cache, get_cache())
+        with mock.patch('vcfApi.cache.get_cache', return_value=other_cache):
+            bump_data_version()
+        response = self.client.get(reverse('vcfrow-detail',kwargs={'id': 'rs1'}))
+        self.assertEqual(response.data['results'][0]['alt'], 'T')
+
+    def test_get_invalidated_on_reconcile(self):
+        """
+        Test a reconcile that corrects a counter invalidates the cached counts
+        """
+        RowCount.set_total(self.vcf.id, 3)
+        self.assertEqual(self.client.get(reverse('vcfrow-list')).data['count'], 3)
+        VcfRow.objects.filter(id='rs3').delete()
+        self.assertEqual(self.client.get(reverse('vcfrow-list')).data['count'], 3)
+        self.assertEqual(reconcile_row_counts(), 1)
+        self.assertEqual(self.client.get(reverse('vcfrow-list')).data['count'], 2)
+
+    def test_cache_shared_by_writers(self):
+        """
+        Test the server and the import/worker settings use the same cache backend,
+        and not one living in the memory of a process
+        """
+        cache = server_settings.CACHES[CACHE_ALIAS]
+        self.assertEqual(proc_settings.CACHES[CACHE_ALIAS], cache)
+        self.assertNotIn(cache['BACKEND'], ('django.core.cache.backends.locmem.LocMemCache',
+            'django.core.cache.backends.dummy.DummyCache'))
+
+class ExportVcfRowTest(TestCase):
+    """ Test module for the streaming export API """
+
+    def setUp(self):
+        """
+        DB Setup
+        """
+        self.vcf = Vcf.objects.create(name='file1.vcf', fullpath='path/to/file/file1.vcf')
+        VcfRow.objects.create(vcf_id=self.vcf.id,sort_key=2,chrom='chr2',pos=1235,
+            id='rs1234',ref='A',alt='G')
+        VcfRow.objects.create(vcf_id=self.vcf.id,sort_key=1,chrom='chr1',pos=12345,
+            id='',ref='G',alt='A')
+
+    def get_export(self, **params):
+        """
+        Get the export response and its streamed content
+        """
+        response = self.client.get(reverse('vcfrow-export',query=params))
+        content = b"".join(response.streaming_content).decode() if response.streaming else None
+        return response, content
+
+    def test_export_ndjson(self):
+        """
+        Test the default NDJSON export in line order
+        """
+        response, content = self.get_export()
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        rows = [json.loads(line) for line in content.splitlines()]
+        self.assertEqual(rows,[
+            {'chrom':'chr1','pos':12345,'id':'','ref':'G','alt':'A'},
+            {'chrom':'chr2','pos':1235,'id':'rs1234','ref':'A','alt':'G'}])
+
+    def test_export_tsv_filtered(self):
+        """
+        Test the TSV export honors the list filters
+        """
+        response, content = self.get_export(output='tsv',chrom='chr2')
+        self.assertEqual(response['Content-Type'], 'text/tab-separated-values')
+        self.assertEqual(content,"#CHROM\tPOS\tID\tREF\tALT\nchr2\t1235\trs1234\tA\tG\n")
+
+    def test_export_vcf_region(self):
+        """
+        Test the VCF export of a region fills in the missing values
+        """
+        response, content = self.get_export(output='vcf',region='chr1:1-20000')
+        lines = content.splitlines()
+        self.assertEqual(lines[0],"##fileformat=VCFv4.2")
+        self.assertTrue(lines[1].startswith("#CHROM\tPOS"))
+        self.assertEqual(lines[2:],["chr1\t12345\t.\tG\tA\t.\t.\t."])
+
+    def test_export_invalid(self):
+        """
+        Test an unknown output format and an invalid region
+        """
+        response, content = self.get_export(output='bam')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response, content = self.get_export(region='chr1:5-1')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.post(reverse('vcfrow-export'))
+        self.assertEqual(response.status_code, status.HTTP_405_METHOD_NOT_ALLOWED)
+
+    def test_export_matches_list(self):
+        """
+        Test the export selects the same rows as the list for the same filters and regions
+        """
+        for params in ({'chrom':'chr2'}, {'region':'chr1'}, {'id__isnull':'false'},
+                {'region':'chr3'}):
+            listed = self.client.get(reverse('vcfrow-list',query=params)).data
+            _, content = self.get_export(**params)
+            self.assertEqual([json.loads(line) for line in content.splitlines()],
+                listed.get('results', []), params)
+
+class ChangeFeedTest(TestCase):
+    """ Test module for the change feed API """
+
+    def setUp(self):
+        """
+        DB Setup
+        """
+        self.vcf = Vcf.objects.create(name='file1.vcf', fullpath='path/to/file/file1.vcf')
+        self.row1 = VcfRow.objects.create(vcf_id=self.vcf.id,sort_key=1,chrom='chr1',pos=12345,
+            id='rs1',ref='G',alt='A')
+        self.row2 = VcfRow.objects.create(vcf_id=self.vcf.id,sort_key=2,chrom='chr2',pos=1235,
+            id='rs2',ref='A',alt='G')
+        RowEvent.record_rows([self.row1, self.row2], RowEvent.CREATED)
+        self.version = RowEvent.objects.last().seq
+
+    def get_changes(self, **params):
+        """
+        Get the change feed response
+        """
+        return self.client.get(reverse('changes',query=params))
+
+    def test_current_version(self):
+        """
+        Test a request without a version only returns the current one
+        """
+        response = self.get_changes()
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.json(), {'version': self.version, 'more': False, 'changes': []})
+
+    def test_changes_since(self):
+        """
+        Test only the changes after a version are returned, deletions without row values
+        """
+        bulk_update_rows(VcfRow.objects.filter(id='rs1'), {'alt': 'T'})
+        bulk_delete_rows(VcfRow.objects.filter(id='rs2'))
+        data = self.get_changes(since=self.version).json()
+        self.assertEqual(data['version'], self.version + 2)
+        self.assertFalse(data['more'])
+        self.assertEqual(data['changes'], [
+            {'version': self.version + 1, 'change': 'updated', 'row_id': self.row1.row_id,
+                'sort_key': 1, 'row': {'chrom': 'chr1', 'pos': 12345, 'id': 'rs1', 'ref': 'G',
+                    'alt': 'T'}},
+            {'version': self.version + 2, 'change': 'deleted', 'row_id': self.row2.row_id,
+                'sort_key': 2, 'row': None}])
+
+    def test_changes_paging(self):
+        """
+        Test the changes are paged by the limit and the more flag
+        """
+        data = self.get_changes(since=0, limit=1).json()
+        self.assertTrue(data['more'])
+        self.assertEqual([change['change'] for change in data['changes']], ['created'])
+        data = self.get_changes(since=data['version'], limit=1).json()
+        self.assertFalse(data['more'])
+        self.assertEqual(data['version'], self.version)
+        self.assertEqual(data['changes'][0]['row']['id'], 'rs2')
+
+    def test_long_poll_timeout(self):
+        """
+        Test a long polling request without changes returns the version it was given
+        """
+        response = self.get_changes(since=self.version, wait=0.1)
+        self.assertEqual(response.json(), {'version': self.version, 'more': False, 'changes': []})
+
+    @override_settings(VCFAPI_CHANGES_MAX_WAIT=0.1)
+    def test_long_poll_max_wait(self):
+        """
+        Test a long polling request waits no longer than the max wait
+        """
+        start = time.monotonic()
+        response = self.get_changes(since=self.version, wait=60)
+        self.assertLess(time.monotonic() - start, 5)
+        self.assertEqual(response.json()['changes'], [])
+
+    def test_long_poll_reads_journal_once(self):
+        """
+        Test a long polling request does not read the journal again while nothing changes
+        """
+        with self.assertNumQueries(1):
+            self.assertEqual(wait_for_changes(self.version, wait=0.3), ([], False))
+
+    def test_long_poll_woken_by_change(self):
+        """
+        Test a waiting request is woken as soon as a row change of its process is committed
+        """
+        timer = threading.Timer(0.1, bump_data_version)
+        timer.start()
+        start = time.monotonic()
+        self.assertTrue(wait_for_data_change(get_data_version(), 30))
+        self.assertLess(time.monotonic() - start, VERSION_CHECK_INTERVAL)
+        timer.join()
+
+    @override_settings(CACHES={CACHE_ALIAS: {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'vcfapi-tests'}})
+    def test_long_poll_sees_other_process(self):
+        """
+        Test a waiting request sees the version bumped by another process, which does not
+        wake it up, and times out when there is none
+        """
+        version = get_data_version()
+        self.assertFalse(wait_for_data_change(version, 0.1))
+        with mock.patch('vcfApi.cache.VERSION_CHECK_INTERVAL', 0.05):
+            timer = threading.Timer(0.1, get_cache().incr, (VERSION_KEY,))
+            timer.start()
+            self.assertTrue(wait_for_data_change(version, 30))
+            timer.join()
+        self.assertEqual(get_data_version(), version + 1)
+
+    def test_pruned_version(self):
+        """
+        Test a version older than the pruned deletions is gone
+        """
+        Vcf.objects.filter(id=self.vcf.id).update(pruned_seq=self.version)
+        response = self.get_changes(since=self.version - 1)
+        self.assertEqual(response.status_code, status.HTTP_410_GONE)
+        self.assertEqual(response.json()['version'], self.version)
+        self.assertEqual(self.get_changes(since=self.version).status_code, status.HTTP_200_OK)
+
+    def test_invalid_params(self):
+        """
+        Test invalid versions, limits and waits are rejected
+        """
+        for params in ({'since': 'abc'}, {'since': -1}, {'since': 0, 'limit': 0},
+                {'since': 0, 'limit': 100000}, {'since': 0, 'wait': 'soon'},
+                {'since': 0, 'wait': 'nan'}):
+            response = self.get_changes(**params)
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.post(reverse('changes'))
+        self.assertEqual(response.status_code, status.HTTP_405_METHOD_NOT_ALLOWED)
+
@@ -7,7 +7,11 @@ from django.urls import path
 from . import views
 
 urlpatterns = [
-    path('VcfRows', views.VcfRowsList.as_view({'get': 'list', 'post': 'create'}),name='vcfrow-list'),
+    path('VcfRows', views.VcfRowsList.as_view({'get': 'list', 'post': 'create',
+        'patch': 'bulk_update', 'delete': 'bulk_destroy'}),name='vcfrow-list'),
+    path('VcfRows/export', views.VcfRowsList.as_view({'get': 'export'}),name='vcfrow-export'),
+    path('changes', views.ChangeFeed.as_view({'get': 'list'}),name='changes'),
+    path('VcfRows/regions', views.VcfRowsList.as_view({'post': 'regions'}),name='vcfrow-regions'),
     path('VcfRows/id=<str:id>', views.VcfRowsDetail.as_view({'get': 'retrieve', 'put': 'update',
         'patch': 'partial_update', 'delete': 'destroy'}),name='vcfrow-detail'),
 ]
@@ -0,0 +1,192 @@
+"""
+This module contains raw VCF byte-stream helpers.
+It deliberately has no Django dependencies so its functions can be used
+by worker processes that never touch the database.
+"""
+import os
+import gzip
+import hashlib
+
+READ_BUFFER_SIZE = 1024 * 1024
+GZIP_MAGIC = b'\x1f\x8b'
+HEADER_PREFIX = b'#'
+COLUMNS_HEADER_PREFIX = b'#CHROM'
+FIELD_DEL = b'\t'
+EMPTY_VALUE = b'.'
+# The columns a body line needs to hold a row (CHROM, POS, ID, REF, ALT)
+ROW_FIELDS = 5
+MIN_CHUNK_SIZE = 8 * 1024 * 1024
+FINGERPRINT_SAMPLE_SIZE = 1024 * 1024
+
+def is_gzipped(vcf_path):
+    """
+    Check the magic bytes of a file to see if it is gzip/bgzip compressed
+
+    Args:
+        vcf_path(str): The full path of the file
+
+    Returns:
+        gzipped(bool): True if the file is compressed
+    """
+    with open(vcf_path, 'rb') as probe:
+        return probe.read(2) == GZIP_MAGIC
+
+def file_fingerprint(vcf_path):
+    """
+    Compute a cheap fingerprint of a file from its size and the first and last MB
+    of its content. Used to make sure a checkpoint belongs to the same file.
+
+    Args:
+        vcf_path(str): The full path of the file
+
+    Returns:
+        fingerprint(str): A "<size>:<sha256>" string
+    """
+    size = os.path.getsize(vcf_path)
+    digest = hashlib.sha256()
+    with open(vcf_path, 'rb') as stream:
+        digest.update(stream.read(FINGERPRINT_SAMPLE_SIZE))
+        if size > FINGERPRINT_SAMPLE_SIZE:
+            stream.seek(max(FINGERPRINT_SAMPLE_SIZE, size - FINGERPRINT_SAMPLE_SIZE))
+            digest.update(stream.read())
+    return f"{size}:{digest.hexdigest()}"
+
+def seek_line(stream, offset):
+    """
+    Position a binary stream at the first line that starts at or after offset
+
+    Args:
+        stream(file): A seekable binary file object
+        offset(int): The byte offset
+
+    Returns:
+        offset(int): The byte offset of that line
+    """
+    if offset <= 0:
+        stream.seek(0)
+        return 0
+    # Skip the tail of a line that started before the offset
+    stream.seek(offset - 1)
+    return offset - 1 + len(stream.readline())
+
+def open_vcf_stream(vcf_path):
+    """
+    Open a VCF file as a buffered binary stream, transparently handling gzipped files
+
+    Args:
+        vcf_path(str): The full path of the file
+
+    Returns:
+        stream(file): A binary file object positioned at the start of the file
+    """
+    if is_gzipped(vcf_path):
+        return gzip.open(vcf_path, 'rb')
+    return open(vcf_path, 'rb', buffering=READ_BUFFER_SIZE)
+
+def parse_vcf_line(line):
+    """
+    Tokenize only the first five columns (CHROM, POS, ID, REF, ALT) of a VCF body line.
+    The values are normalized the same way the vcfpy based importer did, i.e. a missing
+    ID or ALT ('.') becomes an empty string and multiple ALT alleles are concatenated.
+
+    Args:
+        line(bytes): A raw VCF body line
+
+    Returns:
+        fields(tuple): A (chrom, pos, id, ref, alt) tuple or None if the line is not valid
+    """
+    fields = line.rstrip(b'\r\n').split(FIELD_DEL, ROW_FIELDS)
+    if len(fields) < ROW_FIELDS:
+        return None
+    chrom, pos, vid, ref, alt = fields[:ROW_FIELDS]
+    if vid == EMPTY_VALUE:
+        vid = b''
+    if alt == EMPTY_VALUE:
+        alt = b''
+    return (chrom.decode(), int(pos), vid.decode(), ref.decode(),
+        alt.replace(b',', b'').decode())
+
+def is_row_line(line):
+    """
+    Check if a VCF body line holds a row, i.e. has the columns parse_vcf_line reads.
+    The other lines (i.e. blank ones) are skipped on import, so they have no row.
+
+    Args:
+        line(bytes): A raw VCF body line
+
+    Returns:
+        row(bool): True if the line holds a row
+    """
+    return line.count(FIELD_DEL) >= ROW_FIELDS - 1
+
+def find_body_offset(vcf_path):
+    """
+    Find the byte offset of the first body (non header) line of a VCF file.
+    This also validates that the file has a #CHROM header line.
+
+    Args:
+        vcf_path(str): The full path of the file
+
+    Returns:
+        offset(int): The byte offset right after the #CHROM header line
+    """
+    offset = 0
+    has_columns_header = False
+    with open_vcf_stream(vcf_path) as stream:
+        for line in stream:
+            if not line.startswith(HEADER_PREFIX):
+                break
+            offset += len(line)
+            if line.startswith(COLUMNS_HEADER_PREFIX):
+                has_columns_header = True
+    if not has_columns_header:
+        raise ValueError("VCF body found before the #CHROM header line!")
+    return offset
+
+def split_byte_ranges(vcf_path, parts, min_chunk_size=MIN_CHUNK_SIZE, start_offset=0):
+    """
+    Split the body of an uncompressed VCF file in contiguous byte ranges.
+    The ranges are not line aligned, parse_vcf_chunk takes care of that.
+
+    Args:
+        vcf_path(str): The full path of the file
+        parts(int): The number of ranges we would like
+        min_chunk_size(int): Do not create ranges smaller than this
+        start_offset(int): Only split the body after this offset (i.e. when resuming)
+
+    Returns:
+        ranges(list): A list of (start, end) byte offset tuples in file order
+    """
+    start = max(find_body_offset(vcf_path), start_offset)
+    end = os.path.getsize(vcf_path)
+    chunk_size = max(min_chunk_size, -(-(end - start) // max(parts, 1)))
+    ranges = []
+    while start < end:
+        ranges.append((start, min(start + chunk_size, end)))
+        start += chunk_size
+    return ranges
+
+def parse_vcf_chunk(task):
+    """
+    Parse the lines of a VCF byte range. A line belongs to the range its first byte
+    falls into, so neighbouring ranges never share or lose a line.
+
+    Args:
+        task(tuple): A (vcf_path, start, end) tuple
+
+    Returns:
+        rows(list): The parsed (chrom, pos, id, ref, alt) tuples in file order
+    """
+    vcf_path, start, end = task
+    rows = []
+    with open(vcf_path, 'rb', buffering=READ_BUFFER_SIZE) as stream:
+        offset = seek_line(stream, start)
+        while offset < end:
+            line = stream.readline()
+            if not line:
+                break
+            offset += len(line)
+            fields = parse_vcf_line(line)
+            if fields is not None:
+                rows.append(fields)
+    return rows
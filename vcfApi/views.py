@@ -2,20 +2,77 @@
 Contains all the views that implement the requested functionality. 
 Our urls will be routed to these classes or functions.
 """
+import json
+import base64
+import binascii
+import functools
 from collections import OrderedDict
+from django.core.paginator import Paginator as DjangoPaginator
+from django.db.models import Q
+from django.db.models import Subquery
 from django.http import HttpResponse
+from django.http import StreamingHttpResponse
+from django.utils.functional import cached_property
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
 from rest_framework.pagination import PageNumberPagination
+from rest_framework.settings import api_settings
+from rest_framework.utils.urls import replace_query_param
 from django_filters.rest_framework import DjangoFilterBackend
 from rest_framework.response import Response
+from rest_framework.decorators import action
 from rest_framework import viewsets, filters, status
+from vcfApi.models import Vcf
 from vcfApi.models import VcfRow
+from vcfApi.models import RowCount
 from vcfApi.serializers import VcfRowSerializer
+from vcfApi.serializers import PLACEMENTS
+from vcfApi.serializers import PLACEMENT_END
 from vcfApi import query
+from vcfApi import changefeed
+from vcfApi.cache import cached_response
+from vcfApi.bulk import bulk_update_rows
+from vcfApi.bulk import bulk_delete_rows
 from vcfApi import logger
 from django.conf import settings
 
 AUTH_HEADER = 'HTTP_AUTHORIZATION'
 PREDEFINED_SECRET = settings.PREDEFINED_SECRET
+EXPORT_FIELDS = ('chrom', 'pos', 'id', 'ref', 'alt')
+EXPORT_CHUNK_SIZE = 2000
+EXPORT_FORMAT_PARAM = 'output'
+DRY_RUN_PARAM = 'dry_run'
+PLACEMENT_PARAM = 'placement'
+SINCE_PARAM = 'since'
+LIMIT_PARAM = 'limit'
+WAIT_PARAM = 'wait'
+EXPORT_VCF_HEADER = ("##fileformat=VCFv4.2\n"
+    "#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n")
+
+class CachedCountPaginator(DjangoPaginator):
+    """
+    Django Paginator that uses a known row count instead of running a COUNT query
+    """
+    def __init__(self, object_list, per_page, count=None, **kwargs):
+        super().__init__(object_list, per_page, **kwargs)
+        self.known_count = count
+
+    @cached_property
+    def count(self):
+        """
+        Return the known count if we have one
+        """
+        if self.known_count is not None:
+            return self.known_count
+        return super().count
+
+def get_view_row_count(view):
+    """
+    Get the cached row count of the view's current listing if it provides one
+    """
+    if view is not None and hasattr(view, 'get_row_count'):
+        return view.get_row_count()
+    return None
 
 class CustomPageNumberPagination(PageNumberPagination):
     """
@@ -24,6 +81,14 @@ class CustomPageNumberPagination(PageNumberPagination):
     page_size_query_param = 'page_size'  # items per page
     page_query_param = 'page'
 
+    def paginate_queryset(self, queryset, request, view=None):
+        """
+        Use the cached row count of the view, if there is one, for the pagination
+        """
+        self.django_paginator_class = functools.partial(CachedCountPaginator,
+            count=get_view_row_count(view))
+        return super().paginate_queryset(queryset, request, view=view)
+
     def get_paginated_response(self, data):
         """
         Override the Paginated response with some useful info and links
@@ -36,6 +101,130 @@ class CustomPageNumberPagination(PageNumberPagination):
             ('results', data)
         ]))
 
+class KeysetPagination(BasePagination):
+    """
+    Cursor (keyset) Pagination Class. Pages are selected with a range condition on the
+    ordering index instead of an OFFSET, so every page costs the same regardless of depth.
+    It is used when the request carries a cursor or asks for it via paging=cursor.
+    The count is left out unless requested via with_count=true since it needs a full COUNT.
+    """
+    page_size_query_param = 'page_size'
+    cursor_query_param = 'cursor'
+    paging_query_param = 'paging'
+    paging_query_value = 'cursor'
+    count_query_param = 'with_count'
+    # Ordering fields, the last one needs to be unique
+    ordering = ('sort_key', 'row_id')
+    invalid_cursor_message = 'Invalid cursor.'
+
+    @classmethod
+    def is_requested(cls, request):
+        """
+        Check if the request asks for cursor pagination
+        """
+        params = request.query_params
+        return (cls.cursor_query_param in params
+            or params.get(cls.paging_query_param) == cls.paging_query_value)
+
+    def get_page_size(self, request):
+        """
+        Get the page size from the request or the default from the settings
+        """
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+            if page_size > 0:
+                return page_size
+        except (KeyError, ValueError):
+            pass
+        return api_settings.PAGE_SIZE
+
+    def encode_cursor(self, row, reverse):
+        """
+        Build an opaque cursor from the ordering values of a row
+        """
+        values = [str(getattr(row, field)) for field in self.ordering]
+        values.append('1' if reverse else '0')
+        return base64.urlsafe_b64encode(':'.join(values).encode()).decode()
+
+    def decode_cursor(self, cursor):
+        """
+        Get the ordering values and the direction out of a cursor
+        """
+        try:
+            parts = base64.urlsafe_b64decode(cursor.encode()).decode().split(':')
+            if len(parts) != len(self.ordering) + 1:
+                raise ValueError(cursor)
+            return [int(part) for part in parts[:-1]], parts[-1] == '1'
+        except (ValueError, binascii.Error, UnicodeDecodeError):
+            raise NotFound(self.invalid_cursor_message)
+
+    def keyset_filter(self, values, reverse):
+        """
+        Build the condition selecting the rows after (or before) the given ordering values
+        """
+        lookup = 'lt' if reverse else 'gt'
+        condition = Q()
+        for i, field in enumerate(self.ordering):
+            prefix = dict(zip(self.ordering[:i], values[:i]))
+            condition |= Q(**prefix, **{f"{field}__{lookup}": values[i]})
+        return condition
+
+    def paginate_queryset(self, queryset, request, view=None):
+        """
+        Get a page of rows after (or before) the cursor position
+        """
+        self.request = request
+        page_size = self.get_page_size(request)
+        self.count = None
+        if request.query_params.get(self.count_query_param, '').lower() == 'true':
+            self.count = get_view_row_count(view)
+            if self.count is None:
+                self.count = queryset.count()
+        cursor = request.query_params.get(self.cursor_query_param)
+        reverse = False
+        if cursor:
+            values, reverse = self.decode_cursor(cursor)
+            queryset = queryset.filter(self.keyset_filter(values, reverse))
+        ordering = [f"-{field}" if reverse else field for field in self.ordering]
+        rows = list(queryset.order_by(*ordering)[:page_size + 1])
+        has_more = len(rows) > page_size
+        rows = rows[:page_size]
+        if reverse:
+            rows.reverse()
+        self.next_row = rows[-1] if rows and (has_more or reverse) else None
+        self.previous_row = rows[0] if rows and cursor and (has_more or not reverse) else None
+        return rows
+
+    def get_next_link(self):
+        """
+        Build the link to the page after the current one
+        """
+        if self.next_row is None:
+            return None
+        return replace_query_param(self.request.build_absolute_uri(),
+            self.cursor_query_param, self.encode_cursor(self.next_row, False))
+
+    def get_previous_link(self):
+        """
+        Build the link to the page before the current one
+        """
+        if self.previous_row is None:
+            return None
+        return replace_query_param(self.request.build_absolute_uri(),
+            self.cursor_query_param, self.encode_cursor(self.previous_row, True))
+
+    def get_paginated_response(self, data):
+        """
+        Return the page with its cursor links and the count only if it was requested
+        """
+        response = OrderedDict()
+        if self.count is not None:
+            response['count'] = self.count
+        response['next'] = self.get_next_link()
+        response['previous'] = self.get_previous_link()
+        response['results'] = data
+        return Response(response)
+
 def is_authenticated(metadict):
     """
     Get the Authorization header value from the request META and compare it 
@@ -59,35 +248,221 @@ class VcfRowsList(viewsets.ModelViewSet):
     search_fields = ['chrom','id']
     pagination_class = CustomPageNumberPagination
 
+    def filter_rows(self, regions, my_filters):
+        """
+        Get the rows of the file matching the filters, in any of the regions if there are
+        some. The queries are scoped to the file, so the (vcf, sort_key) index serves the
+        ordering, and every region carries the scope itself to be a range search on the
+        (vcf, chrom, pos) index.
+
+        Args:
+            regions(list): The region strings
+            my_filters(dict): The exact match filters
+
+        Returns:
+            retobjs(QuerySet): The rows
+
+        Raises:
+            ValueError: If any of the region strings is not valid
+        """
+        # Note: In this assignment we assume/support only one Vcf file on the db
+        # A subquery, so the scope doesn't cost a query of its own
+        vcf_id = Subquery(Vcf.objects.order_by('id').values('id')[:1])
+        if regions:
+            return self.queryset.filter(query.region_query(regions, vcf_id), **my_filters)
+        return self.queryset.filter(vcf_id=vcf_id, **my_filters)
+
+    def get_request_rows(self, request):
+        """
+        Get the rows matching the list filters and regions of the querystring, the same
+        for the list, the bulk operations and the export
+
+        Returns:
+            (retobjs, regions, my_filters): The rows, the region strings and the filters
+
+        Raises:
+            ValueError: If any of the region strings is not valid
+        """
+        my_filters = query.filter_query(request.META,self.filterset_fields)
+        regions = query.get_query_values(request.META,query.REGION_PARAM)
+        return self.filter_rows(regions, my_filters), regions, my_filters
+
+    @cached_response
     def list(self, request):
         """
         Override the default list to implement some of the requirements
         """
+        try:
+            retobjs, regions, my_filters = self.get_request_rows(request)
+        except ValueError as err:
+            return Response({"detail": str(err)}, status=status.HTTP_400_BAD_REQUEST)
+        if not regions:
+            # Plain filters may be counted from the maintained counters
+            self.count_filters = my_filters
+        return self.list_response(retobjs)
+
+    @action(detail=False, methods=['get'])
+    def export(self, request):
+        """
+        Stream all the rows matching the list filters and regions as NDJSON (default),
+        TSV or VCF text. The format is selected via the output parameter i.e.
+        /vcfapi/VcfRows/export?output=vcf&chrom=chr1
+        """
+        output = request.query_params.get(EXPORT_FORMAT_PARAM, 'ndjson')
+        if output not in EXPORT_FORMATS:
+            return Response({"detail": f"Output {output} not valid! Please use one of "
+                f"{', '.join(EXPORT_FORMATS)}"}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            retobjs, _, _ = self.get_request_rows(request)
+        except ValueError as err:
+            return Response({"detail": str(err)}, status=status.HTTP_400_BAD_REQUEST)
+        content_type, header, formatter = EXPORT_FORMATS[output]
+        response = StreamingHttpResponse(iter_export(retobjs.order_by('sort_key'), header,
+            formatter), content_type=content_type)
+        response['Content-Disposition'] = f'attachment; filename="vcfrows.{output}"'
+        return response
+
+    def regions(self, request):
+        """
+        Return the rows in any of the regions listed in the request body i.e.
+        {"regions": ["chr7:117,480,000-117,670,000", "chr1:13000-14000"]}
+        The querystring filters and pagination parameters work as in list.
+        """
+        regions = request.data.get('regions') if hasattr(request.data, 'get') else None
+        if (not regions or not isinstance(regions, list)
+                or not all(isinstance(region, str) for region in regions)):
+            return Response({"detail": "Please provide a list of regions."},
+                status=status.HTTP_400_BAD_REQUEST)
         my_filters = query.filter_query(request.META,self.filterset_fields)
-        retobjs = self.queryset.filter(**my_filters)
-        if retobjs:
-            page = self.paginate_queryset(retobjs)
-            if page:
-                serializer = VcfRowSerializer(page, many=True)
-                return self.get_paginated_response(serializer.data)
-            serializer = VcfRowSerializer(retobjs, many=True)
-            return Response(serializer.data)
+        try:
+            retobjs = self.filter_rows(regions, my_filters)
+        except ValueError as err:
+            return Response({"detail": str(err)}, status=status.HTTP_400_BAD_REQUEST)
+        return self.list_response(retobjs)
+
+    def get_row_count(self):
+        """
+        Get the row count of the current listing from the maintained counters.
+        Returns None if the listing filters are not counted.
+        """
+        filters = getattr(self, 'count_filters', None)
+        if filters is None:
+            return None
+        return RowCount.get_count(filters)
+
+    @property
+    def paginator(self):
+        """
+        Use cursor pagination when the request asks for it, page numbers otherwise
+        """
+        if not hasattr(self, '_paginator'):
+            if KeysetPagination.is_requested(self.request):
+                self._paginator = KeysetPagination()
+            else:
+                self._paginator = self.pagination_class()
+        return self._paginator
+
+    def list_response(self, retobjs):
+        """
+        Build the paginated response of a list queryset.
+        Only the requested page is fetched from the db.
+        """
+        page = self.paginate_queryset(retobjs)
+        if page:
+            serializer = VcfRowSerializer(page, many=True)
+            return self.get_paginated_response(serializer.data)
         return Response({"detail": "No results found."},
             status=status.HTTP_404_NOT_FOUND)
 
     def create(self, request):
         """
-        Override the default create to implement authorization checking
+        Override the default create to implement authorization checking.
+        A list of rows is validated as a batch and bulk inserted.
+        New rows go after the last one, or in chrom/pos order with placement=sorted.
         """
         if is_authenticated(request.META):
+            placement = request.query_params.get(PLACEMENT_PARAM, PLACEMENT_END)
+            if placement not in PLACEMENTS:
+                return Response({"detail": f"Placement {placement} not valid! Please use one of "
+                    f"{', '.join(PLACEMENTS)}"}, status=status.HTTP_400_BAD_REQUEST)
             data = request.data.copy()
-            serializer = VcfRowSerializer(data=data)
+            context = {'placement': placement}
+            if isinstance(data, list):
+                serializer = VcfRowSerializer(data=data, many=True, allow_empty=False,
+                    context=context)
+            else:
+                serializer = VcfRowSerializer(data=data, context=context)
             if serializer.is_valid():
                 serializer.save()
                 return Response(serializer.data, status=status.HTTP_201_CREATED)
             return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
         return Response(status=status.HTTP_403_FORBIDDEN)
 
+    def get_bulk_queryset(self, request):
+        """
+        Get the rows a bulk request applies to from its list filters and regions.
+        At least one filter is required so a whole file can not be modified by mistake.
+
+        Returns:
+            (retobjs, error): The queryset or an error response
+        """
+        try:
+            retobjs, regions, my_filters = self.get_request_rows(request)
+        except ValueError as err:
+            return None, Response({"detail": str(err)}, status=status.HTTP_400_BAD_REQUEST)
+        if not my_filters and not regions:
+            return None, Response({"detail": "Please provide at least one filter."},
+                status=status.HTTP_400_BAD_REQUEST)
+        return retobjs, None
+
+    def bulk_response(self, request, retobjs, operation, *args):
+        """
+        Run a bulk operation on the filtered rows and respond with the affected count.
+        With dry_run=true only the count of the rows that would be affected is returned.
+        """
+        if request.query_params.get(DRY_RUN_PARAM, '').lower() == 'true':
+            return Response({"count": retobjs.count(), "dry_run": True})
+        try:
+            count = operation(retobjs, *args)
+        except Exception as err:
+            logger.logException(err)
+            return Response(status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+        if not count:
+            return Response({"detail": "No results found."},
+                status=status.HTTP_404_NOT_FOUND)
+        return Response({"count": count})
+
+    def bulk_update(self, request):
+        """
+        Update all the rows matching the list filters with a single statement
+        i.e. PATCH /vcfapi/VcfRows?chrom=chr23 {"chrom": "chrX"}
+        """
+        if not is_authenticated(request.META):
+            return Response(status=status.HTTP_403_FORBIDDEN)
+        retobjs, error = self.get_bulk_queryset(request)
+        if error:
+            return error
+        serializer = VcfRowSerializer(data=request.data.copy(), partial=True)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        if not serializer.validated_data:
+            return Response({"detail": "Please provide at least one field to update."},
+                status=status.HTTP_400_BAD_REQUEST)
+        return self.bulk_response(request, retobjs, bulk_update_rows,
+            dict(serializer.validated_data))
+
+    def bulk_destroy(self, request):
+        """
+        Delete all the rows matching the list filters with a single statement
+        i.e. DELETE /vcfapi/VcfRows?chrom=chr23&dry_run=true
+        """
+        if not is_authenticated(request.META):
+            return Response(status=status.HTTP_403_FORBIDDEN)
+        retobjs, error = self.get_bulk_queryset(request)
+        if error:
+            return error
+        return self.bulk_response(request, retobjs, bulk_delete_rows)
+
 class VcfRowsDetail(viewsets.ModelViewSet):
     """
     Detail view for VcfRows that takes id as key. 
@@ -98,6 +473,7 @@ class VcfRowsDetail(viewsets.ModelViewSet):
     pagination_class = CustomPageNumberPagination
     lookup_field = "id"
 
+    @cached_response
     def retrieve(self, request, id = None, format=None):
         """
         Override the default retrieve to return multiples per the requirement
@@ -119,16 +495,14 @@ class VcfRowsDetail(viewsets.ModelViewSet):
 
     def destroy(self, request, id = None, format=None):
         """
-        Override the default destroy to implement authorization checking
+        Override the default destroy to implement authorization checking.
+        All the rows with the id are deleted with a single statement.
         """
         if is_authenticated(request.META):
             try:
-                pkobjs = VcfRow.objects.filter(id=id)
-                if len(pkobjs) == 0:
+                if not bulk_delete_rows(VcfRow.objects.filter(id=id)):
                     return Response({"detail": "No results found."},
                         status=status.HTTP_404_NOT_FOUND)
-                for pkobj in pkobjs:
-                    pkobj.delete()
             except Exception as err:
                 logger.logException(err)
                 return Response(status=status.HTTP_500_INTERNAL_SERVER_ERROR)
@@ -137,24 +511,21 @@ class VcfRowsDetail(viewsets.ModelViewSet):
 
     def handle_update_request(self, request, id, partial):
         """
-        Performs a validated update on the selected objects
+        Performs a validated update on the selected objects.
+        The data is validated once and all the rows with the id are updated
+        with a single statement.
         """
         if is_authenticated(request.META):
             try:
-                pkobjs = VcfRow.objects.filter(id=id)
-                if len(pkobjs) == 0:
+                serializer = VcfRowSerializer(data=request.data.copy(),partial=partial)
+                if not serializer.is_valid():
+                    logger.error(serializer.errors)
+                    return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+                logger.info(f"Saving rows with id {id}")
+                if not bulk_update_rows(VcfRow.objects.filter(id=id),
+                        dict(serializer.validated_data)):
                     return Response({"detail": "No results found."},
                         status=status.HTTP_404_NOT_FOUND)
-                data = request.data.copy()
-                for pkobj in pkobjs:
-                    logger.info(f"Checking {pkobj}")
-                    serializer = VcfRowSerializer(pkobj,data=data,partial=partial)
-                    if serializer.is_valid():
-                        logger.info(f"Saving {pkobj}")
-                        serializer.save()
-                    else:
-                        logger.error(serializer.errors)
-                        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
                 return Response(status=status.HTTP_200_OK)
             except Exception as err:
                 logger.logException(err)
@@ -172,3 +543,108 @@ class VcfRowsDetail(viewsets.ModelViewSet):
         Override the default PATCH update to implement authorization checking
         """
         return self.handle_update_request(request, id, partial=True)
+
+def format_ndjson_row(row):
+    """
+    Format an exported row as a JSON line
+    """
+    return json.dumps(dict(zip(EXPORT_FIELDS, row))) + "\n"
+
+def format_tsv_row(row):
+    """
+    Format an exported row as a tab separated line
+    """
+    return "\t".join(str(value) for value in row) + "\n"
+
+def format_vcf_row(row):
+    """
+    Format an exported row as a VCF body line with the missing values set to '.'
+    """
+    return "\t".join(str(value) if value not in (None, '') else '.' for value in row) \
+        + "\t.\t.\t.\n"
+
+# format name: (content type, header, row formatter)
+EXPORT_FORMATS = {
+    'ndjson': ('application/x-ndjson', '', format_ndjson_row),
+    'tsv': ('text/tab-separated-values', "#" + "\t".join(EXPORT_FIELDS).upper() + "\n",
+        format_tsv_row),
+    'vcf': ('text/x-vcf', EXPORT_VCF_HEADER, format_vcf_row),
+}
+
+def iter_export(retobjs, header, formatter):
+    """
+    Stream the formatted rows of a queryset in chunks. The rows are read through a
+    server side iterator so the memory used does not depend on the result size.
+    """
+    yield header
+    lines = []
+    for row in retobjs.values_list(*EXPORT_FIELDS).iterator(chunk_size=EXPORT_CHUNK_SIZE):
+        lines.append(formatter(row))
+        if len(lines) >= EXPORT_CHUNK_SIZE:
+            yield "".join(lines)
+            lines = []
+    if lines:
+        yield "".join(lines)
+
+def parse_number_param(params, name, cast, default, minimum=0, maximum=None):
+    """
+    Get a number query parameter, checking it is within bounds
+
+    Args:
+        params(QueryDict): The query parameters
+        name(str): The parameter name
+        cast(type): int or float
+        default: The value if the parameter is missing
+        minimum: The smallest valid value
+        maximum: The largest valid value, None for no limit
+
+    Returns:
+        value: The value
+
+    Raises:
+        ValueError: If the value is not a number within the bounds
+    """
+    if name not in params:
+        return default
+    value = cast(params[name])
+    # Written so that NaN fails the bounds check too
+    if not value >= minimum or (maximum is not None and not value <= maximum):
+        raise ValueError(name)
+    return value
+
+class ChangeFeed(viewsets.ViewSet):
+    """
+    This is the class that returns the row changes after a version, for replicas that
+    mirror the rows. Used by the /vcfapi/changes endpoint.
+    """
+    def list(self, request):
+        """
+        Return the row changes after a version.
+        Without a since parameter only the current version is returned: a new replica reads
+        it, copies the rows and follows the feed from it. The changes are paged by the limit
+        parameter and the more flag, wait=<seconds> holds the request until changes come in
+        (long polling, up to VCFAPI_CHANGES_MAX_WAIT seconds). A version older than the
+        pruned deletions answers 410, the replica has to copy the rows again.
+        i.e. /vcfapi/changes?since=1520&wait=10
+        """
+        params = request.query_params
+        try:
+            since = parse_number_param(params, SINCE_PARAM, int, None)
+            limit = parse_number_param(params, LIMIT_PARAM, int, changefeed.CHANGES_PAGE_SIZE,
+                minimum=1, maximum=changefeed.MAX_CHANGES_PAGE_SIZE)
+            wait = parse_number_param(params, WAIT_PARAM, float, 0)
+        except ValueError as err:
+            return Response({"detail": f"Parameter {err} not valid! Please use {SINCE_PARAM}="
+                f"<version>, {LIMIT_PARAM}=1-{changefeed.MAX_CHANGES_PAGE_SIZE} and "
+                f"{WAIT_PARAM}=<seconds>"}, status=status.HTTP_400_BAD_REQUEST)
+        if since is None:
+            return Response({"version": changefeed.get_latest_version(), "more": False,
+                "changes": []})
+        changes, more = changefeed.wait_for_changes(since, limit, wait)
+        # Checked after the read, so deletions pruned while reading are not missed
+        if since < changefeed.get_oldest_version():
+            return Response({"detail": "Version too old, deleted rows were pruned since. "
+                "Please copy the rows again from the current version.",
+                "version": changefeed.get_latest_version()}, status=status.HTTP_410_GONE)
+        return Response({"version": changes[-1]['version'] if changes else since,
+            "more": more, "changes": changes})